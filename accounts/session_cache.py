@@ -0,0 +1,129 @@
+"""Cached session to user resolution for WebSocket handshakes.
+
+Resolving the user of a WebSocket handshake loads the session and the user
+from the database. Instead, the few user fields consumers need are cached by
+session key for WEBSOCKET_USER_CACHE_TIMEOUT, signed so that cache entries
+cannot be forged by anyone who can write to the cache. Signing out, changing
+password and deleting the account invalidate the user's cached sessions.
+
+Entries record the generation of the user's sessions they were cached in, and
+invalidating the user's sessions starts a new generation, so entries of
+earlier generations are ignored. An entry cached concurrently with the
+invalidation has the earlier generation, so it cannot survive it.
+"""
+
+import time
+
+from channels.auth import AuthMiddleware
+import channels.auth
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.core.cache import cache
+
+SIGNING_SALT = 'accounts.session_cache'
+
+
+class SessionUser:
+    """The fields of an authenticated user that consumers use."""
+    is_anonymous = False
+    is_authenticated = True
+
+    def __init__(self, user_id, username, email):
+        self.id = user_id  # pylint: disable=invalid-name
+        self.username = username
+        self.email = email
+
+    @property
+    def pk(self):  # pylint: disable=invalid-name
+        return self.id
+
+    def __str__(self):
+        return f'user-{self.id}'
+
+
+async def get_user(scope):
+    """Return the user of the scope's session, reading through the cache."""
+    session_key = scope['session'].session_key
+    if session_key is None:
+        return AnonymousUser()
+
+    user = await database_sync_to_async(get_cached_user)(session_key)
+    if user is None:
+        user = await channels.auth.get_user(scope)
+        if user.is_authenticated:
+            await database_sync_to_async(cache_user)(session_key, user)
+
+    return user
+
+
+def get_cached_user(session_key):
+    value = cache.get(get_session_cache_key(session_key))
+    if value is None:
+        return None
+
+    try:
+        fields = signing.loads(value, salt=SIGNING_SALT)
+    except signing.BadSignature:
+        return None
+
+    # Entries cached before generations were recorded have none
+    if fields.get('generation') != get_user_sessions_generation(fields['id']):
+        return None
+
+    return SessionUser(fields['id'], fields['username'], fields['email'])
+
+
+def cache_user(session_key, user):
+    value = signing.dumps(
+        {
+            'id': user.id,
+            'username': user.username,
+            'email': user.email,
+            'generation': get_user_sessions_generation(user.id),
+        },
+        salt=SIGNING_SALT)
+    cache.set(get_session_cache_key(session_key), value,
+              settings.WEBSOCKET_USER_CACHE_TIMEOUT)
+
+
+def invalidate_session(session_key):
+    if session_key is not None:
+        cache.delete(get_session_cache_key(session_key))
+
+
+def invalidate_user_sessions(user_id):
+    get_user_sessions_generation(user_id)
+    cache.incr(get_user_sessions_generation_cache_key(user_id))
+
+
+def get_user_sessions_generation(user_id):
+    generation_key = get_user_sessions_generation_cache_key(user_id)
+    generation = cache.get(generation_key)
+    if generation is None:
+        # Start new generation sequences from the current time so they cannot
+        # validate entries cached in an evicted sequence.
+        cache.add(generation_key, int(time.time() * 1000), timeout=None)
+        generation = cache.get(generation_key)
+
+    return generation
+
+
+def get_session_cache_key(session_key):
+    return f'session-user-{session_key}'
+
+
+def get_user_sessions_generation_cache_key(user_id):
+    return f'user-sessions-{user_id}-generation'
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """AuthMiddleware which resolves the user through the cache."""
+    async def resolve_scope(self, scope):
+        scope['user']._wrapped = await get_user(scope)  # pylint: disable=protected-access
+
+
+def CachedAuthMiddlewareStack(inner):  # pylint: disable=invalid-name
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
@@ -0,0 +1,114 @@
+# Disable redefinition of outer name for pytest which uses this feature for
+# fixtures.
+# pylint: disable=redefined-outer-name
+
+from importlib import import_module
+from unittest import mock
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+import pytest
+
+from accounts import session_cache
+from accounts.models import User
+
+MOCK_USERNAME = 'MockUsername'
+MOCK_EMAIL = 'mock@example.com'
+MOCK_PASSWORD = 'MockPassword'
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_get_user_reads_through_cache(user: User, session_key: str):
+    scope = create_scope(session_key)
+    db_user = await session_cache.get_user(scope)
+    assert db_user.id == user.id
+
+    # The session is no longer needed to resolve the user
+    await delete_sessions()
+
+    scope = create_scope(session_key)
+    cached_user = await session_cache.get_user(scope)
+    assert isinstance(cached_user, session_cache.SessionUser)
+    assert cached_user.id == user.id
+    assert cached_user.username == MOCK_USERNAME
+    assert cached_user.email == MOCK_EMAIL
+    assert not cached_user.is_anonymous
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_get_user_ignores_forged_cache_entries(user: User,
+                                                     session_key: str):
+    cache.set(session_cache.get_session_cache_key(session_key), 'forged-entry')
+
+    scope = create_scope(session_key)
+    resolved_user = await session_cache.get_user(scope)
+    assert isinstance(resolved_user, User)
+    assert resolved_user.id == user.id
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_get_user_without_session_is_anonymous():
+    scope = create_scope(None)
+    resolved_user = await session_cache.get_user(scope)
+    assert resolved_user.is_anonymous
+
+
+@pytest.mark.django_db
+def test_invalidate_user_sessions(user: User):
+    session_cache.cache_user('session1', user)
+    session_cache.cache_user('session2', user)
+
+    session_cache.invalidate_user_sessions(user.id)
+
+    assert session_cache.get_cached_user('session1') is None
+    assert session_cache.get_cached_user('session2') is None
+
+
+@pytest.mark.django_db
+def test_invalidate_user_sessions_while_caching_a_session(user: User):
+    def dumps(*args, **kwargs):
+        value = signing_dumps(*args, **kwargs)
+        # The user signs out while their session is being cached
+        session_cache.invalidate_user_sessions(user.id)
+        return value
+
+    signing_dumps = session_cache.signing.dumps
+    with mock.patch.object(session_cache.signing, 'dumps', dumps):
+        session_cache.cache_user('session1', user)
+
+    assert session_cache.get_cached_user('session1') is None
+
+
+# Fixtures
+
+
+@pytest.fixture
+def user() -> User:
+    return auth.get_user_model().objects.create_user(username=MOCK_USERNAME,
+                                                     email=MOCK_EMAIL,
+                                                     password=MOCK_PASSWORD)
+
+
+@pytest.fixture
+def session_key(client, user: User) -> str:
+    client.force_login(user)
+    return client.session.session_key
+
+
+# Utils
+
+
+def create_scope(session_key):
+    session_store = import_module(settings.SESSION_ENGINE).SessionStore
+    return {'session': session_store(session_key)}
+
+
+@database_sync_to_async
+def delete_sessions():
+    Session.objects.all().delete()
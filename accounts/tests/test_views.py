@@ -1,5 +1,6 @@
 from http import HTTPStatus
 
+from accounts import session_cache
 from accounts.models import User
 from django.contrib import auth
 from django.test import TestCase
@@ -100,6 +101,30 @@ class AccountsViewsTests(TestCase):
         assert self.client.login(username=MOCK_USERNAME,
                                  password=MOCK_PASSWORD2)
 
+    def test_user_logout_invalidates_cached_session(self):
+        user = create_user()
+        self.client.force_login(user)
+        session_key = self.client.session.session_key
+        session_cache.cache_user(session_key, user)
+
+        response = self.client.get('/logout/')
+        self.assertRedirects(response, '/')
+        assert session_cache.get_cached_user(session_key) is None
+
+    def test_user_password_change_invalidates_cached_sessions(self):
+        user = create_user()
+        self.client.force_login(user)
+        session_cache.cache_user('MockOtherSessionKey', user)
+
+        response = self.client.post(
+            f'/accounts/{user.id}/', {
+                'old_password': MOCK_PASSWORD,
+                'new_password1': MOCK_PASSWORD2,
+                'new_password2': MOCK_PASSWORD2,
+            })
+        self.assertRedirects(response, f'/accounts/{user.id}/')
+        assert session_cache.get_cached_user('MockOtherSessionKey') is None
+
     def test_user_can_only_change_their_password(self):
         user = create_user()
         self.client.force_login(user)
@@ -10,5 +10,10 @@ urlpatterns = [
     path('<int:pk>/delete/',
          views.UserDeleteView.as_view(),
          name='account-delete'),
+    # Override the auth views which invalidate cached sessions
+    path('logout/', views.LogoutView.as_view(), name='logout'),
+    path('password_change/',
+         views.PasswordChangeView.as_view(),
+         name='password_change'),
     path('', include('django.contrib.auth.urls')),
 ]
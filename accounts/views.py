@@ -3,8 +3,10 @@
 from django.contrib import auth
 from django.contrib.auth.forms import PasswordChangeForm
 from django.contrib.auth.mixins import LoginRequiredMixin
-# pylint: disable=unused-import
-from django.contrib.auth.views import LoginView as DefaultLoginView, LogoutView, PasswordChangeView
+from django.contrib.auth.views import (LoginView as DefaultLoginView,
+                                       LogoutView as DefaultLogoutView,
+                                       PasswordChangeView as
+                                       DefaultPasswordChangeView)
 from django.shortcuts import redirect
 from django.urls import reverse, reverse_lazy
 from django.views import View
@@ -12,6 +14,7 @@ from django.views.generic import DetailView
 # pylint: disable=unused-import
 from django.views.generic.edit import CreateView, DeleteView, UpdateView
 
+from . import session_cache
 from .forms import CustomUserCreationForm
 from .models import User
 
@@ -55,6 +58,20 @@ class LoginView(DefaultLoginView):
             return super().post(request, *args, **kwargs)
 
 
+class LogoutView(DefaultLogoutView):
+    def dispatch(self, request, *args, **kwargs):
+        session_cache.invalidate_session(request.session.session_key)
+        return super().dispatch(request, *args, **kwargs)
+
+
+class PasswordChangeView(DefaultPasswordChangeView):
+    def form_valid(self, form):
+        response = super().form_valid(form)
+        # Sessions with the previous password are no longer valid
+        session_cache.invalidate_user_sessions(self.request.user.id)
+        return response
+
+
 class UserDetailView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         view = ShowUserDetailView.as_view()
@@ -105,6 +122,8 @@ class UserDeleteView(LoginRequiredMixin, DeleteView):
 
     def post(self, request, *args, **kwargs):
         if request.user.id == kwargs['pk']:
-            return super().post(request, *args, **kwargs)
+            response = super().post(request, *args, **kwargs)
+            session_cache.invalidate_user_sessions(kwargs['pk'])
+            return response
         else:
             return redirect('homepage')
@@ -0,0 +1,20 @@
+from django.core.cache import cache
+import pytest
+
+from radio import presence
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    """Database ids are reused between tests, so cache entries must not be."""
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_presence():
+    """Forget the presence of the previous test's users."""
+    presence._presence = None  # pylint: disable=protected-access
+    yield
+    presence._presence = None  # pylint: disable=protected-access
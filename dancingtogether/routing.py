@@ -1,7 +1,7 @@
 from django.urls import path
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 
+from accounts.session_cache import CachedAuthMiddlewareStack
 import radio.consumers
 
 # The channel routing defines what connections get handled by what consumers,
@@ -12,7 +12,7 @@ application = ProtocolTypeRouter({
     # Channels will do this for you automatically. It's included here as an example.
     # "http": AsgiHandler,
     'websocket':
-    AuthMiddlewareStack(
+    CachedAuthMiddlewareStack(
         URLRouter([
             path('api/stations/<int:station_id>/stream/',
                  radio.consumers.StationConsumer),
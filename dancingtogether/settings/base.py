@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
+from datetime import timedelta
 import os
 from pathlib import Path
 import typing
@@ -225,6 +226,16 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Caches
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ.get('REDIS_URL'),
+    },
+}
+
 # Django Rest Framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -247,5 +258,104 @@ SPOTIFY_CLIENT_SECRET = os.environ.get('DT_SPOTIFY_CLIENT_SECRET')
 SPOTIFY_PLAYER_NAME = os.environ.get('DT_SPOTIFY_PLAYER_NAME',
                                      'Dancing Together')
 
+# Playback state cache
+
+PLAYBACK_STATE_CACHE_TIMEOUT = 60 * 60  # seconds
+# Write position-only playback state updates to the cache and flush them to
+# the database at most once per PLAYBACK_STATE_FLUSH_INTERVAL
+PLAYBACK_STATE_BATCH_FLUSH_POSITIONS = bool(
+    os.environ.get('DT_PLAYBACK_STATE_BATCH_FLUSH_POSITIONS', False))
+PLAYBACK_STATE_FLUSH_INTERVAL = timedelta(seconds=30)
+# DJ heartbeats within this much of the position extrapolated from the
+# previous sample are not saved or broadcast, apart from a checkpoint once per
+# PLAYBACK_STATE_FLUSH_INTERVAL
+PLAYBACK_STATE_HEARTBEAT_TOLERANCE = timedelta(milliseconds=500)
+# Listeners are told where to seek to this far in advance, as seeking the
+# music player takes a while
+PLAYBACK_STATE_SEEK_LEAD_TIME = timedelta(seconds=2)
+
+# Authenticated WebSocket handshakes read the user of their session from the
+# cache for this long
+WEBSOCKET_USER_CACHE_TIMEOUT = 60  # seconds
+
+# NTP-style clock synchronization of station clients
+CLOCK_SYNC_SAMPLES = 8
+CLOCK_SYNC_MAX_SAMPLES = 32
+CLOCK_SYNC_CACHE_TIMEOUT = 60 * 60  # seconds
+
+# Joining stations
+
+# Limits concurrent station joins per server process during reconnect storms
+STATION_JOIN_MAX_CONCURRENCY = int(
+    os.environ.get('DT_STATION_JOIN_MAX_CONCURRENCY', 32))
+STATION_JOIN_MAX_QUEUED = int(
+    os.environ.get('DT_STATION_JOIN_MAX_QUEUED', 1000))
+STATION_JOIN_QUEUE_TIMEOUT = timedelta(seconds=5)
+# Rejected clients are told to retry after one to two times this
+STATION_JOIN_RETRY_AFTER = timedelta(seconds=5)
+# Admission counters are logged at most this often while rejecting joins
+STATION_JOIN_STATS_LOG_INTERVAL = timedelta(seconds=10)
+# Joins and leaves of a station are sent to its admins in batches of this long
+LISTENER_CHANGE_BATCH_WINDOW = timedelta(seconds=1)
+# Admins are sent every listener of the station this often
+LISTENER_ROSTER_SNAPSHOT_INTERVAL = timedelta(seconds=60)
+
+# DJs other than the one who last changed the playback state are read-only
+# until it has not been changed for this long
+DJ_LEASE_DURATION = timedelta(seconds=15)
+# Acquiring a DJ lease gives up after waiting this long for a concurrent
+# acquisition of the same station's lease
+DJ_LEASE_LOCK_WAIT = timedelta(seconds=1)
+
+# Stations are paused when their DJ leaves, unless the DJ reconnects within
+# this long
+DJ_RECONNECT_GRACE_PERIOD = timedelta(seconds=10)
+
+# The station index lists stations in pages of this many
+STATION_PAGE_SIZE = 25
+
+# Listeners are listed in pages of this many
+LISTENER_PAGE_SIZE = 100
+
+# Most listeners that can be invited or removed in one request
+LISTENER_BULK_MAX_SIZE = 500
+
+# Presence of connected listeners
+
+PRESENCE_BACKEND = 'radio.presence.RedisPresence'
+# Connections refresh their presence at most this often while they are active
+PRESENCE_REFRESH_INTERVAL = timedelta(seconds=30)
+# Users not seen for this long are assumed to be gone, e.g. because their
+# server process crashed
+PRESENCE_STALE_AFTER = timedelta(minutes=5)
+PRESENCE_ROSTER_PAGE_SIZE = 50
+
 SPOTIFY_TOKEN_API_URL = 'https://accounts.spotify.com/api/token'
+# Access tokens are refreshed once they expire within this long, and requests
+# for a refresh are answered with the current token until then
+SPOTIFY_ACCESS_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# Refreshes made while holding the lock on the user's credentials give up,
+# retries included, after about this long
+SPOTIFY_ACCESS_TOKEN_LOCKED_REFRESH_DEADLINE = timedelta(seconds=5)
+# The refresh_access_tokens worker refreshes the tokens of connected listeners
+# which expire within SPOTIFY_PROACTIVE_REFRESH_LEAD every
+# SPOTIFY_PROACTIVE_REFRESH_INTERVAL, at most SPOTIFY_PROACTIVE_REFRESH_RATE
+# tokens per second
+SPOTIFY_PROACTIVE_REFRESH_LEAD = timedelta(minutes=10)
+SPOTIFY_PROACTIVE_REFRESH_INTERVAL = timedelta(minutes=1)
+SPOTIFY_PROACTIVE_REFRESH_RATE = 5
+SPOTIFY_PROACTIVE_REFRESH_BATCH_SIZE = 500
+# Tokens which expired longer ago are left to be refreshed on demand
+SPOTIFY_PROACTIVE_REFRESH_EXPIRED_GRACE = timedelta(minutes=5)
+# Requests to the token API share a pool of this many keep-alive connections
+SPOTIFY_ACCOUNTS_POOL_SIZE = 10
+SPOTIFY_ACCOUNTS_CONNECT_TIMEOUT = timedelta(seconds=3)
+SPOTIFY_ACCOUNTS_READ_TIMEOUT = timedelta(seconds=10)
+# Rate limited, failed and unconnected requests are retried this many times,
+# after a backoff that doubles from SPOTIFY_ACCOUNTS_RETRY_BACKOFF, or after
+# the Retry-After time unless that is longer than
+# SPOTIFY_ACCOUNTS_MAX_RETRY_AFTER
+SPOTIFY_ACCOUNTS_MAX_RETRIES = 3
+SPOTIFY_ACCOUNTS_RETRY_BACKOFF = timedelta(milliseconds=500)
+SPOTIFY_ACCOUNTS_MAX_RETRY_AFTER = timedelta(seconds=10)
 SPOTIFY_PLAYER_PLAY_API_URL = 'https://api.spotify.com/v1/me/player/play'
@@ -17,11 +17,32 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
+# Webpack
+# Frontend bundles are not built for tests, so pages render without them
+
+WEBPACK_LOADER = {
+    'DEFAULT': {
+        'BUNDLE_DIR_NAME':
+        'bundles/',
+        'STATS_FILE':
+        os.path.join(BASE_DIR, 'radio', 'tests', 'webpack-stats.json'),
+    },
+}
+
 # Test
 # https://docs.djangoproject.com/en/2.0/topics/testing/
 
 TEST_RUNNER = 'dancingtogether.runner.PytestTestRunner'
 
+# Caches
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
 # Channel layer definitions
 # http://channels.readthedocs.io/en/latest/topics/channel_layers.html
 
@@ -33,3 +54,7 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+# Presence of connected listeners
+
+PRESENCE_BACKEND = 'radio.presence.InMemoryPresence'
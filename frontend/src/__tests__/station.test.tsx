@@ -20,6 +20,7 @@ import MockMusicPlayer from "../__mocks__/spotify_music_player";
 
 const MOCK_USER_ID = 1;
 const MOCK_USERNAME1 = "MOCK_USERNAME1";
+const MOCK_USERNAME2 = "MOCK_USERNAME2";
 const MOCK_STATION_ID = 1;
 const MOCK_STATION_NAME = "MOCK_STATION_NAME";
 const MOCK_CROSS_SITE_REQUEST_FORGERY_TOKEN =
@@ -123,26 +124,48 @@ describe("station server", () => {
     );
   });
 
+  it("can synchronize clocks", async () => {
+    expect.assertions(3);
+    const mockWebSocketBridge = new MockWebSocketBridge();
+    const stationServer = createStationServer(mockWebSocketBridge);
+
+    // eslint-disable-next-line jest/valid-expect-in-promise
+    mockWebSocketBridge.receiveData().then((data) => {
+      expect(data).toEqual({ command: "time_sync" });
+
+      // eslint-disable-next-line jest/valid-expect-in-promise
+      mockWebSocketBridge.receiveData().then((pong) => {
+        expect(pong).toEqual(
+          expect.objectContaining({
+            command: "time_sync_pong",
+            sample_id: 0,
+          })
+        );
+        mockWebSocketBridge.fire({
+          offset_us: -1500,
+          rtt_us: 20000,
+          type: "time_sync_result",
+        });
+      });
+      mockWebSocketBridge.fire({
+        sample_id: 0,
+        server_transmit_us: 1000,
+        type: "time_sync_ping",
+      });
+    });
+
+    await expect(stationServer.sendTimeSyncRequest()).resolves.toEqual({
+      clientServerTimeOffset: -1.5,
+      roundTripTime: 20,
+    });
+  });
+
   it("can send a playback state", async () => {
     expect.assertions(2);
-    const stationServer = createStationServer(new MockWebSocketBridge());
+    const mockWebSocketBridge = new MockWebSocketBridge();
+    const stationServer = createStationServer(mockWebSocketBridge);
 
-    // Mock server response
     const sampleTime = new Date();
-    const responsePlaybackState = new ServerPlaybackState(
-      MOCK_CONTEXT_URI,
-      MOCK_CURRENT_TRACK_URI,
-      true /*paused*/,
-      1000 /*raw_position_ms*/,
-      sampleTime,
-      MOCK_SERVER_ETAG2
-    );
-    fetchMock.mockResponseOnce(
-      JSON.stringify({
-        playbackstate: responsePlaybackState,
-      })
-    );
-
     const currentPlaybackState = new ServerPlaybackState(
       MOCK_CONTEXT_URI,
       MOCK_CURRENT_TRACK_URI,
@@ -151,6 +174,28 @@ describe("station server", () => {
       sampleTime
     );
 
+    // Mock server response
+    // eslint-disable-next-line jest/valid-expect-in-promise
+    mockWebSocketBridge.receiveData().then((data) => {
+      expect(data).toEqual({
+        command: "player_state_change",
+        request_id: 1,
+        state: currentPlaybackState,
+      });
+      mockWebSocketBridge.fire({
+        type: "ensure_playback_state",
+        request_id: data.request_id,
+        state: new ServerPlaybackState(
+          MOCK_CONTEXT_URI,
+          MOCK_CURRENT_TRACK_URI,
+          true /*paused*/,
+          1000 /*raw_position_ms*/,
+          sampleTime,
+          MOCK_SERVER_ETAG2
+        ),
+      });
+    });
+
     const expectedResponsePlaybackState = new PlaybackState(
       MOCK_CONTEXT_URI,
       MOCK_CURRENT_TRACK_URI,
@@ -162,8 +207,6 @@ describe("station server", () => {
     await expect(
       stationServer.sendPlaybackState(currentPlaybackState)
     ).resolves.toEqual(expectedResponsePlaybackState);
-
-    expect(fetchMock.mock.calls.length).toEqual(1);
   });
 
   it("can get the playback state", async () => {
@@ -270,12 +313,30 @@ describe("station server", () => {
       stationId: MOCK_STATION_ID,
       username: MOCK_USERNAME1,
     };
-    const responseListeners = [createServerListener(listener)];
-    fetchMock.mockResponseOnce(JSON.stringify(responseListeners));
+    const listener2 = { ...listener, id: 3, username: MOCK_USERNAME2 };
+    const nextUrl = `/api/v1/stations/${MOCK_STATION_ID}/listeners/?cursor=1`;
+    fetchMock.mockResponseOnce(
+      JSON.stringify({
+        next: nextUrl,
+        previous: null,
+        results: [createServerListener(listener)],
+      })
+    );
+    fetchMock.mockResponseOnce(
+      JSON.stringify({
+        next: null,
+        previous: nextUrl,
+        results: [createServerListener(listener2)],
+      })
+    );
 
-    await expect(stationServer.getListeners()).resolves.toEqual([listener]);
+    await expect(stationServer.getListeners()).resolves.toEqual([
+      listener,
+      listener2,
+    ]);
 
-    expect(fetchMock.mock.calls.length).toEqual(1);
+    expect(fetchMock.mock.calls.length).toEqual(2);
+    expect(fetchMock.mock.calls[1][0]).toEqual(nextUrl);
   });
 
   test("station server can invite listeners", async () => {
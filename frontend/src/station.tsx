@@ -229,7 +229,7 @@ export class StationManager extends React.Component<
       this.state.taskExecutor.push(() => this.showListeners());
     }
 
-    this.state.taskExecutor.push(() => this.calculatePing());
+    this.state.taskExecutor.push(() => this.syncClock());
     this.state.taskExecutor.push(() => this.syncServerPlaybackState());
     this.enableHeartbeat();
   }
@@ -301,6 +301,23 @@ export class StationManager extends React.Component<
     this.adjustServerTimeOffset(pong.startTime, pong.serverTime, new Date());
   }
 
+  private async syncClock(): Promise<void> {
+    const result = await Promise.race([
+      this.props.server.sendTimeSyncRequest(),
+      timeout(5000),
+    ]);
+
+    const roundTripTimes = this.state.roundTripTimes;
+    roundTripTimes.push(result.roundTripTime);
+    const clientServerTimeOffsets = this.state.clientServerTimeOffsets;
+    clientServerTimeOffsets.push(result.clientServerTimeOffset);
+
+    this.setState({
+      clientServerTimeOffsets,
+      roundTripTimes,
+    });
+  }
+
   private getOAuthToken(cb: (accessToken: string) => void) {
     let refreshTokenIfNeeded = Promise.resolve(this.props.accessToken);
     if (new Date() > this.props.accessTokenExpirationTime) {
@@ -510,6 +527,12 @@ interface IPongResponse {
   serverTime: Date;
 }
 
+interface ITimeSyncResult {
+  // Milliseconds
+  roundTripTime: number;
+  clientServerTimeOffset: number;
+}
+
 interface IOAuthTokenResponse {
   accessToken: string;
   accessTokenExpirationTime: Date;
@@ -537,7 +560,11 @@ export class StationServer {
     ["join", $.Callbacks()],
     ["pong", $.Callbacks()],
     ["playback_state_changed", $.Callbacks()],
+    ["ensure_playback_state", $.Callbacks()],
+    ["time_sync_result", $.Callbacks()],
   ]);
+  private nextRequestId = 1;
+  private joinPlaybackState?: PlaybackState;
 
   constructor(
     private stationId: number,
@@ -595,6 +622,16 @@ export class StationServer {
     });
   }
 
+  // Synchronizes clocks with a burst of pings sent by the server
+  public sendTimeSyncRequest(): Promise<ITimeSyncResult> {
+    return new Promise((resolve) => {
+      this.onOnce("time_sync_result", resolve);
+      this.webSocketBridge.send({
+        command: "time_sync",
+      });
+    });
+  }
+
   public async refreshOAuthToken(userId: number): Promise<IOAuthTokenResponse> {
     const url = `/api/v1/users/${userId}/accesstoken/refresh/`;
     const response = await fetch(url, {
@@ -613,35 +650,39 @@ export class StationServer {
     }
   }
 
-  public async sendPlaybackState(
+  public sendPlaybackState(
     playbackState: PlaybackState
   ): Promise<PlaybackState> {
-    const url = `/api/v1/stations/${this.stationId}/`;
-
-    const headers = new Headers();
-    headers.append("X-CSRFToken", this.csrftoken);
-    headers.append("Content-Type", "application/json");
+    const requestId = this.nextRequestId;
+    this.nextRequestId += 1;
 
-    const response = await fetch(url, {
-      body: JSON.stringify({
-        playbackstate: playbackState,
-      }),
-      credentials: "include",
-      headers,
-      method: "PATCH",
+    return new Promise((resolve) => {
+      const onEnsurePlaybackState = (
+        responseRequestId: number,
+        serverPlaybackState: PlaybackState
+      ) => {
+        if (responseRequestId === requestId) {
+          this.removeListener("ensure_playback_state", onEnsurePlaybackState);
+          resolve(serverPlaybackState);
+        }
+      };
+      this.on("ensure_playback_state", onEnsurePlaybackState);
+      this.webSocketBridge.send({
+        command: "player_state_change",
+        request_id: requestId,
+        state: playbackState,
+      });
     });
-
-    if (response.status === 200) {
-      const data = await response.json();
-      return createPlaybackStateFromServer(data.playbackstate);
-    } else if (response.status === 412) {
-      throw new Error("Conditional station playback state update failed");
-    } else {
-      throw new Error(await response.text());
-    }
   }
 
   public async getPlaybackState(): Promise<PlaybackState | undefined> {
+    if (this.joinPlaybackState) {
+      // The first sync uses the playback state sent when joining
+      const playbackState = this.joinPlaybackState;
+      this.joinPlaybackState = undefined;
+      return playbackState;
+    }
+
     const url = `/api/v1/stations/${this.stationId}/`;
     const response = await fetch(url, {
       credentials: "include",
@@ -660,17 +701,23 @@ export class StationServer {
   }
 
   public async getListeners(): Promise<IListener[]> {
-    const url = `/api/v1/stations/${this.stationId}/listeners/`;
-    const response = await fetch(url, {
-      credentials: "include",
-    });
+    let listeners: IListener[] = [];
+    let url: string | null = `/api/v1/stations/${this.stationId}/listeners/`;
+    while (url) {
+      const response: Response = await fetch(url, {
+        credentials: "include",
+      });
+
+      if (!response.ok) {
+        throw new Error(await response.text());
+      }
 
-    if (response.ok) {
       const data = await response.json();
-      return data.map(createListenerFromServer);
-    } else {
-      throw new Error(await response.text());
+      listeners = listeners.concat(data.results.map(createListenerFromServer));
+      url = data.next;
     }
+
+    return listeners;
   }
 
   public async inviteListener(
@@ -727,18 +774,46 @@ export class StationServer {
   }
 
   private onMessage(action: any) {
+    if (action.type === "time_sync_ping") {
+      // Reply before anything else to keep the client processing time short
+      const clientReceiveTime = getClockMicroseconds();
+      this.webSocketBridge.send({
+        client_receive_us: clientReceiveTime,
+        client_transmit_us: getClockMicroseconds(),
+        command: "time_sync_pong",
+        sample_id: action.sample_id,
+      });
+      return;
+    }
+
     console.log("Received: ", action);
     if (action.error) {
       this.observers
         .get("error")!
         .fire(serverErrorFromString(action.error), action.message);
     } else if (action.join) {
+      if (action.playbackstate) {
+        this.joinPlaybackState = createPlaybackStateFromServer(
+          action.playbackstate
+        );
+      }
       this.observers.get("join")!.fire(action.join);
     } else if (action.type === "playback_state_changed") {
       const serverPlaybackState = createPlaybackStateFromServer(
         action.playbackstate
       );
       this.observers.get(action.type)!.fire(serverPlaybackState);
+    } else if (action.type === "ensure_playback_state") {
+      const serverPlaybackState = createPlaybackStateFromServer(action.state);
+      this.observers
+        .get(action.type)!
+        .fire(action.request_id, serverPlaybackState);
+    } else if (action.type === "time_sync_result") {
+      const result: ITimeSyncResult = {
+        clientServerTimeOffset: action.offset_us / 1000,
+        roundTripTime: action.rtt_us / 1000,
+      };
+      this.observers.get(action.type)!.fire(result);
     } else if (action.type === "pong") {
       const pong: IPongResponse = {
         serverTime: new Date(action.server_time),
@@ -749,6 +824,11 @@ export class StationServer {
   }
 }
 
+function getClockMicroseconds(): number {
+  // High resolution time which does not step while the page is open
+  return Math.round((performance.timeOrigin + performance.now()) * 1000);
+}
+
 function serverErrorFromString(error: string): ServerError {
   if (error === "client_error") {
     return ServerError.ClientError;
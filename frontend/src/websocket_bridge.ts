@@ -10,8 +10,12 @@ export interface IWebSocketBridge {
   send(data: any): void;
 }
 
+// Close code sent by the server when it is too busy to join the station
+const RETRY_AFTER_CLOSE_CODE = 4429;
+
 export class ChannelWebSocketBridge implements IWebSocketBridge {
   private impl?: ReconnectingWebSocket;
+  private retryAfterMs?: number;
 
   public connect(path: string): void {
     this.impl = new ReconnectingWebSocket(path);
@@ -19,6 +23,12 @@ export class ChannelWebSocketBridge implements IWebSocketBridge {
       console.log(
         `Websocket closed: code=${event.code}, wasClean=${event.wasClean}`
       );
+      if (event.code === RETRY_AFTER_CLOSE_CODE && this.retryAfterMs) {
+        // Reconnect after the delay the server asked for instead
+        this.impl!.close();
+        window.setTimeout(() => this.impl!.reconnect(), this.retryAfterMs);
+        this.retryAfterMs = undefined;
+      }
     };
   }
 
@@ -29,7 +39,14 @@ export class ChannelWebSocketBridge implements IWebSocketBridge {
       );
     }
 
-    this.impl.onmessage = (event) => callback(JSON.parse(event.data));
+    this.impl.onmessage = (event) => {
+      const action = JSON.parse(event.data);
+      if (action.type === "retry_after") {
+        this.retryAfterMs = action.retry_after_ms;
+      } else {
+        callback(action);
+      }
+    };
   }
 
   public send(data: Record<string, unknown>): void {
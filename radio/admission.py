@@ -0,0 +1,125 @@
+"""Admission control for joining stations.
+
+After a server restart every client reconnects at once, and every join
+queries the database. Joins are limited to STATION_JOIN_MAX_CONCURRENCY at a
+time per server process, and joins that arrive while STATION_JOIN_MAX_QUEUED
+joins are already waiting, or that wait longer than
+STATION_JOIN_QUEUE_TIMEOUT, are rejected. Rejected clients are told to retry
+after a jittered delay, which spreads their reconnects out.
+
+The admission counters are logged while joins are being rejected, at most
+every STATION_JOIN_STATS_LOG_INTERVAL, and when the queue drains.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+import random
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close code telling clients to reconnect after the retry_after hint
+RETRY_AFTER_CLOSE_CODE = 4429
+
+
+class JoinRejected(Exception):
+    """Raised when a station join was not admitted."""
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class JoinAdmission:
+    def __init__(self):
+        # Metrics since the server process started
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+        self.waiting = 0
+        self.stats_logged_time = None
+        self.semaphore = None
+        self.semaphore_loop = None
+
+    @asynccontextmanager
+    async def admit(self):
+        """Hold one of the join slots, waiting for one if necessary.
+
+        Raises JoinRejected if the join was not admitted.
+        """
+        semaphore = self.get_semaphore()
+        if semaphore.locked():
+            await self.wait(semaphore)
+        else:
+            await semaphore.acquire()
+
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    async def wait(self, semaphore):
+        if self.waiting >= settings.STATION_JOIN_MAX_QUEUED:
+            self.reject()
+
+        self.queued += 1
+        self.waiting += 1
+        # Not wait_for, which can drop a slot acquired as the timeout expires
+        acquire = asyncio.ensure_future(semaphore.acquire())
+        try:
+            done, _ = await asyncio.wait(
+                [acquire],
+                timeout=settings.STATION_JOIN_QUEUE_TIMEOUT.total_seconds())
+            if not done:
+                acquire.cancel()
+                self.reject()
+        except asyncio.CancelledError:
+            if acquire.done() and not acquire.cancelled():
+                semaphore.release()
+            else:
+                acquire.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+            if not self.waiting:
+                logger.info('Station join queue drained: %s', self.get_stats())
+
+    def reject(self):
+        self.rejected += 1
+        self.log_stats_if_due()
+        retry_after = settings.STATION_JOIN_RETRY_AFTER * random.uniform(1, 2)
+        raise JoinRejected(retry_after)
+
+    def get_semaphore(self):
+        # Semaphores belong to the event loop they were first used on
+        loop = asyncio.get_event_loop()
+        if self.semaphore_loop is not loop:
+            self.semaphore = asyncio.Semaphore(
+                settings.STATION_JOIN_MAX_CONCURRENCY)
+            self.semaphore_loop = loop
+
+        return self.semaphore
+
+    def log_stats_if_due(self):
+        now = time.monotonic()
+        if (self.stats_logged_time is not None and now - self.stats_logged_time
+                < settings.STATION_JOIN_STATS_LOG_INTERVAL.total_seconds()):
+            return
+
+        self.stats_logged_time = now
+        logger.warning('Rejecting station joins: %s', self.get_stats())
+
+    def get_stats(self):
+        return {
+            'queued': self.queued,
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'waiting': self.waiting,
+        }
+
+
+join_admission = JoinAdmission()
@@ -1,9 +1,14 @@
+import copy
+from datetime import timedelta
 import logging
 
+from django.conf import settings
 from django.contrib import auth
+from django.db import transaction
 from rest_framework import serializers
 
 from ..models import Listener, PlaybackState, Station
+from .. import clock_sync, playback
 
 logger = logging.getLogger(__name__)
 
@@ -12,17 +17,79 @@ class PlaybackStateSerializer(serializers.ModelSerializer):
     class Meta:
         model = PlaybackState
         fields = ('station_id', 'context_uri', 'current_track_uri', 'paused',
-                  'raw_position_ms', 'sample_time', 'last_updated_time')
+                  'raw_position_ms', 'sample_time', 'last_updated_time',
+                  'version')
+        read_only_fields = ('version', )
+
+    def to_representation(self, instance):
+        """Add the playback position extrapolated by the server.
+
+        position_ms is the position at server_time_us, and scheduled_seek is
+        the position listeners should seek to in order to be in sync at its
+        apply_at_us, which leaves them time to seek. Times are in
+        microseconds of the clock that clients synchronize with.
+        """
+        data = super().to_representation(instance)
+        server_time_us = clock_sync.now_us()
+        apply_at_us = server_time_us + (settings.PLAYBACK_STATE_SEEK_LEAD_TIME
+                                        // timedelta(microseconds=1))
+        data['server_time_us'] = server_time_us
+        data['position_ms'] = instance.position_ms_at(
+            clock_sync.to_datetime(server_time_us))
+        data['scheduled_seek'] = {
+            'apply_at_us':
+            apply_at_us,
+            'position_ms':
+            instance.position_ms_at(clock_sync.to_datetime(apply_at_us)),
+        }
+        return data
+
+    def create(self, validated_data):
+        instance = PlaybackState(**validated_data)
+        playback.save_playback_state(
+            instance,
+            expected_versions=self.context.get('expected_versions'),
+            lease_token=self.get_dj_lease_token())
+        self.publish_playback_state_changed(instance)
+        return instance
 
     def update(self, instance, validated_data):
+        previous = copy.copy(instance)
         for field in PlaybackStateSerializer.Meta.fields:
-            if field != 'last_updated_time':
+            if field not in ('last_updated_time', 'version'):
                 new_value = validated_data.get(field, getattr(instance, field))
                 setattr(instance, field, new_value)
 
-        instance.save()
+        if playback.save_playback_state(instance, previous,
+                                        self.context.get('expected_versions'),
+                                        self.get_dj_lease_token()):
+            self.publish_playback_state_changed(instance)
         return instance
 
+    def get_dj_lease_token(self):
+        lease = self.context.get('dj_lease')
+        return lease['token'] if lease is not None else None
+
+    def publish_playback_state_changed(self, instance):
+        lease = self.context.get('dj_lease')
+        playback.publish_playback_state_changed_sync(
+            instance.station_id,
+            PlaybackStateSerializer(instance).data,
+            lease['holder_id'] if lease is not None else None)
+
+
+def update_or_create_playback_state(station_id,
+                                    playbackstate_data,
+                                    context=None):
+    """Apply validated playback state data to the station's playback state."""
+    serializer = PlaybackStateSerializer(context=context or {})
+    playback_state = playback.get_playback_state(station_id)
+    if playback_state is not None:
+        return serializer.update(playback_state, playbackstate_data)
+
+    playbackstate_data['station_id'] = station_id
+    return serializer.create(playbackstate_data)
+
 
 class StationSerializer(serializers.HyperlinkedModelSerializer):
     playbackstate = PlaybackStateSerializer()
@@ -31,17 +98,17 @@ class StationSerializer(serializers.HyperlinkedModelSerializer):
         model = Station
         fields = ('title', 'playbackstate')
 
+    def to_representation(self, instance):
+        # Read the playback state through the cache instead of the relation
+        if not Station.playbackstate.related.is_cached(instance):
+            playback.attach_playback_state(instance)
+
+        return super().to_representation(instance)
+
     def update(self, instance, validated_data):
         if 'playbackstate' in validated_data:
-            try:
-                playback_state = PlaybackStateSerializer().update(
-                    instance.playbackstate, validated_data['playbackstate'])
-            except PlaybackState.DoesNotExist:
-                validated_data['playbackstate']['station_id'] = instance.id
-                playback_state = PlaybackStateSerializer().create(
-                    validated_data['playbackstate'])
-
-            instance.playbackstate = playback_state
+            instance.playbackstate = update_or_create_playback_state(
+                instance.id, validated_data['playbackstate'], self.context)
 
         return instance
 
@@ -53,14 +120,154 @@ class ListenerSerializer(serializers.ModelSerializer):
     )
     station = serializers.PrimaryKeyRelatedField(
         queryset=Station.objects.all())
+    clock_sync = serializers.SerializerMethodField()
 
     class Meta:
         model = Listener
-        fields = ('id', 'user', 'station', 'is_admin', 'is_dj')
+        fields = ('id', 'user', 'station', 'is_admin', 'is_dj', 'clock_sync')
+
+    def get_clock_sync(self, obj):
+        """The latest clock synchronization of the listener's connection."""
+        clock_syncs = self.context.get('clock_syncs')
+        if clock_syncs is not None:
+            return clock_syncs.get(obj.user_id)
+
+        return clock_sync.get_clock_sync(obj.station_id, obj.user_id)
+
+
+# Not needed to implement update abstract methods.
+# pylint: disable=abstract-method
+class ListenerInviteSerializer(serializers.Serializer):
+    user = serializers.CharField()
+    is_admin = serializers.BooleanField(default=False)
+    is_dj = serializers.BooleanField(default=False)
+
+
+class BulkListenerInviteSerializer(serializers.Serializer):
+    """Invites users to the station in context as listeners.
+
+    Saving returns a result for every invite: whether the user was invited,
+    was already a listener or does not exist, and the user's listener.
+    """
+    listeners = ListenerInviteSerializer(many=True, allow_empty=False)
+
+    @staticmethod
+    def validate_listeners(value):
+        validate_bulk_usernames([invite['user'] for invite in value])
+        return value
+
+    def create(self, validated_data):
+        station_id = self.context['station_id']
+        invites = validated_data['listeners']
+
+        with transaction.atomic():
+            user_ids = get_user_ids([invite['user'] for invite in invites])
+            station_listeners = Listener.objects.filter(
+                station_id=station_id, user_id__in=user_ids.values())
+            existing_user_ids = set(
+                station_listeners.values_list('user_id', flat=True))
+
+            new_listeners = [
+                Listener(station_id=station_id,
+                         user_id=user_ids[invite['user']],
+                         is_admin=invite['is_admin'],
+                         is_dj=invite['is_dj']) for invite in invites
+                if invite['user'] in user_ids
+                and user_ids[invite['user']] not in existing_user_ids
+            ]
+            # Listeners invited concurrently are skipped instead of failing
+            # the whole batch on the unique constraint
+            Listener.objects.bulk_create(new_listeners, ignore_conflicts=True)
+
+            listeners = {
+                listener.user_id: listener
+                for listener in station_listeners.select_related('user')
+            }
+
+        context = {
+            'clock_syncs': clock_sync.get_clock_syncs(station_id,
+                                                      listeners.keys())
+        }
+        results = []
+        for invite in invites:
+            user_id = user_ids.get(invite['user'])
+            if user_id is None:
+                status = 'unknown_user'
+            elif user_id in existing_user_ids:
+                status = 'already_listener'
+            else:
+                status = 'invited'
+
+            listener = listeners.get(user_id)
+            if listener is not None:
+                listener = ListenerSerializer(listener, context=context).data
+
+            results.append({
+                'user': invite['user'],
+                'status': status,
+                'listener': listener,
+            })
+
+        return results
+
+
+class BulkListenerRemoveSerializer(serializers.Serializer):
+    """Removes listeners from the station in context by username.
+
+    Saving returns a result for every username: whether its listener was
+    removed or the user was not a listener.
+    """
+    users = serializers.ListField(child=serializers.CharField(),
+                                  allow_empty=False)
+
+    @staticmethod
+    def validate_users(value):
+        validate_bulk_usernames(value)
+        return value
+
+    def create(self, validated_data):
+        usernames = validated_data['users']
+
+        with transaction.atomic():
+            listener_ids = dict(
+                Listener.objects.filter(
+                    station_id=self.context['station_id'],
+                    user__username__in=usernames).values_list(
+                        'user__username', 'id'))
+            Listener.objects.filter(id__in=listener_ids.values()).delete()
+
+        results = []
+        for username in usernames:
+            status = 'removed' if username in listener_ids else 'not_listener'
+            results.append({'user': username, 'status': status})
+
+        return results
+
+
+def validate_bulk_usernames(usernames):
+    if len(usernames) > settings.LISTENER_BULK_MAX_SIZE:
+        raise serializers.ValidationError(
+            f'At most {settings.LISTENER_BULK_MAX_SIZE} users are allowed.')
+
+    if len(set(usernames)) != len(usernames):
+        raise serializers.ValidationError('Usernames must be unique.')
+
+
+def get_user_ids(usernames):
+    """Return the ids of the users with the usernames by username."""
+    return dict(auth.get_user_model().objects.filter(
+        username__in=usernames).values_list('username', 'id'))
 
 
 # Not needed to implement create and update abstract methods.
 # pylint: disable=abstract-method
+class PresenceSerializer(serializers.Serializer):
+    user_id = serializers.IntegerField()
+    username = serializers.CharField()
+    connections = serializers.IntegerField()
+    last_seen = serializers.DateTimeField()
+
+
 class AccessTokenSerializer(serializers.Serializer):
     token = serializers.CharField(max_length=256)
     token_expiration_time = serializers.DateTimeField()
@@ -18,6 +18,8 @@ listeners_router.register(r'listeners',
 urlpatterns = [
     re_path(r'^', include(router.urls)),
     re_path(r'^', include(listeners_router.urls)),
+    re_path(r'^stations/(?P<station_pk>\d+)/presence/$',
+            views.StationPresenceView.as_view()),
     re_path(r'^users/(?P<user_pk>[^/.]+)/accesstoken/refresh/$',
             views.RefreshAccessToken.as_view()),
     re_path(r'^api-auth/', include('rest_framework.urls')),
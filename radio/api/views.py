@@ -1,24 +1,51 @@
+from http import HTTPStatus
 import logging
-from typing import Optional
+from typing import FrozenSet, Optional
 
+from django.conf import settings
+from django.contrib import auth
+from django.http import Http404
 from django.shortcuts import get_object_or_404
-from rest_framework import permissions, viewsets
-from rest_framework.exceptions import PermissionDenied
+from django.utils.http import parse_etags
+from rest_framework import generics, permissions, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, PermissionDenied
+from rest_framework.fields import BooleanField
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
 from rest_framework.views import APIView
 from rest_framework.request import Request
 from rest_framework.response import Response
 
+from .. import clock_sync, dj_lease, playback, presence
+from ..exceptions import DjLeaseHeld, PlaybackStateConflict, StaleDjLease
 from ..models import Listener, SpotifyCredentials, Station
 from ..spotify import AccessToken
-from .serializers import (AccessTokenSerializer, ListenerSerializer,
-                          StationSerializer)
+from .serializers import (AccessTokenSerializer, BulkListenerInviteSerializer,
+                          BulkListenerRemoveSerializer, ListenerSerializer,
+                          PresenceSerializer, StationSerializer)
 
 logger = logging.getLogger(__name__)
 
 
+class PreconditionFailed(APIException):
+    status_code = HTTPStatus.PRECONDITION_FAILED.value
+    default_detail = 'The station playback state has changed.'
+    default_code = 'precondition_failed'
+
+
+class Conflict(APIException):
+    status_code = HTTPStatus.CONFLICT.value
+    default_detail = 'The station playback state was changed concurrently.'
+    default_code = 'conflict'
+
+
 class StationViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows stations to be viewed or edited.
+
+    Responses include the playback state version as an ETag. Updates with an
+    If-Match header only succeed if the playback state has not changed, and
+    retrieves with an If-None-Match header return 304 if it has not changed.
     """
     queryset = Station.objects.all()
     serializer_class = StationSerializer
@@ -29,39 +56,189 @@ class StationViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         return self.request.user.stations.all()
 
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['expected_versions'] = get_if_match_versions(self.request)
+        return context
+
+    def retrieve(self, request: Request, *args, **kwargs):
+        instance = self.get_object()
+        etag = playback.get_etag(playback.attach_playback_state(instance))
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=HTTPStatus.NOT_MODIFIED.value,
+                            headers={'ETag': etag})
+
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data, headers={'ETag': etag})
+
+    def perform_update(self, serializer):
+        if 'playbackstate' in serializer.validated_data:
+            # Only DJs may take the lease, as on the WebSocket
+            if not Listener.objects.filter(station_id=serializer.instance.id,
+                                           user=self.request.user,
+                                           is_dj=True).exists():
+                raise PermissionDenied(
+                    'Only DJs can change the station playback state.')
+
+            try:
+                serializer.context['dj_lease'] = dj_lease.acquire_dj_lease(
+                    serializer.instance.id, self.request.user.id)
+            except DjLeaseHeld:
+                raise Conflict('Another DJ is controlling the station '
+                               'playback state.')
+
+        try:
+            super().perform_update(serializer)
+        except PlaybackStateConflict as exc:
+            if isinstance(exc, StaleDjLease):
+                dj_lease.release_dj_lease(serializer.instance.id,
+                                          serializer.context['dj_lease'])
+            if get_if_match_versions(self.request) is not None:
+                raise PreconditionFailed()
+            raise Conflict()
+
+        self.headers['ETag'] = playback.get_etag(
+            getattr(serializer.instance, 'playbackstate', None))
+
+
+class ListenerPagination(CursorPagination):
+    page_size = settings.LISTENER_PAGE_SIZE
+    ordering = 'id'
+
 
 class ListenerViewSet(viewsets.ModelViewSet):
+    """
+    API endpoint that allows station admins to view and edit the station's
+    listeners.
+
+    Listeners can be filtered by role with the is_admin and is_dj query
+    parameters, and by the start of their username with the username query
+    parameter.
+    """
     serializer_class = ListenerSerializer
+    pagination_class = ListenerPagination
 
     def get_object(self):
         return get_object_or_404(self.get_queryset(), id=self.kwargs['pk'])
 
     def get_queryset(self):
         station_id = self.kwargs['station_pk']
-        get_object_or_404(self.request.user.stations.all(), id=station_id)
+        check_station_admin(self.request, station_id)
+
+        queryset = Listener.objects.filter(
+            station=station_id).select_related('user')
+
+        params = self.request.query_params
+        for role in ('is_admin', 'is_dj'):
+            if role in params:
+                queryset = queryset.filter(
+                    **{role: BooleanField().to_internal_value(params[role])})
+
+        if 'username' in params:
+            queryset = queryset.filter(
+                user__username__startswith=params['username'])
+
+        return queryset
 
-        listener = Listener.objects.get(station=station_id,
-                                        user=self.request.user)
-        if not listener.is_admin:
-            raise PermissionDenied()
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['clock_syncs'] = getattr(self, 'clock_syncs', None)
+        return context
 
-        return Listener.objects.filter(station=station_id)
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        # Read the page's clock syncs from the cache at once
+        self.clock_syncs = clock_sync.get_clock_syncs(
+            self.kwargs['station_pk'], [listener.user_id for listener in page])
+        return page
 
     # pylint: disable=arguments-differ
     def create(self, request: Request, station_pk=None):
-        get_object_or_404(self.request.user.stations.all(), id=station_pk)
+        check_station_admin(request, station_pk)
+        return super().create(request)
 
-        listener = Listener.objects.get(station=station_pk,
-                                        user=self.request.user)
-        if not listener.is_admin:
-            raise PermissionDenied()
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_invite(self, request: Request, station_pk=None):
+        """Invite many users as listeners in one transaction."""
+        return self.bulk_save(request, station_pk,
+                              BulkListenerInviteSerializer)
 
-        return super().create(request)
+    @bulk_invite.mapping.delete
+    def bulk_remove(self, request: Request, station_pk=None):
+        """Remove many listeners in one transaction."""
+        return self.bulk_save(request, station_pk,
+                              BulkListenerRemoveSerializer)
+
+    @staticmethod
+    def bulk_save(request: Request, station_pk, serializer_class):
+        check_station_admin(request, station_pk)
+        serializer = serializer_class(data=request.data,
+                                      context={'station_id': station_pk})
+        serializer.is_valid(raise_exception=True)
+        return Response({'results': serializer.save()})
+
+
+class PresencePagination(LimitOffsetPagination):
+    default_limit = settings.PRESENCE_ROSTER_PAGE_SIZE
+
+
+class StationPresenceView(generics.ListAPIView):
+    """
+    API endpoint that lists the users connected to a station, most recently
+    seen first.
+    """
+    serializer_class = PresenceSerializer
+    pagination_class = PresencePagination
+
+    def get_queryset(self):
+        station_id = int(self.kwargs['station_pk'])
+        check_station_admin(self.request, station_id)
+
+        station_presence = presence.get_presence()
+        station_presence.reap(station_id)
+        return presence.StationRoster(station_presence, station_id)
+
+    def list(self, request: Request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        usernames = dict(auth.get_user_model().objects.filter(
+            id__in=[user['user_id']
+                    for user in page]).values_list('id', 'username'))
+        for user in page:
+            user['username'] = usernames.get(user['user_id'], '')
+
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+
+def check_station_admin(request: Request, station_id):
+    """Check that the requester is an admin of the station in one query.
+
+    Raises Http404 if the requester is not a listener of the station, and
+    PermissionDenied if they are not one of its admins.
+    """
+    is_admin = Listener.objects.filter(station_id=station_id,
+                                       user=request.user).values_list(
+                                           'is_admin', flat=True).first()
+    if is_admin is None:
+        raise Http404()
+    if not is_admin:
+        raise PermissionDenied()
+
+
+def get_if_match_versions(request: Request) -> Optional[FrozenSet[int]]:
+    """Return the playback state versions the request is conditional on."""
+    etags = parse_etags(request.headers.get('If-Match', ''))
+    if not etags or etags == ['*']:
+        return None
+
+    # Etags without a version never match a playback state version
+    versions = map(playback.get_etag_version, etags)
+    return frozenset(version for version in versions if version is not None)
 
 
 class BelongsToUser(permissions.BasePermission):
     def has_object_permission(self, request: Request, view, obj):
-        return obj.user == request.user
+        return obj.user_id == request.user.id
 
 
 class RefreshAccessToken(APIView):
@@ -83,9 +260,9 @@ class RefreshAccessToken(APIView):
         request: Request,
         format=None,  # pylint: disable=redefined-builtin,unused-argument
         user_pk: Optional[int] = None):  # pylint: disable=unused-argument
-        access_token = self.get_object()
-        access_token.refresh()
-        access_token.save()
+        # Check that the access token is the user's before refreshing it
+        self.get_object()
+        access_token = AccessToken.load_fresh(self.kwargs['user_pk'])
 
         serializer = AccessTokenSerializer(access_token)
         return Response(serializer.data)
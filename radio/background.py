@@ -0,0 +1,29 @@
+"""Background tasks on the event loop.
+
+Nothing awaits a background task, so an exception raised by one would only
+surface as an "exception was never retrieved" warning when the task is
+garbage collected. Failures are logged as soon as the task finishes instead.
+"""
+
+import asyncio
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def run_in_background(coro, description):
+    """Schedule the coroutine as a task and return the task. description
+    names the task in the log if it fails."""
+    task = asyncio.ensure_future(coro)
+    task.add_done_callback(functools.partial(log_task_failure, description))
+    return task
+
+
+def log_task_failure(description, task):
+    if task.cancelled():
+        return
+
+    exc = task.exception()
+    if exc is not None:
+        logger.error('%s failed', description, exc_info=exc)
@@ -0,0 +1,81 @@
+"""NTP-style clock synchronization between the server and station clients.
+
+The server sends a burst of time_sync_ping messages stamped with its transmit
+time, clients reply with their receive and transmit times, and the server
+stamps the arrival of each reply. Every sample gives the round trip time
+without the client's processing time, and the offset of the server's clock
+from the client's. The sample with the lowest round trip time was the least
+delayed by queueing, so its offset is used, as in NTP's clock filter.
+
+Timestamps are integer microseconds since the Unix epoch. The server's are
+read from a monotonic high resolution clock anchored to the wall clock when
+the process started, so they never step while a burst is in progress.
+
+The latest estimate of every listener's connection is cached so that station
+admins can diagnose drifting listeners.
+"""
+
+from datetime import datetime, timedelta
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+_EPOCH = datetime.fromtimestamp(0, tz=timezone.utc)
+_EPOCH_US = time.time_ns() // 1000
+_MONOTONIC_NS = time.perf_counter_ns()
+
+
+def now_us():
+    """Return the server's monotonic clock time in epoch microseconds."""
+    return _EPOCH_US + (time.perf_counter_ns() - _MONOTONIC_NS) // 1000
+
+
+def to_datetime(time_us):
+    return _EPOCH + timedelta(microseconds=time_us)
+
+
+def get_sample(server_transmit_us, client_receive_us, client_transmit_us,
+               server_receive_us):
+    """Return the round trip time and server clock offset of a sample."""
+    rtt_us = ((server_receive_us - server_transmit_us) -
+              (client_transmit_us - client_receive_us))
+    offset_us = ((server_transmit_us - client_receive_us) +
+                 (server_receive_us - client_transmit_us)) // 2
+    return rtt_us, offset_us
+
+
+def get_best_sample(samples):
+    return min(samples, key=lambda sample: sample[0])
+
+
+def save_clock_sync(station_id, user_id, rtt_us, offset_us, sample_count):
+    cache.set(
+        get_clock_sync_cache_key(station_id, user_id), {
+            'rtt_us': rtt_us,
+            'offset_us': offset_us,
+            'sample_count': sample_count,
+            'measured_time': timezone.now(),
+        }, settings.CLOCK_SYNC_CACHE_TIMEOUT)
+
+
+def get_clock_sync(station_id, user_id):
+    """Return the latest clock sync of the user in the station or None."""
+    return cache.get(get_clock_sync_cache_key(station_id, user_id))
+
+
+def get_clock_syncs(station_id, user_ids):
+    """Return the latest clock syncs of the users in the station by user id."""
+    cache_keys = {
+        get_clock_sync_cache_key(station_id, user_id): user_id
+        for user_id in user_ids
+    }
+    return {
+        cache_keys[key]: value
+        for key, value in cache.get_many(cache_keys).items()
+    }
+
+
+def get_clock_sync_cache_key(station_id, user_id):
+    return f'clock-sync-{station_id}-{user_id}'
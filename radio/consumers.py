@@ -1,17 +1,20 @@
-from datetime import datetime, timezone
+import asyncio
+from datetime import datetime, timedelta, timezone
 import enum
 import logging
 
-from asgiref.sync import async_to_sync
-import channels.auth
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from django.db.models import signals
+from django.conf import settings
 
-from . import models
-from .api.serializers import PlaybackStateSerializer
-from .exceptions import ClientError
+from .api.serializers import (PlaybackStateSerializer,
+                              update_or_create_playback_state)
+from .exceptions import (ClientError, DjLeaseHeld, PlaybackStateConflict,
+                         StaleDjLease)
 from .models import Listener, Station
+from . import admission, clock_sync, dj_lease, playback, presence
+from .background import run_in_background
+from .listener_changes import listener_change_batcher
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +48,17 @@ def station_admin_required(func):
     return wrap
 
 
+def station_dj_required(func):
+    def wrap(self, *args, **kwargs):
+        if not self.is_dj:
+            raise ClientError(
+                'forbidden',
+                'user does not have permission to change playback state')
+        return func(self, *args, **kwargs)
+
+    return wrap
+
+
 class StationConsumer(AsyncJsonWebsocketConsumer):
     # pylint: disable=attribute-defined-outside-init
 
@@ -56,22 +70,32 @@ class StationConsumer(AsyncJsonWebsocketConsumer):
 
     async def connect(self):
         """Called during initial websocket handshaking."""
-        try:
-            self.user = await channels.auth.get_user(self.scope)
-        except:  # pylint: disable=bare-except
-            # TODO: Replace bare except with specific exception
-            self.user = self.scope['user']
-
-        if self.user.is_anonymous:
-            await self.close()
-        else:
-            await self.accept()
-
         self.state = StationState.NotConnected
         self.is_admin = None
         self.is_dj = None
+        self.roster_snapshot_task = None
+        self.presence_refresh_time_us = None
 
-        await self.join_station()
+        # Clock synchronization of this connection
+        self.receive_time_us = None
+        self.time_sync_pings = {}
+        self.time_sync_samples = []
+        self.clock_rtt_us = None
+        self.clock_offset_us = None
+
+        try:
+            async with admission.join_admission.admit():
+                await self.authenticate_and_join_station()
+        except admission.JoinRejected as exc:
+            await self.send_retry_after(exc.retry_after)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        # Timestamp frames before decoding them for clock synchronization
+        self.receive_time_us = clock_sync.now_us()
+        if self.state == StationState.Connected:
+            await self.refresh_presence()
+
+        await super().receive(text_data, bytes_data, **kwargs)
 
     async def receive_json(self, content, **kwargs):
         """Called when we get a text frame."""
@@ -79,6 +103,19 @@ class StationConsumer(AsyncJsonWebsocketConsumer):
         try:
             if command == 'ping':
                 await self.send_pong(content['start_time'])
+            elif command == 'time_sync':
+                await self.start_time_sync(
+                    get_int_field(content, 'samples', required=False))
+            elif command == 'time_sync_pong':
+                await self.receive_time_sync_pong(
+                    get_int_field(content, 'sample_id'),
+                    get_int_field(content, 'client_receive_us'),
+                    get_int_field(content, 'client_transmit_us'))
+            elif command == 'player_state_change':
+                await self.player_state_change(
+                    get_int_field(content, 'request_id'),
+                    get_dict_field(content, 'state'),
+                    get_str_field(content, 'etag', required=False))
 
         except ClientError as exc:
             await self.send_json({'error': exc.code, 'message': exc.message})
@@ -90,15 +127,39 @@ class StationConsumer(AsyncJsonWebsocketConsumer):
                 await self.leave_station()
         except ClientError as exc:
             logger.error('Station client error: %d: %s', exc.code, exc.message)
+        finally:
+            # Leaving cancels it, unless leaving failed first
+            self.cancel_roster_snapshots()
 
     # Command helper methods called by receive_json
 
+    async def authenticate_and_join_station(self):
+        # Resolved by CachedAuthMiddlewareStack
+        self.user = self.scope['user']
+        if self.user.is_anonymous:
+            await self.close()
+            return
+
+        await self.accept()
+        await self.join_station()
+
+    async def send_retry_after(self, retry_after):
+        """Tell the client to reconnect after retry_after and disconnect."""
+        await self.accept()
+        await self.send_json({
+            'type':
+            'retry_after',
+            'retry_after_ms':
+            int(retry_after.total_seconds() * 1000),
+        })
+        await self.close(code=admission.RETRY_AFTER_CLOSE_CODE)
+
     async def join_station(self):
         listener = await get_listener_or_error(self.station_id, self.user)
         self.is_admin = listener.is_admin
         self.is_dj = listener.is_dj
 
-        station = await get_station_or_error(self.station_id, self.user)
+        station = listener.station
         await self.channel_layer.group_add(station.group_name,
                                            self.channel_name)
 
@@ -106,32 +167,50 @@ class StationConsumer(AsyncJsonWebsocketConsumer):
             await self.channel_layer.group_add(station.admin_group_name,
                                                self.channel_name)
 
-        # Message admins that a user has joined the station
-        await self.admin_group_send_join(station.admin_group_name,
-                                         self.user.username, self.user.email)
+        await join_presence(self.station_id, self.user.id)
+        self.presence_refresh_time_us = clock_sync.now_us()
 
-        # Subscribe for PlaybackState change notifications
-        signals.post_save.connect(self.notify_playback_state_changed)
+        # Message admins that a user has joined the station
+        listener_change_batcher.add_join(self.station_id, self.user)
+        if self.is_admin:
+            self.roster_snapshot_task = run_in_background(
+                self.send_roster_snapshots(),
+                f'Sending roster snapshots of station {self.station_id}')
 
-        # Reply to client to finish setting up station
+        # Reply to client to finish setting up station, including the current
+        # playback state so the client does not have to request it
         self.state = StationState.Connected
-        await self.send_json({'join': station.title})
+        await self.send_json({
+            'join':
+            station.title,
+            'playbackstate':
+            get_playback_state_data(getattr(station, 'playbackstate', None)),
+        })
 
     @station_join_required
     async def leave_station(self):
-        station = await get_station_or_error(self.station_id, self.user)
-        await self.admin_group_send_leave(station.admin_group_name,
-                                          self.user.username, self.user.email)
+        admin_group_name = Station.get_admin_group_name(self.station_id)
+        listener_change_batcher.add_leave(self.station_id, self.user)
+        await leave_presence(self.station_id, self.user.id)
+        self.cancel_roster_snapshots()
+        self.presence_refresh_time_us = None
 
-        await self.channel_layer.group_discard(station.group_name,
-                                               self.channel_name)
+        await self.channel_layer.group_discard(
+            Station.get_group_name(self.station_id), self.channel_name)
 
         if self.is_admin:
-            await self.channel_layer.group_discard(station.admin_group_name,
+            await self.channel_layer.group_discard(admin_group_name,
                                                    self.channel_name)
 
         if self.is_dj:
-            await ensure_station_playback_state_is_paused(station)
+            # Give DJs who refresh the page or switch networks time to return
+            if settings.DJ_RECONNECT_GRACE_PERIOD:
+                run_in_background(
+                    pause_station_unless_dj_returns(self.station_id,
+                                                    self.user.id),
+                    f'Pausing station {self.station_id} after its DJ left')
+            else:
+                await pause_station_playback_state(self.station_id)
 
         self.state = StationState.NotConnected
         self.is_admin = None
@@ -147,116 +226,290 @@ class StationConsumer(AsyncJsonWebsocketConsumer):
             datetime.now(timezone.utc).isoformat(),
         })
 
-    # Playback State Change Notification Management
-
-    def notify_playback_state_changed(self, sender, **kwargs):
-        if sender is not models.PlaybackState:
-            return
-
-        playback_state = kwargs['instance']
-        if playback_state.station_id != self.station_id:
-            # This notification is not for this station
-            return
+    @station_join_required
+    async def start_time_sync(self, sample_count=None):
+        if sample_count is None or sample_count < 1:
+            sample_count = settings.CLOCK_SYNC_SAMPLES
+        sample_count = min(sample_count, settings.CLOCK_SYNC_MAX_SAMPLES)
+        self.time_sync_pings = {}
+        self.time_sync_samples = []
+        await self.send_time_sync_ping(sample_count)
+
+    async def send_time_sync_ping(self, remaining_sample_count):
+        # Pings are sent one at a time so they do not queue behind each other
+        sample_id = len(self.time_sync_samples)
+        server_transmit_us = clock_sync.now_us()
+        self.time_sync_pings = {
+            sample_id: (server_transmit_us, remaining_sample_count)
+        }
+        await self.send_json({
+            'type': 'time_sync_ping',
+            'sample_id': sample_id,
+            'server_transmit_us': server_transmit_us,
+        })
 
-        if self.is_dj:
-            # The DJ caused this change and should not be notified
+    async def receive_time_sync_pong(self, sample_id, client_receive_us,
+                                     client_transmit_us):
+        if sample_id not in self.time_sync_pings:
+            # Reply to a ping of a previous burst
             return
 
-        async_to_sync(self.send_playback_state_changed)(playback_state)
+        server_transmit_us, remaining_sample_count = self.time_sync_pings.pop(
+            sample_id)
+        self.time_sync_samples.append(
+            clock_sync.get_sample(server_transmit_us, client_receive_us,
+                                  client_transmit_us, self.receive_time_us))
 
-    # Sending group messages
+        if remaining_sample_count > 1:
+            await self.send_time_sync_ping(remaining_sample_count - 1)
+        else:
+            await self.finish_time_sync()
+
+    async def finish_time_sync(self):
+        self.clock_rtt_us, self.clock_offset_us = clock_sync.get_best_sample(
+            self.time_sync_samples)
+        await save_clock_sync(self.station_id, self.user.id,
+                              self.clock_rtt_us, self.clock_offset_us,
+                              len(self.time_sync_samples))
+        await self.send_json({
+            'type': 'time_sync_result',
+            'rtt_us': self.clock_rtt_us,
+            'offset_us': self.clock_offset_us,
+        })
 
-    async def admin_group_send_join(self, group_name, username, email):
-        await self.channel_layer.group_send(
-            group_name, {
-                'type': 'station.join',
-                'sender_user_id': self.user.id,
-                'username': username,
-                'email': email,
-            })
+    @station_join_required
+    @station_dj_required
+    async def player_state_change(self, request_id, state, etag=None):
+        playbackstate_data = await change_station_playback_state(
+            self.station_id, self.user.id, state, etag)
+        await self.send_json({
+            'type': 'ensure_playback_state',
+            'request_id': request_id,
+            'state': playbackstate_data,
+        })
 
-    async def admin_group_send_leave(self, group_name, username, email):
-        await self.channel_layer.group_send(
-            group_name, {
-                'type': 'station.leave',
-                'sender_user_id': self.user.id,
-                'username': username,
-                'email': email,
+    async def refresh_presence(self):
+        refresh_interval_us = (settings.PRESENCE_REFRESH_INTERVAL //
+                               timedelta(microseconds=1))
+        if (self.receive_time_us - self.presence_refresh_time_us >=
+                refresh_interval_us):
+            self.presence_refresh_time_us = self.receive_time_us
+            await touch_presence(self.station_id, self.user.id)
+
+    def cancel_roster_snapshots(self):
+        if self.roster_snapshot_task is not None:
+            self.roster_snapshot_task.cancel()
+            self.roster_snapshot_task = None
+
+    async def send_roster_snapshots(self):
+        """Periodically send admins every listener of the station."""
+        while True:
+            await asyncio.sleep(
+                settings.LISTENER_ROSTER_SNAPSHOT_INTERVAL.total_seconds())
+            listeners = await get_station_roster(self.station_id)
+            await self.send_json({
+                'type': 'listener_roster',
+                'listeners': listeners,
             })
 
     # Handlers for messages sent over the channel layer
 
-    async def station_join(self, event):
-        """Called when someone has joined our station."""
-        sender_user_id = event['sender_user_id']
-        if sender_user_id != self.user.id:
+    async def station_listener_change_batch(self, event):
+        """Called when listeners have joined or left our station."""
+        joined = []
+        left = []
+        for change in event['changes']:
+            if change['user_id'] == self.user.id:
+                continue
+
+            listener = {
+                'username': change['username'],
+                'email': change['email'],
+            }
+            if change['connection_delta'] > 0:
+                joined.append(listener)
+            else:
+                left.append(listener)
+
+        if joined or left:
             await self.send_json({
-                'type': 'listener_change',
-                'listener_change_type': 'join',
-                'listener': {
-                    'username': event['username'],
-                    'email': event['email'],
-                }
+                'type': 'listener_change_batch',
+                'joined': joined,
+                'left': left,
             })
 
-    async def station_leave(self, event):
-        """Called when someone has left our station."""
-        sender_user_id = event['sender_user_id']
-        if sender_user_id != self.user.id:
-            await self.send_json({
-                'type': 'listener_change',
-                'listener_change_type': 'leave',
-                'listener': {
-                    'username': event['username'],
-                    'email': event['email'],
-                }
-            })
+    async def station_playback_state_changed(self, event):
+        """Called when the station's playback state has changed."""
+        if event.get('sender_user_id') == self.user.id:
+            # The DJ caused this change and should not be notified
+            return
 
-    async def send_playback_state_changed(self, playback_state):
-        serializer = PlaybackStateSerializer(playback_state)
-        await self.send_json({
-            'type': 'playback_state_changed',
-            'playbackstate': serializer.data,
-        })
+        # The frame was encoded once by the publisher for every listener
+        await self.send(text_data=event['text'])
 
 
-async def ensure_station_playback_state_is_paused(station):
-    playback_state = getattr(station, 'playbackstate', None)
-    if (playback_state is not None) and (not playback_state.paused):
-        playback_state.paused = True
-        await save_station_playback_state(playback_state)
+def get_playback_state_data(playback_state):
+    """Serialize the playback state sent to clients along with its etag."""
+    if playback_state is None:
+        return None
 
+    playbackstate_data = PlaybackStateSerializer(playback_state).data
+    playbackstate_data['etag'] = playback.get_etag(playback_state)
+    return playbackstate_data
 
-# Database
 
+def get_int_field(content, field, required=True):
+    """Return the message's integer field, or None if it is not required and
+    missing."""
+    value = content.get(field)
+    if value is None and not required:
+        return None
+
+    # bool is an int subclass but not a valid number here
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ClientError('bad_request', f'{field} must be an integer')
+
+    return value
 
-@database_sync_to_async
-def get_station_or_error(station_id, user):
-    """Fetch station for user and check permissions."""
-    assert not user.is_anonymous, 'Anonymous users cannot connect to station'
-    assert station_id is not None
 
+def get_dict_field(content, field):
+    """Return the message's object field."""
+    value = content.get(field)
+    if not isinstance(value, dict):
+        raise ClientError('bad_request', f'{field} must be an object')
+
+    return value
+
+
+def get_str_field(content, field, required=True):
+    """Return the message's string field, or None if it is not required and
+    missing."""
+    value = content.get(field)
+    if value is None and not required:
+        return None
+
+    if not isinstance(value, str):
+        raise ClientError('bad_request', f'{field} must be a string')
+
+    return value
+
+
+async def pause_station_unless_dj_returns(station_id, user_id):
+    await asyncio.sleep(settings.DJ_RECONNECT_GRACE_PERIOD.total_seconds())
     try:
-        station = Station.objects.get(pk=station_id)
-    except Station.DoesNotExist:
-        raise ClientError('invalid_station', 'invalid station')
+        if not await is_present(station_id, user_id):
+            await pause_station_playback_state(station_id)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Failed to pause station %d after its DJ left',
+                         station_id)
+
 
-    return station
+# Database
 
 
 @database_sync_to_async
 def get_listener_or_error(station_id, user):
+    """Fetch the user's listener with its station and playback state."""
     assert not user.is_anonymous, 'Anonymous users cannot connect to station'
     assert station_id is not None
 
     try:
-        listener = Listener.objects.get(user_id=user.id, station_id=station_id)
+        listener = Listener.objects.select_related(
+            'station', 'station__playbackstate').get(user_id=user.id,
+                                                     station_id=station_id)
     except Listener.DoesNotExist:
         raise ClientError('forbidden', 'This station is not available')
 
+    if settings.PLAYBACK_STATE_BATCH_FLUSH_POSITIONS:
+        # The database may lag behind positions batched in the cache
+        playback.attach_playback_state(listener.station)
+
     return listener
 
 
 @database_sync_to_async
-def save_station_playback_state(station_state):
-    station_state.save()
+def save_clock_sync(station_id, user_id, rtt_us, offset_us, sample_count):
+    clock_sync.save_clock_sync(station_id, user_id, rtt_us, offset_us,
+                               sample_count)
+
+
+@database_sync_to_async
+def join_presence(station_id, user_id):
+    presence.get_presence().join(station_id, user_id)
+
+
+@database_sync_to_async
+def leave_presence(station_id, user_id):
+    presence.get_presence().leave(station_id, user_id)
+
+
+@database_sync_to_async
+def touch_presence(station_id, user_id):
+    presence.get_presence().touch(station_id, user_id)
+
+
+@database_sync_to_async
+def is_present(station_id, user_id):
+    return presence.get_presence().is_present(station_id, user_id)
+
+
+@database_sync_to_async
+def pause_station_playback_state(station_id):
+    playback_state = playback.pause_playback_state(station_id)
+    if playback_state is not None:
+        playback.publish_playback_state_changed_sync(
+            station_id,
+            PlaybackStateSerializer(playback_state).data)
+
+
+@database_sync_to_async
+def get_station_roster(station_id):
+    return [{
+        'username': listener['user__username'],
+        'email': listener['user__email'],
+        'is_admin': listener['is_admin'],
+        'is_dj': listener['is_dj'],
+    } for listener in Listener.objects.filter(station_id=station_id).values(
+        'user__username', 'user__email', 'is_admin', 'is_dj')]
+
+
+@database_sync_to_async
+def change_station_playback_state(station_id, user_id, state, etag=None):
+    """Apply a DJ's playback state change and return the current state.
+
+    If etag is given the change is only applied if the playback state is
+    still at that version. A change that lost a race with another update, or
+    that was made while another DJ holds the station's DJ lease, is dropped,
+    and the current state is returned for the DJ to converge to. A DJ whose
+    lease is older than the one the current state was changed under gives it
+    up.
+    """
+    serializer = PlaybackStateSerializer(data=state)
+    if not serializer.is_valid():
+        raise ClientError('bad_request', 'invalid playback state')
+
+    try:
+        lease = dj_lease.acquire_dj_lease(station_id, user_id)
+    except DjLeaseHeld:
+        return get_playback_state_data(playback.get_playback_state(station_id))
+
+    expected_versions = None
+    if etag is not None:
+        version = playback.get_etag_version(etag)
+        expected_versions = frozenset([version] if version is not None else [])
+
+    try:
+        playback_state = update_or_create_playback_state(
+            station_id, serializer.validated_data, {
+                'expected_versions': expected_versions,
+                'dj_lease': lease,
+            })
+    except PlaybackStateConflict as exc:
+        if isinstance(exc, StaleDjLease):
+            dj_lease.release_dj_lease(station_id, lease)
+        playback_state = playback.get_playback_state(station_id)
+        if playback_state is None:
+            raise ClientError('conflict',
+                              'playback state was changed concurrently')
+
+    return get_playback_state_data(playback_state)
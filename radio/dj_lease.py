@@ -0,0 +1,117 @@
+"""Arbitration between the DJs of a station.
+
+Only one DJ at a time may change a station's playback state, the holder of
+the station's DJ lease. A DJ acquires the lease with their first change once
+it is free or has expired, and renews it with every change, including
+heartbeats, so the lease stays with the active DJ. Other DJs are read-only
+until the holder has not changed the playback state for DJ_LEASE_DURATION.
+
+Every acquisition is given a fencing token greater than any before it.
+Changes are saved with the token of their lease and changes with a smaller
+token than the playback state's are rejected, so a DJ whose lease expired
+while their change was in flight cannot overwrite the new holder's changes.
+A DJ whose change is rejected that way gives up their lease.
+
+Leases are read and written while holding a short lock on the station's
+lease, so a renewal cannot overwrite a lease another DJ acquired after the
+renewing DJ's lease expired.
+"""
+
+from contextlib import contextmanager
+from datetime import timedelta
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .exceptions import DjLeaseHeld
+
+# Expiry of a lease lock whose holder died before releasing it
+DJ_LEASE_LOCK_TIMEOUT = timedelta(seconds=5)
+
+
+def acquire_dj_lease(station_id, user_id):
+    """Acquire or renew the user's lease of the station.
+
+    Returns the lease. Raises DjLeaseHeld if another DJ holds it, or is
+    acquiring it and holds its lock for longer than DJ_LEASE_LOCK_WAIT.
+    """
+    lease_key = get_dj_lease_cache_key(station_id)
+    with lock_dj_lease(station_id):
+        lease = cache.get(lease_key)
+        if lease is not None and lease['holder_id'] != user_id:
+            raise DjLeaseHeld(lease)
+
+        token = (lease['token']
+                 if lease is not None else get_next_fencing_token(station_id))
+        lease = build_dj_lease(user_id, token)
+        cache.set(lease_key, lease, settings.DJ_LEASE_DURATION.total_seconds())
+
+    return lease
+
+
+def release_dj_lease(station_id, lease):
+    """Release the lease unless it has since expired or been replaced."""
+    lease_key = get_dj_lease_cache_key(station_id)
+    try:
+        with lock_dj_lease(station_id):
+            current_lease = cache.get(lease_key)
+            if (current_lease is not None
+                    and current_lease['holder_id'] == lease['holder_id']
+                    and current_lease['token'] == lease['token']):
+                cache.delete(lease_key)
+    except DjLeaseHeld:
+        # Another DJ is acquiring the lease, the released lease will expire
+        pass
+
+
+@contextmanager
+def lock_dj_lease(station_id):
+    """Hold the lock on the station's lease, waiting up to
+    DJ_LEASE_LOCK_WAIT for it. Raises DjLeaseHeld if it is not acquired."""
+    lock_key = get_dj_lease_lock_cache_key(station_id)
+    wait_seconds = settings.DJ_LEASE_LOCK_WAIT.total_seconds()
+    wait_end_time = time.monotonic() + wait_seconds
+    while not cache.add(lock_key, True, DJ_LEASE_LOCK_TIMEOUT.total_seconds()):
+        if time.monotonic() >= wait_end_time:
+            raise DjLeaseHeld(get_dj_lease(station_id))
+        time.sleep(0.01)
+
+    try:
+        yield
+    finally:
+        cache.delete(lock_key)
+
+
+def get_dj_lease(station_id):
+    """Return the station's current lease or None if it is free."""
+    return cache.get(get_dj_lease_cache_key(station_id))
+
+
+def build_dj_lease(user_id, token):
+    return {
+        'holder_id': user_id,
+        'token': token,
+        'expiration_time': timezone.now() + settings.DJ_LEASE_DURATION,
+    }
+
+
+def get_next_fencing_token(station_id):
+    token_key = get_fencing_token_cache_key(station_id)
+    # Start new token sequences from the current time so they cannot go
+    # backwards if the previous sequence was evicted.
+    cache.add(token_key, int(time.time() * 1000), timeout=None)
+    return cache.incr(token_key)
+
+
+def get_dj_lease_cache_key(station_id):
+    return f'dj-lease-{station_id}'
+
+
+def get_dj_lease_lock_cache_key(station_id):
+    return f'dj-lease-{station_id}-lock'
+
+
+def get_fencing_token_cache_key(station_id):
+    return f'dj-lease-{station_id}-token'
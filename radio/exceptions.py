@@ -8,3 +8,19 @@ class ClientError(Error):
         self.code = code
         self.message = message
         super().__init__(*args, **kwargs)
+
+
+class PlaybackStateConflict(Error):
+    """Raised when a playback state update raced with another update."""
+
+
+class StaleDjLease(PlaybackStateConflict):
+    """Raised when a playback state update was made under an older DJ lease
+    than the playback state's last change."""
+
+
+class DjLeaseHeld(Error):
+    """Raised when another DJ holds the station's DJ lease."""
+    def __init__(self, lease, *args, **kwargs):
+        self.lease = lease
+        super().__init__(*args, **kwargs)
@@ -0,0 +1,88 @@
+"""Batched notifications of listeners joining and leaving stations.
+
+Each server process collects the joins and leaves of a station for
+LISTENER_CHANGE_BATCH_WINDOW and then publishes their net changes to the
+station's admins in one message, instead of one message per connection. A
+listener who reconnects within the window is not reported at all.
+"""
+
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .background import run_in_background
+from .models import Station
+
+logger = logging.getLogger(__name__)
+
+LISTENER_CHANGE_BATCH_EVENT_TYPE = 'station.listener_change_batch'
+
+
+class ListenerChangeBatcher:
+    def __init__(self):
+        # Station id to user id to the user's pending change
+        self.pending = {}
+        self.pending_loop = None
+
+    def add_join(self, station_id, user):
+        self.add(station_id, user, 1)
+
+    def add_leave(self, station_id, user):
+        self.add(station_id, user, -1)
+
+    def add(self, station_id, user, connection_delta):
+        pending = self.get_pending()
+        changes = pending.get(station_id)
+        if changes is None:
+            changes = pending[station_id] = {}
+            run_in_background(
+                self.publish_later(station_id),
+                f'Publishing listener changes of station {station_id}')
+
+        change = changes.setdefault(
+            user.id, {
+                'user_id': user.id,
+                'username': user.username,
+                'email': user.email,
+                'connection_delta': 0,
+            })
+        change['connection_delta'] += connection_delta
+
+    async def publish_later(self, station_id):
+        await asyncio.sleep(
+            settings.LISTENER_CHANGE_BATCH_WINDOW.total_seconds())
+
+        changes = [
+            change for change in self.get_pending().pop(station_id).values()
+            if change['connection_delta']
+        ]
+        if changes:
+            await publish_listener_changes(station_id, changes)
+
+    def get_pending(self):
+        # Pending changes belong to the event loop that publishes them
+        loop = asyncio.get_event_loop()
+        if self.pending_loop is not loop:
+            self.pending = {}
+            self.pending_loop = loop
+
+        return self.pending
+
+
+async def publish_listener_changes(station_id, changes):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        logger.warning(
+            'No channel layer configured, dropping listener changes for '
+            'station %d', station_id)
+        return
+
+    await channel_layer.group_send(Station.get_admin_group_name(station_id), {
+        'type': LISTENER_CHANGE_BATCH_EVENT_TYPE,
+        'changes': changes,
+    })
+
+
+listener_change_batcher = ListenerChangeBatcher()
@@ -0,0 +1,77 @@
+"""Measure the per-change CPU cost of broadcasting playback state changes."""
+
+from datetime import datetime, timezone
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...api.serializers import PlaybackStateSerializer
+from ...models import PlaybackState
+from ...playback import build_playback_state_changed_event
+
+DEFAULT_STATION_SIZES = [1, 10, 100, 500, 1000]
+
+
+class Command(BaseCommand):
+    help = ('Compare the CPU cost of serializing playback state changes once '
+            'per listener with serializing them once per change.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--station-sizes',
+                            nargs='+',
+                            type=int,
+                            default=DEFAULT_STATION_SIZES,
+                            help='number of listeners in the station')
+        parser.add_argument('--changes',
+                            type=int,
+                            default=20,
+                            help='number of playback state changes to time')
+
+    def handle(self, *args, **options):
+        playback_state = PlaybackState(station_id=1,
+                                       context_uri='spotify:album:benchmark',
+                                       current_track_uri='spotify:track:1',
+                                       paused=False,
+                                       raw_position_ms=123456,
+                                       sample_time=datetime.now(timezone.utc),
+                                       last_updated_time=datetime.now(
+                                           timezone.utc))
+
+        self.stdout.write(f'{"listeners":>10} {"per listener (ms)":>18} '
+                          f'{"once (ms)":>10} {"speedup":>8}')
+        for station_size in options['station_sizes']:
+            per_listener = time_per_change(
+                lambda: serialize_per_listener(playback_state, station_size),
+                options['changes'])
+            once = time_per_change(
+                lambda: serialize_once(playback_state, station_size),
+                options['changes'])
+            self.stdout.write(f'{station_size:>10} {per_listener:>18.3f} '
+                              f'{once:>10.3f} {per_listener / once:>7.1f}x')
+
+
+def serialize_per_listener(playback_state, station_size):
+    """The previous broadcast path: every listener serialized and encoded."""
+    for _ in range(station_size):
+        serializer = PlaybackStateSerializer(playback_state)
+        json.dumps({
+            'type': 'playback_state_changed',
+            'playbackstate': serializer.data,
+        })
+
+
+def serialize_once(playback_state, station_size):
+    """The current broadcast path: listeners forward a pre-encoded frame."""
+    event = build_playback_state_changed_event(
+        PlaybackStateSerializer(playback_state).data)
+    for _ in range(station_size):
+        event['text'].encode('utf-8')
+
+
+def time_per_change(func, changes):
+    """Return the mean CPU time of func in milliseconds."""
+    start = time.process_time()
+    for _ in range(changes):
+        func()
+    return (time.process_time() - start) * 1000 / changes
@@ -0,0 +1,43 @@
+"""Refresh the expiring access tokens of connected listeners."""
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...token_refresh import RateLimiter, refresh_expiring_access_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Refresh the Spotify access tokens of listeners connected to a '
+            'station before they expire.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='refresh expiring access tokens once and exit')
+
+    def handle(self, *args, **options):
+        rate_limiter = RateLimiter(settings.SPOTIFY_PROACTIVE_REFRESH_RATE)
+        while True:
+            # Replace the connection if a failed refresh left it unusable
+            close_old_connections()
+            try:
+                refreshed = refresh_expiring_access_tokens(rate_limiter)
+            except Exception:  # pylint: disable=broad-except
+                if options['once']:
+                    raise
+                logger.exception('Failed to refresh expiring access tokens')
+            else:
+                self.stdout.write(f'Refreshed {refreshed} access tokens')
+
+            if options['once']:
+                return
+
+            time.sleep(
+                settings.SPOTIFY_PROACTIVE_REFRESH_INTERVAL.total_seconds())
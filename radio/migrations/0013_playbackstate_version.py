@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-16 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0012_auto_20180711_0630'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playbackstate',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
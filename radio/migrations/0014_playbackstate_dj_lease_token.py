@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-16 23:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0013_playbackstate_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='playbackstate',
+            name='dj_lease_token',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-16 23:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0014_playbackstate_dj_lease_token'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='spotifycredentials',
+            index=models.Index(fields=['access_token_expiration_time', 'user'], name='radio_spotifycreds_expiring'),
+        ),
+    ]
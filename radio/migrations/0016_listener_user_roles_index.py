@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-16 23:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('radio', '0015_spotifycredentials_access_token_expiration_time_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='listener',
+            index=models.Index(fields=['user', 'station', 'is_admin', 'is_dj'], name='radio_listener_user_roles'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.0.7 on 2026-10-16 23:41
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('radio', '0016_listener_user_roles_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='listener',
+            index=models.Index(fields=['station', 'id'], name='radio_listener_station'),
+        ),
+        migrations.AddIndex(
+            model_name='listener',
+            index=models.Index(condition=models.Q(is_admin=True), fields=['station', 'id'], name='radio_listener_station_admins'),
+        ),
+        migrations.AddIndex(
+            model_name='listener',
+            index=models.Index(condition=models.Q(is_dj=True), fields=['station', 'id'], name='radio_listener_station_djs'),
+        ),
+        migrations.AlterField(
+            model_name='listener',
+            name='station',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='radio.Station'),
+        ),
+        migrations.AlterField(
+            model_name='listener',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
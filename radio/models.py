@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from django.conf import settings
 from django.db import models
 from django.urls import reverse
@@ -6,6 +8,11 @@ from django.urls import reverse
 class SpotifyCredentials(models.Model):
     class Meta:
         verbose_name_plural = "spotify credentials"
+        indexes = [
+            # Covers finding the users whose access tokens expire soonest
+            models.Index(fields=['access_token_expiration_time', 'user'],
+                         name='radio_spotifycreds_expiring'),
+        ]
 
     user = models.OneToOneField(settings.AUTH_USER_MODEL,
                                 on_delete=models.CASCADE)
@@ -26,26 +33,52 @@ class Station(models.Model):
 
     @property
     def group_name(self):
-        return f'station-{self.id}'
+        return self.get_group_name(self.id)
 
     @property
     def admin_group_name(self):
-        return f'station-admin-{self.id}'
+        return self.get_admin_group_name(self.id)
+
+    @staticmethod
+    def get_group_name(station_id):
+        return f'station-{station_id}'
+
+    @staticmethod
+    def get_admin_group_name(station_id):
+        return f'station-admin-{station_id}'
 
     def get_absolute_url(self):
         return reverse('radio:detail', kwargs={'pk': self.pk})
 
 
 class Listener(models.Model):
+    # Both foreign keys lead indexes below, so they need none of their own
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
-                             on_delete=models.CASCADE)
-    station = models.ForeignKey(Station, on_delete=models.CASCADE)
+                             on_delete=models.CASCADE,
+                             db_index=False)
+    station = models.ForeignKey(Station,
+                                on_delete=models.CASCADE,
+                                db_index=False)
 
     is_admin = models.BooleanField()
     is_dj = models.BooleanField()
 
     class Meta:
         unique_together = (('user', 'station'), )
+        indexes = [
+            # Covers listing a user's stations with their roles
+            models.Index(fields=['user', 'station', 'is_admin', 'is_dj'],
+                         name='radio_listener_user_roles'),
+            # Pages of a station's listeners in id order
+            models.Index(fields=['station', 'id'],
+                         name='radio_listener_station'),
+            models.Index(fields=['station', 'id'],
+                         condition=models.Q(is_admin=True),
+                         name='radio_listener_station_admins'),
+            models.Index(fields=['station', 'id'],
+                         condition=models.Q(is_dj=True),
+                         name='radio_listener_station_djs'),
+        ]
 
 
 class PlaybackState(models.Model):
@@ -56,3 +89,15 @@ class PlaybackState(models.Model):
     raw_position_ms = models.PositiveIntegerField()
     sample_time = models.DateTimeField()
     last_updated_time = models.DateTimeField(auto_now=True)
+    # Incremented by every saved change, used for conditional updates
+    version = models.PositiveIntegerField(default=0)
+    # Fencing token of the DJ lease the last change was made under
+    dj_lease_token = models.BigIntegerField(default=0)
+
+    def position_ms_at(self, time):
+        """Return the playback position extrapolated to time."""
+        if self.paused:
+            return self.raw_position_ms
+
+        elapsed_ms = (time - self.sample_time) // timedelta(milliseconds=1)
+        return max(self.raw_position_ms + elapsed_ms, 0)
@@ -0,0 +1,374 @@
+"""Station playback state caching and change notifications.
+
+Playback state is read through a versioned cache keyed by station id and
+written through to the database. Every saved change increments the playback
+state's version, which is used as its ETag, and database writes are a single
+compare-and-swap UPDATE on the version last written to the database.
+
+Batched position updates are only written to the cache, so the database
+version can lag behind the cached one. Every writer, batched or not, holds
+the playback state row lock while it checks that the cached version is still
+the one its change was made to and caches its change, so concurrent changes
+made to the same version conflict instead of overwriting each other, and
+cache writes happen in the order of the changes. Readers only trust entries
+stored under the station's current cache version, so an entry filled from a
+database read that raced with a write is never served.
+
+Playback state changes are published to the station's channel layer group,
+so listeners connected to any server process are notified. The WebSocket
+frame is encoded to JSON text once per change and every listener's consumer
+forwards the pre-encoded frame as is.
+"""
+
+from datetime import timedelta
+import json
+import logging
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from django.utils.http import quote_etag
+
+from .exceptions import PlaybackStateConflict, StaleDjLease
+from .models import PlaybackState, Station
+
+logger = logging.getLogger(__name__)
+
+PLAYBACK_STATE_CHANGED_EVENT_TYPE = 'station.playback_state_changed'
+
+PLAYBACK_STATE_UPDATE_FIELDS = ('context_uri', 'current_track_uri', 'paused',
+                                'raw_position_ms', 'sample_time',
+                                'last_updated_time', 'version',
+                                'dj_lease_token')
+
+PLAYBACK_STATE_CACHED_FIELDS = ('id',
+                                'station_id') + PLAYBACK_STATE_UPDATE_FIELDS
+
+# Fields that change on every heartbeat while music is playing
+PLAYBACK_STATE_POSITION_FIELDS = frozenset(('raw_position_ms', 'sample_time'))
+
+# Playback State Cache
+
+
+def get_playback_state(station_id):
+    """Return the station's playback state or None if it has none."""
+    version = get_cache_version(station_id)
+    state_key = get_state_cache_key(station_id, version)
+    entry = cache.get(state_key)
+    if entry is not None:
+        return playback_state_from_cache_entry(entry)
+
+    playback_state = PlaybackState.objects.filter(
+        station_id=station_id).first()
+    if playback_state is not None:
+        playback_state.flushed_time = playback_state.last_updated_time
+        playback_state.flushed_version = playback_state.version
+
+    # If a writer already cached this version, its entry wins
+    cache.add(state_key, build_cache_entry(playback_state),
+              settings.PLAYBACK_STATE_CACHE_TIMEOUT)
+    return playback_state
+
+
+def attach_playback_state(station):
+    """Read the station's playback state through the cache onto station."""
+    playback_state = get_playback_state(station.id)
+    Station.playbackstate.related.set_cached_value(station, playback_state)
+    return playback_state
+
+
+def get_etag(playback_state):
+    version = playback_state.version if playback_state is not None else 0
+    return quote_etag(str(version))
+
+
+def get_etag_version(etag):
+    """Return the playback state version of etag or None if it has none."""
+    try:
+        return int(etag.strip('"'))
+    except ValueError:
+        return None
+
+
+def save_playback_state(playback_state,
+                        previous=None,
+                        expected_versions=None,
+                        lease_token=None):
+    """Save the playback state to the database and the cache.
+
+    Returns True if listeners need to be notified of the change. Raises
+    PlaybackStateConflict if the previous version is not one of
+    expected_versions or if the playback state was changed concurrently, and
+    StaleDjLease if the previous change was made under a newer DJ lease than
+    lease_token.
+
+    DJ heartbeats whose position is consistent with the previous sample are
+    not saved, as listeners extrapolate the same position from the previous
+    sample, apart from a checkpoint once per PLAYBACK_STATE_FLUSH_INTERVAL.
+
+    When position batching is enabled, other updates that only change the
+    playback position (e.g. seeks) are written to the cache and flushed to
+    the database at most once per PLAYBACK_STATE_FLUSH_INTERVAL.
+    """
+    previous_version = previous.version if previous is not None else 0
+    if ((expected_versions is not None)
+            and (previous_version not in expected_versions)):
+        raise PlaybackStateConflict()
+
+    if lease_token is not None:
+        if previous is not None and previous.dj_lease_token > lease_token:
+            raise StaleDjLease()
+        playback_state.dj_lease_token = lease_token
+
+    changed_fields = None
+    if previous is not None:
+        changed_fields = get_changed_fields(previous, playback_state)
+        if is_heartbeat(previous, playback_state, changed_fields):
+            if is_flush_due(previous):
+                write_playback_state(playback_state)
+            return False
+
+    if (settings.PLAYBACK_STATE_BATCH_FLUSH_POSITIONS
+            and changed_fields is not None
+            and changed_fields <= PLAYBACK_STATE_POSITION_FIELDS
+            and not is_flush_due(playback_state)):
+        with transaction.atomic():
+            lock_playback_state(playback_state.station_id)
+            check_cached_version(playback_state.station_id,
+                                 playback_state.version)
+            playback_state.last_updated_time = timezone.now()
+            playback_state.version += 1
+            cache_playback_state(playback_state)
+        return True
+
+    write_playback_state(playback_state)
+    return True
+
+
+def write_playback_state(playback_state):
+    flushed_version = getattr(playback_state, 'flushed_version',
+                              playback_state.version)
+
+    with transaction.atomic():
+        # Writing holds the row lock until commit, which orders cache writes
+        if playback_state._state.adding:  # pylint: disable=protected-access
+            playback_state.version += 1
+            playback_state.save()
+        else:
+            previous_version = playback_state.version
+            playback_state.last_updated_time = timezone.now()
+            playback_state.version += 1
+            updated = PlaybackState.objects.filter(
+                pk=playback_state.pk, version=flushed_version).update(
+                    **{
+                        field: getattr(playback_state, field)
+                        for field in PLAYBACK_STATE_UPDATE_FIELDS
+                    })
+            if not updated:
+                raise PlaybackStateConflict()
+
+            # A batched position update may have been cached since the
+            # database was last written
+            check_cached_version(playback_state.station_id, previous_version)
+
+        playback_state.flushed_time = playback_state.last_updated_time
+        playback_state.flushed_version = playback_state.version
+        cache_playback_state(playback_state)
+
+
+def pause_playback_state(station_id):
+    """Pause the station's playback state if it is playing.
+
+    Returns the paused playback state, or None if it was not playing. The
+    pause is a single conditional UPDATE, so it does not overwrite a change
+    that raced with it. Positions batched in the cache but not yet flushed
+    are dropped, but the version still moves past them.
+    """
+    with transaction.atomic():
+        # Batched position updates are cached under the row lock
+        lock_playback_state(station_id)
+        cached_version = get_cached_playback_state_version(station_id)
+        updated = PlaybackState.objects.filter(
+            station_id=station_id, paused=False).update(
+                paused=True,
+                last_updated_time=timezone.now(),
+                version=Greatest(F('version'), cached_version) + 1)
+        if not updated:
+            return None
+
+        # The row lock is held until commit, which orders the cache write
+        playback_state = PlaybackState.objects.get(station_id=station_id)
+        playback_state.flushed_time = playback_state.last_updated_time
+        playback_state.flushed_version = playback_state.version
+        cache_playback_state(playback_state)
+
+    return playback_state
+
+
+def lock_playback_state(station_id):
+    """Hold the playback state row lock until the end of the transaction."""
+    list(PlaybackState.objects.select_for_update().filter(
+        station_id=station_id).values_list('pk', flat=True))
+
+
+def check_cached_version(station_id, version):
+    """Raise PlaybackStateConflict if the cached playback state has moved
+    past version. The playback state row lock must be held."""
+    cached_version = get_cached_playback_state_version(station_id)
+    # Every writer caches its change, so no entry is cached only if it was
+    # evicted since the last change
+    if cached_version not in (0, version):
+        raise PlaybackStateConflict()
+
+
+def get_changed_fields(previous, playback_state):
+    return {
+        field
+        for field in PLAYBACK_STATE_CACHED_FIELDS
+        if getattr(previous, field) != getattr(playback_state, field)
+    }
+
+
+def is_heartbeat(previous, playback_state, changed_fields):
+    """Whether the update is only the playback position progressing."""
+    if not changed_fields <= PLAYBACK_STATE_POSITION_FIELDS:
+        return False
+
+    if playback_state.paused:
+        return playback_state.raw_position_ms == previous.raw_position_ms
+
+    elapsed = playback_state.sample_time - previous.sample_time
+    expected_position = timedelta(
+        milliseconds=previous.raw_position_ms) + elapsed
+    drift = abs(
+        timedelta(milliseconds=playback_state.raw_position_ms) -
+        expected_position)
+    return drift <= settings.PLAYBACK_STATE_HEARTBEAT_TOLERANCE
+
+
+def cache_playback_state(playback_state):
+    station_id = playback_state.station_id
+    get_cache_version(station_id)
+    version = cache.incr(get_version_cache_key(station_id))
+    cache.set(get_state_cache_key(station_id, version),
+              build_cache_entry(playback_state),
+              settings.PLAYBACK_STATE_CACHE_TIMEOUT)
+
+
+def get_cached_playback_state_version(station_id):
+    """Return the version of the cached playback state or 0 if none is."""
+    entry = cache.get(
+        get_state_cache_key(station_id, get_cache_version(station_id)))
+    if entry is None or entry['fields'] is None:
+        return 0
+
+    return entry['fields']['version']
+
+
+def get_cache_version(station_id):
+    version_key = get_version_cache_key(station_id)
+    version = cache.get(version_key)
+    if version is None:
+        # Start new version sequences from the current time so they cannot
+        # collide with entries left over from an evicted sequence.
+        cache.add(version_key, int(time.time() * 1000), timeout=None)
+        version = cache.get(version_key)
+
+    return version
+
+
+def is_flush_due(playback_state):
+    flushed_time = getattr(playback_state, 'flushed_time', None)
+    return ((flushed_time is None) or (timezone.now() - flushed_time >=
+                                       settings.PLAYBACK_STATE_FLUSH_INTERVAL))
+
+
+def build_cache_entry(playback_state):
+    if playback_state is None:
+        return {'fields': None}
+
+    return {
+        'fields': {
+            field: getattr(playback_state, field)
+            for field in PLAYBACK_STATE_CACHED_FIELDS
+        },
+        'flushed_time':
+        getattr(playback_state, 'flushed_time',
+                playback_state.last_updated_time),
+        'flushed_version':
+        getattr(playback_state, 'flushed_version', playback_state.version),
+    }
+
+
+def playback_state_from_cache_entry(entry):
+    if entry['fields'] is None:
+        return None
+
+    playback_state = PlaybackState(**entry['fields'])
+    playback_state.flushed_time = entry['flushed_time']
+    playback_state.flushed_version = entry['flushed_version']
+
+    # The instance came from the database, so saving should UPDATE the row
+    playback_state._state.adding = False  # pylint: disable=protected-access
+    return playback_state
+
+
+def get_version_cache_key(station_id):
+    return f'playbackstate-{station_id}-version'
+
+
+def get_state_cache_key(station_id, version):
+    return f'playbackstate-{station_id}-{version}'
+
+
+# Playback State Change Notifications
+
+
+def encode_playback_state_changed_frame(playbackstate_data):
+    """Encode the playback_state_changed WebSocket frame sent to listeners."""
+    return json.dumps({
+        'type': 'playback_state_changed',
+        'playbackstate': playbackstate_data,
+    })
+
+
+def build_playback_state_changed_event(playbackstate_data,
+                                       sender_user_id=None):
+    return {
+        'type': PLAYBACK_STATE_CHANGED_EVENT_TYPE,
+        'text': encode_playback_state_changed_frame(playbackstate_data),
+        'sender_user_id': sender_user_id,
+    }
+
+
+async def publish_playback_state_changed(station_id,
+                                         playbackstate_data,
+                                         sender_user_id=None):
+    """Publish a playback state change to everyone in the station.
+
+    The connections of sender_user_id, who made the change, are not sent it.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        logger.warning(
+            'No channel layer configured, dropping playback state change '
+            'for station %d', station_id)
+        return
+
+    await channel_layer.group_send(
+        Station.get_group_name(station_id),
+        build_playback_state_changed_event(playbackstate_data, sender_user_id))
+
+
+def publish_playback_state_changed_sync(station_id,
+                                        playbackstate_data,
+                                        sender_user_id=None):
+    async_to_sync(publish_playback_state_changed)(station_id,
+                                                  playbackstate_data,
+                                                  sender_user_id)
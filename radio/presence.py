@@ -0,0 +1,268 @@
+"""Presence of the listeners connected to each station.
+
+For every station the presence backend keeps the connected user ids with
+their number of connections and when they were last seen. Connections
+update it when they join and leave the station, and refresh their last seen
+time every PRESENCE_REFRESH_INTERVAL. Users of server processes that crashed
+without leaving are no longer present once they have not been seen for
+PRESENCE_STALE_AFTER: reads ignore them, and reaping forgets them. A user
+who is reaped while still connected is present again at their next refresh.
+
+The backend is chosen by the PRESENCE_BACKEND setting. RedisPresence shares
+presence between server processes, InMemoryPresence only knows the
+connections of its own process and is meant for tests and development, like
+the in memory channel layer.
+"""
+
+from datetime import datetime, timezone
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+
+_presence = None
+
+
+def get_presence():
+    """Return the configured presence backend."""
+    global _presence  # pylint: disable=global-statement
+    if _presence is None:
+        _presence = import_string(settings.PRESENCE_BACKEND)()
+
+    return _presence
+
+
+class StationRoster:
+    """The station's present users, most recently seen first.
+
+    Supports len() and slicing, so it can be paginated like a queryset.
+    """
+    def __init__(self, presence, station_id):
+        self.presence = presence
+        self.station_id = station_id
+
+    def __len__(self):
+        return self.presence.count(self.station_id)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step is not None:
+            raise TypeError('StationRoster only supports slices')
+
+        start = key.start or 0
+        stop = key.stop if key.stop is not None else len(self)
+        if stop <= start:
+            return []
+
+        return self.presence.get_users(self.station_id, start, stop)
+
+
+class RedisPresence:
+    """Presence in a hash of connection counts and a sorted set of last seen
+    times, both keyed by user id."""
+
+    # Decrement the connection count and forget users without connections
+    LEAVE_SCRIPT = '''
+        local connections = redis.call('HINCRBY', KEYS[1], ARGV[1], -1)
+        if connections <= 0 then
+            redis.call('HDEL', KEYS[1], ARGV[1])
+            redis.call('ZREM', KEYS[2], ARGV[1])
+        else
+            redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+        end
+        return connections
+    '''
+
+    # Forget users who have not been seen since the cutoff
+    REAP_SCRIPT = '''
+        local user_ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+        if #user_ids > 0 then
+            redis.call('HDEL', KEYS[1], unpack(user_ids))
+            redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+        end
+        return #user_ids
+    '''
+
+    def __init__(self):
+        self.redis = get_redis_connection('default')
+        self.leave_script = self.redis.register_script(self.LEAVE_SCRIPT)
+        self.reap_script = self.redis.register_script(self.REAP_SCRIPT)
+
+    def join(self, station_id, user_id):
+        connections_key, last_seen_key = get_presence_keys(station_id)
+        pipeline = self.redis.pipeline()
+        pipeline.hincrby(connections_key, user_id, 1)
+        pipeline.zadd(last_seen_key, {user_id: time.time()})
+        pipeline.execute()
+
+    def leave(self, station_id, user_id):
+        self.leave_script(keys=get_presence_keys(station_id),
+                          args=[user_id, time.time()])
+
+    def touch(self, station_id, user_id):
+        # Re-add the connection of a user who was reaped while connected
+        connections_key, last_seen_key = get_presence_keys(station_id)
+        pipeline = self.redis.pipeline()
+        pipeline.hsetnx(connections_key, user_id, 1)
+        pipeline.zadd(last_seen_key, {user_id: time.time()})
+        pipeline.execute()
+
+    def reap(self, station_id):
+        """Forget stale users and return how many there were."""
+        return self.reap_script(keys=get_presence_keys(station_id),
+                                args=[get_stale_cutoff()])
+
+    def is_present(self, station_id, user_id):
+        _, last_seen_key = get_presence_keys(station_id)
+        return is_fresh(self.redis.zscore(last_seen_key, user_id),
+                        get_stale_cutoff())
+
+    def get_present_user_ids(self, station_id, user_ids):
+        """Return which of the users are present."""
+        _, last_seen_key = get_presence_keys(station_id)
+        pipeline = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipeline.zscore(last_seen_key, user_id)
+
+        cutoff = get_stale_cutoff()
+        return {
+            user_id
+            for user_id, last_seen_time in zip(user_ids, pipeline.execute())
+            if is_fresh(last_seen_time, cutoff)
+        }
+
+    def count(self, station_id):
+        """Return the number of present users."""
+        _, last_seen_key = get_presence_keys(station_id)
+        return self.redis.zcount(last_seen_key, f'({get_stale_cutoff()}',
+                                 '+inf')
+
+    def get_counts(self, station_ids):
+        """Return the number of present users of each station by id."""
+        cutoff = get_stale_cutoff()
+        pipeline = self.redis.pipeline(transaction=False)
+        for station_id in station_ids:
+            _, last_seen_key = get_presence_keys(station_id)
+            pipeline.zcount(last_seen_key, f'({cutoff}', '+inf')
+
+        return dict(zip(station_ids, pipeline.execute()))
+
+    def get_users(self, station_id, start, stop):
+        connections_key, last_seen_key = get_presence_keys(station_id)
+        last_seen = self.redis.zrevrangebyscore(last_seen_key,
+                                                '+inf',
+                                                f'({get_stale_cutoff()}',
+                                                start=start,
+                                                num=stop - start,
+                                                withscores=True)
+        if not last_seen:
+            return []
+
+        connections = self.redis.hmget(connections_key,
+                                       [user_id for user_id, _ in last_seen])
+        return [
+            build_user_presence(user_id, user_connections, last_seen_time)
+            for (user_id, last_seen_time
+                 ), user_connections in zip(last_seen, connections)
+        ]
+
+
+class InMemoryPresence:
+    """Presence of this server process's connections only."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Station id to user id to connection count and last seen time
+        self.stations = {}
+
+    def join(self, station_id, user_id):
+        with self.lock:
+            users = self.stations.setdefault(station_id, {})
+            connections, _ = users.get(user_id, (0, None))
+            users[user_id] = (connections + 1, time.time())
+
+    def leave(self, station_id, user_id):
+        with self.lock:
+            users = self.stations.get(station_id, {})
+            connections, _ = users.get(user_id, (0, None))
+            if connections <= 1:
+                users.pop(user_id, None)
+            else:
+                users[user_id] = (connections - 1, time.time())
+
+    def touch(self, station_id, user_id):
+        with self.lock:
+            users = self.stations.setdefault(station_id, {})
+            connections, _ = users.get(user_id, (1, None))
+            users[user_id] = (connections, time.time())
+
+    def reap(self, station_id):
+        cutoff = get_stale_cutoff()
+        with self.lock:
+            users = self.stations.get(station_id, {})
+            stale_user_ids = [
+                user_id for user_id, (_, last_seen_time) in users.items()
+                if last_seen_time <= cutoff
+            ]
+            for user_id in stale_user_ids:
+                del users[user_id]
+
+        return len(stale_user_ids)
+
+    def is_present(self, station_id, user_id):
+        return user_id in self.get_present_users(station_id)
+
+    def get_present_user_ids(self, station_id, user_ids):
+        users = self.get_present_users(station_id)
+        return {user_id for user_id in user_ids if user_id in users}
+
+    def count(self, station_id):
+        return len(self.get_present_users(station_id))
+
+    def get_counts(self, station_ids):
+        return {
+            station_id: self.count(station_id)
+            for station_id in station_ids
+        }
+
+    def get_users(self, station_id, start, stop):
+        users = sorted(self.get_present_users(station_id).items(),
+                       key=lambda item: item[1][1],
+                       reverse=True)
+
+        return [
+            build_user_presence(user_id, connections, last_seen_time)
+            for user_id, (connections, last_seen_time) in users[start:stop]
+        ]
+
+    def get_present_users(self, station_id):
+        """Return the station's users which are not stale."""
+        cutoff = get_stale_cutoff()
+        with self.lock:
+            return {
+                user_id: user
+                for user_id, user in self.stations.get(station_id, {}).items()
+                if user[1] > cutoff
+            }
+
+
+def build_user_presence(user_id, connections, last_seen_time):
+    return {
+        'user_id': int(user_id),
+        'connections': int(connections or 0),
+        'last_seen': datetime.fromtimestamp(last_seen_time, tz=timezone.utc),
+    }
+
+
+def get_stale_cutoff():
+    """Return the last seen time at or before which users are stale."""
+    return time.time() - settings.PRESENCE_STALE_AFTER.total_seconds()
+
+
+def is_fresh(last_seen_time, cutoff):
+    return last_seen_time is not None and last_seen_time > cutoff
+
+
+def get_presence_keys(station_id):
+    return (f'presence-{station_id}-connections',
+            f'presence-{station_id}-last-seen')
@@ -1,14 +1,16 @@
 from datetime import timedelta
 import hashlib
-from http import HTTPStatus
 import logging
 import urllib.parse
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
 from django.shortcuts import redirect
 from django.utils import timezone
-import requests
 
+from . import spotify_accounts
 from .models import SpotifyCredentials
 
 logger = logging.getLogger(__name__)
@@ -22,7 +24,9 @@ class AuthorizationRequiredMixin:
     Verify that the current user has authorized the application to use Spotify.
     """
     def dispatch(self, request, *args, **kwargs):
-        if not hasattr(request.user, 'spotifycredentials'):
+        if (get_fetched_spotify_credentials(request) is None
+                and AccessToken.get_cached(request.user.id) is None
+                and not hasattr(request.user, 'spotifycredentials')):
             return request_spotify_authorization(request)
 
         return super().dispatch(request, *args, **kwargs)
@@ -33,15 +37,26 @@ class FreshAccessTokenRequiredMixin:
     Ensures the Spotify access token is fresh and cached in the current session.
     """
     def dispatch(self, request, *args, **kwargs):
-        access_token = AccessToken.load(request.user)
-        if access_token.has_expired():
-            access_token.refresh()
-            access_token.save()
-
-        request.session['access_token'] = access_token.token
+        access_token = AccessToken.load_fresh(
+            request.user.id, creds=get_fetched_spotify_credentials(request))
+        # Assigning would save the session even if the token is unchanged
+        if request.session.get('access_token') != access_token.token:
+            request.session['access_token'] = access_token.token
         return super().dispatch(request, *args, **kwargs)
 
 
+def get_fetched_spotify_credentials(request):
+    """Return the user's Spotify credentials if the view fetched them along
+    with request.listener, otherwise None."""
+    listener = getattr(request, 'listener', None)
+    if ((listener is None)
+            or (not get_user_model().spotifycredentials.related.is_cached(
+                listener.user))):
+        return None
+
+    return getattr(listener.user, 'spotifycredentials', None)
+
+
 # Spotify OAuth Common
 
 
@@ -86,9 +101,16 @@ def build_request_authorization_url(request):
 
 
 class AccessToken:
-    def __init__(self, user, refresh_token, access_token,
+    """A user's Spotify access token.
+
+    Fresh access tokens are cached by user id until they expire within
+    SPOTIFY_ACCESS_TOKEN_REFRESH_MARGIN, so that loading them does not query
+    the database. Refresh tokens are not cached, so cached access tokens have
+    none.
+    """
+    def __init__(self, user_id, refresh_token, access_token,
                  access_token_expiration_time):
-        self.user = user
+        self.user_id = user_id
         self.refresh_token = refresh_token
         self.token = access_token
         self.token_expiration_time = access_token_expiration_time
@@ -103,23 +125,25 @@ class AccessToken:
     def has_expired(self):
         return timezone.now() > self.token_expiration_time
 
-    def refresh(self):
-        data = {
-            'grant_type': 'refresh_token',
-            'refresh_token': self.refresh_token,
-            'client_id': settings.SPOTIFY_CLIENT_ID,
-            'client_secret': settings.SPOTIFY_CLIENT_SECRET,
-        }
-        response = requests.post(settings.SPOTIFY_TOKEN_API_URL, data=data)
-        if response.status_code == HTTPStatus.OK.value:
-            response_data = response.json()
-            self.token = response_data['access_token']
-            expires_in = int(response_data['expires_in'])
-            expires_in = timedelta(seconds=expires_in)
-            self.token_expiration_time = timezone.now() + expires_in
-        else:
-            logger.error(response.text)
-            response.raise_for_status()
+    def expires_within(self, duration):
+        return timezone.now() + duration > self.token_expiration_time
+
+    def refresh(self, deadline=None):
+        response_data = spotify_accounts.refresh_access_token(
+            self.refresh_token, deadline)
+        self.update_token(response_data)
+
+    async def refresh_async(self):
+        response_data = await spotify_accounts.refresh_access_token_async(
+            self.refresh_token)
+        self.update_token(response_data)
+
+    def update_token(self, response_data):
+        self.token = response_data['access_token']
+        # Spotify may issue a new refresh token along with the access token
+        self.refresh_token = response_data.get('refresh_token',
+                                               self.refresh_token)
+        self.token_expiration_time = get_expiration_time(response_data)
 
     @classmethod
     def load(cls, user_id):
@@ -127,40 +151,101 @@ class AccessToken:
         creds = SpotifyCredentials.objects.get(user_id=user_id)
         return cls.from_db_model(creds)
 
-    def save(self):
-        """Save the access token to the database."""
-        try:
-            creds = SpotifyCredentials.objects.get(user_id=self.user.id)
-        except SpotifyCredentials.DoesNotExist:
-            creds = SpotifyCredentials(user_id=self.user.id,
-                                       refresh_token=self.refresh_token)
+    @classmethod
+    def load_fresh(cls, user_id, margin=None, creds=None):
+        """Load the user's access token, refreshing it if it expires within
+        margin, SPOTIFY_ACCESS_TOKEN_REFRESH_MARGIN by default.
+
+        creds are the user's credentials if the caller already fetched them,
+        which are used instead of querying them unless the token needs
+        refreshing.
+
+        Refreshes are single flight per user: the user's credentials are
+        locked while refreshing, so concurrent callers wait for the refresh in
+        flight and reuse its token instead of refreshing again. The refresh
+        gives up after SPOTIFY_ACCESS_TOKEN_LOCKED_REFRESH_DEADLINE so that
+        it cannot hold the lock for long.
+        """
+        if margin is None:
+            margin = settings.SPOTIFY_ACCESS_TOKEN_REFRESH_MARGIN
+
+        access_token = cls.get_cached(user_id)
+        if access_token is None and creds is not None:
+            access_token = cls.from_db_model(creds)
+        if access_token is not None and not access_token.expires_within(
+                margin):
+            return access_token
+
+        with transaction.atomic():
+            creds = SpotifyCredentials.objects.select_for_update().get(
+                user_id=user_id)
+            access_token = cls.from_db_model(creds)
+            if access_token.expires_within(margin):
+                access_token.refresh(
+                    settings.SPOTIFY_ACCESS_TOKEN_LOCKED_REFRESH_DEADLINE)
+                access_token.save()
+            else:
+                access_token.cache()
+
+        return access_token
 
-        creds.access_token = self.token
-        creds.access_token_expiration_time = self.token_expiration_time
-        creds.save()
+    @classmethod
+    def get_cached(cls, user_id):
+        """Return the user's cached access token or None if it is not."""
+        entry = cache.get(get_access_token_cache_key(user_id))
+        if entry is None:
+            return None
+
+        return cls(user_id, None, entry['token'],
+                   entry['token_expiration_time'])
+
+    def save(self):
+        """Save the access token to the database and the cache."""
+        fields = {
+            'refresh_token': self.refresh_token,
+            'access_token': self.token,
+            'access_token_expiration_time': self.token_expiration_time,
+        }
+        updated = SpotifyCredentials.objects.filter(
+            user_id=self.user_id).update(**fields)
+        if not updated:
+            SpotifyCredentials.objects.create(user_id=self.user_id, **fields)
+
+        self.cache()
+
+    def cache(self):
+        timeout = (self.token_expiration_time - timezone.now() -
+                   settings.SPOTIFY_ACCESS_TOKEN_REFRESH_MARGIN)
+        cache_key = get_access_token_cache_key(self.user_id)
+        if timeout <= timedelta():
+            cache.delete(cache_key)
+            return
+
+        cache.set(
+            cache_key, {
+                'token': self.token,
+                'token_expiration_time': self.token_expiration_time,
+            }, timeout.total_seconds())
 
     @classmethod
     def from_db_model(cls, creds: SpotifyCredentials):
-        return cls(creds.user, creds.refresh_token, creds.access_token,
+        return cls(creds.user_id, creds.refresh_token, creds.access_token,
                    creds.access_token_expiration_time)
 
     @staticmethod
     def request_refresh_and_access_token(code, user):
-        data = {
-            'grant_type': 'authorization_code',
-            'code': code,
-            'redirect_uri': get_oauth_redirect_uri(),
-            'client_id': settings.SPOTIFY_CLIENT_ID,
-            'client_secret': settings.SPOTIFY_CLIENT_SECRET,
-        }
-
-        req = requests.post(settings.SPOTIFY_TOKEN_API_URL, data)
-
-        response_data = req.json()
-        expires_in = int(response_data['expires_in'])
-        expires_in = timedelta(seconds=expires_in)
-        expiration_time = timezone.now() + expires_in
-        access_token = AccessToken(user, response_data['refresh_token'],
+        response_data = spotify_accounts.request_authorization_tokens(
+            code, get_oauth_redirect_uri())
+        access_token = AccessToken(user.id, response_data['refresh_token'],
                                    response_data['access_token'],
-                                   expiration_time)
+                                   get_expiration_time(response_data))
         access_token.save()
+
+
+def get_expiration_time(response_data):
+    expires_in = timedelta(seconds=int(response_data['expires_in']))
+    return timezone.now() + expires_in
+
+
+def get_access_token_cache_key(user_id):
+    return f'access-token-{user_id}'
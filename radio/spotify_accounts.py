@@ -0,0 +1,192 @@
+"""Client of the Spotify accounts service, which issues access tokens.
+
+Requests share one session, so connections to the accounts service are
+pooled and kept alive instead of being opened for every token. Every request
+has a connect and a read timeout. Rate limited (429) and failed (5xx)
+requests, and requests that could not connect, are retried with exponential
+backoff, waiting for as long as the service's Retry-After header asks if it
+has one. Callers that hold a lock while requesting can give a deadline for
+all attempts and waits together.
+
+The async variants run requests in a worker thread, so that consumers do not
+block the event loop for the round trip.
+"""
+
+import asyncio
+from datetime import timedelta
+import email.utils
+import functools
+from http import HTTPStatus
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the session shared by all requests to the accounts service."""
+    global _session  # pylint: disable=global-statement
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.SPOTIFY_ACCOUNTS_POOL_SIZE)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+
+    return _session
+
+
+def refresh_access_token(refresh_token, deadline=None):
+    """Request a new access token with the user's refresh token."""
+    return request_token(
+        {
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token,
+            'client_id': settings.SPOTIFY_CLIENT_ID,
+            'client_secret': settings.SPOTIFY_CLIENT_SECRET,
+        }, deadline)
+
+
+def request_authorization_tokens(code, redirect_uri):
+    """Exchange an authorization code for refresh and access tokens."""
+    return request_token({
+        'grant_type': 'authorization_code',
+        'code': code,
+        'redirect_uri': redirect_uri,
+        'client_id': settings.SPOTIFY_CLIENT_ID,
+        'client_secret': settings.SPOTIFY_CLIENT_SECRET,
+    })
+
+
+async def refresh_access_token_async(refresh_token):
+    return await run_in_executor(refresh_access_token, refresh_token)
+
+
+def request_token(data, deadline=None):
+    """POST data to the token API and return the response data.
+
+    If deadline is given, attempts time out and retries are given up on so
+    that the request takes at most about that long in total.
+
+    Raises requests.HTTPError if the request did not succeed, and
+    requests.Timeout or requests.ConnectionError if the service could not be
+    reached, once retries are exhausted.
+    """
+    end_time = (time.monotonic() +
+                deadline.total_seconds() if deadline is not None else None)
+
+    for attempt in range(settings.SPOTIFY_ACCOUNTS_MAX_RETRIES + 1):
+        is_last_attempt = attempt == settings.SPOTIFY_ACCOUNTS_MAX_RETRIES
+        try:
+            response = get_session().post(settings.SPOTIFY_TOKEN_API_URL,
+                                          data=data,
+                                          timeout=get_timeout(end_time))
+        except requests.ConnectionError:
+            delay = get_backoff(attempt)
+            if is_last_attempt or not has_time_for(delay, end_time):
+                raise
+            logger.warning('Could not connect to the Spotify accounts service')
+            time.sleep(delay.total_seconds())
+            continue
+
+        if is_successful(response):
+            return response.json()
+
+        if is_last_attempt or not is_retryable(response):
+            break
+
+        delay = get_retry_delay(response, attempt)
+        if (delay > settings.SPOTIFY_ACCOUNTS_MAX_RETRY_AFTER
+                or not has_time_for(delay, end_time)):
+            # Waiting that long would hold up the request for too long
+            break
+
+        logger.warning('Spotify accounts service responded %d, retrying',
+                       response.status_code)
+        time.sleep(delay.total_seconds())
+
+    logger.error(response.text)
+    response.raise_for_status()
+    # Unfollowed redirects are not errors to raise_for_status
+    raise requests.HTTPError(
+        f'Unexpected {response.status_code} response from the token API',
+        response=response)
+
+
+def get_timeout(end_time):
+    """Return the connect and read timeouts of an attempt ending by
+    end_time."""
+    connect_timeout = settings.SPOTIFY_ACCOUNTS_CONNECT_TIMEOUT.total_seconds()
+    read_timeout = settings.SPOTIFY_ACCOUNTS_READ_TIMEOUT.total_seconds()
+    if end_time is None:
+        return (connect_timeout, read_timeout)
+
+    # Leave the attempt a moment even if the deadline has just passed
+    remaining = max(end_time - time.monotonic(), 0.1)
+    return (min(connect_timeout, remaining), min(read_timeout, remaining))
+
+
+def has_time_for(delay, end_time):
+    """Return whether a retry after delay would start before end_time."""
+    return (end_time is None
+            or time.monotonic() + delay.total_seconds() < end_time)
+
+
+def is_successful(response):
+    # Unlike response.ok, which is also true of unfollowed redirects
+    return (HTTPStatus.OK.value <= response.status_code <
+            HTTPStatus.MULTIPLE_CHOICES.value)
+
+
+def is_retryable(response):
+    return (response.status_code == HTTPStatus.TOO_MANY_REQUESTS.value
+            or response.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR.value)
+
+
+def get_retry_delay(response, attempt):
+    """Return how long to wait before retrying the response's request."""
+    retry_after = parse_retry_after(response.headers.get('Retry-After'))
+    if retry_after is not None:
+        return retry_after
+
+    return get_backoff(attempt)
+
+
+def get_backoff(attempt):
+    return settings.SPOTIFY_ACCOUNTS_RETRY_BACKOFF * (2**attempt)
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header of seconds or an HTTP date."""
+    if value is None:
+        return None
+
+    try:
+        return timedelta(seconds=max(int(value), 0))
+    except ValueError:
+        pass
+
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if timezone.is_naive(retry_time):
+        retry_time = timezone.make_aware(retry_time, timezone.utc)
+    return max(retry_time - timezone.now(), timedelta())
+
+
+async def run_in_executor(func, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args))
@@ -31,6 +31,32 @@ class MockSpotifyRequestHandler(BaseHTTPRequestHandler):
             self.wfile.write(response_content.encode('utf-8'))
 
 
+def create_flaky_spotify_request_handler(error_responses):
+    """Create a handler which responds with the error responses, each a
+    status and headers, before it responds like MockSpotifyRequestHandler.
+    The handler's requests attribute counts the requests it received."""
+    class FlakySpotifyRequestHandler(MockSpotifyRequestHandler):
+        responses = list(error_responses)
+        requests = 0
+
+        # pylint: disable=invalid-name
+        def do_POST(self):
+            handler_class = type(self)
+            handler_class.requests += 1
+            if not handler_class.responses:
+                super().do_POST()
+                return
+
+            status, headers = handler_class.responses.pop(0)
+            self.send_response(status.value)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    return FlakySpotifyRequestHandler
+
+
 def get_free_port():
     with closing(socket.socket(socket.AF_INET,
                                type=socket.SOCK_STREAM)) as sock:
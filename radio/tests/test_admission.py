@@ -0,0 +1,109 @@
+# Disable redefinition of outer name for pytest which uses this feature for
+# fixtures.
+# pylint: disable=redefined-outer-name
+
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from ..admission import JoinAdmission, JoinRejected
+
+
+@pytest.fixture
+def join_settings(settings):
+    settings.STATION_JOIN_MAX_CONCURRENCY = 1
+    settings.STATION_JOIN_MAX_QUEUED = 1
+    settings.STATION_JOIN_QUEUE_TIMEOUT = timedelta(milliseconds=100)
+    settings.STATION_JOIN_RETRY_AFTER = timedelta(seconds=5)
+    settings.STATION_JOIN_STATS_LOG_INTERVAL = timedelta(seconds=10)
+    return settings
+
+
+@pytest.mark.asyncio
+async def test_queued_join_is_admitted_when_slot_frees(join_settings):
+    join_admission = JoinAdmission()
+    joined = asyncio.Event()
+
+    async def join():
+        async with join_admission.admit():
+            joined.set()
+
+    async with join_admission.admit():
+        queued_join = asyncio.ensure_future(join())
+        await asyncio.sleep(0)
+        assert not joined.is_set()
+
+    await queued_join
+    assert joined.is_set()
+    assert join_admission.get_stats() == {
+        'queued': 1,
+        'admitted': 2,
+        'rejected': 0,
+        'waiting': 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_join_is_rejected_after_queue_timeout(join_settings):
+    join_admission = JoinAdmission()
+
+    async with join_admission.admit():
+        with pytest.raises(JoinRejected) as exc_info:
+            async with join_admission.admit():
+                pass
+
+    retry_after = exc_info.value.retry_after
+    assert timedelta(seconds=5) <= retry_after <= timedelta(seconds=10)
+    assert join_admission.get_stats()['rejected'] == 1
+
+    # The rejected join did not take the slot
+    async with join_admission.admit():
+        pass
+
+
+@pytest.mark.asyncio
+async def test_join_is_rejected_when_queue_is_full(join_settings):
+    join_settings.STATION_JOIN_QUEUE_TIMEOUT = timedelta(seconds=5)
+    join_admission = JoinAdmission()
+
+    async def join():
+        async with join_admission.admit():
+            pass
+
+    async with join_admission.admit():
+        queued_join = asyncio.ensure_future(join())
+        await asyncio.sleep(0)
+
+        with pytest.raises(JoinRejected):
+            async with join_admission.admit():
+                pass
+
+    await queued_join
+    assert join_admission.get_stats() == {
+        'queued': 1,
+        'admitted': 2,
+        'rejected': 1,
+        'waiting': 0,
+    }
+
+
+@pytest.mark.asyncio
+async def test_rejections_log_stats_at_most_every_interval(
+        join_settings, caplog):
+    join_admission = JoinAdmission()
+
+    async with join_admission.admit():
+        for _ in range(2):
+            with pytest.raises(JoinRejected):
+                async with join_admission.admit():
+                    pass
+
+    rejection_logs = [
+        record.getMessage() for record in caplog.records
+        if record.getMessage().startswith('Rejecting station joins')
+    ]
+    assert rejection_logs == [
+        'Rejecting station joins: '
+        "{'queued': 1, 'admitted': 1, 'rejected': 1, 'waiting': 1}"
+    ]
@@ -1,13 +1,20 @@
+from datetime import timedelta
 from http import HTTPStatus
+import json
+from unittest import mock
 
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from django.contrib import auth
 from django.test import override_settings
 from django.utils import timezone
 from rest_framework.test import APITestCase
 
 from accounts.models import User
+from .. import clock_sync, dj_lease, presence
 from ..api.serializers import StationSerializer
-from ..models import PlaybackState, SpotifyCredentials, Station
+from ..api.views import ListenerPagination
+from ..models import Listener, PlaybackState, SpotifyCredentials, Station
 from . import mocks, utils
 
 MOCK_USERNAME1 = 'MockUsername1'
@@ -61,6 +68,150 @@ class StationTests(APITestCase):
         assert PlaybackState.objects.get(
             station_id=station.id).raw_position_ms == 1
 
+    def test_updating_stations_notifies_listeners(self):
+        station = utils.create_station()
+        utils.create_listener(station, self.user1)
+        create_playback_state(station)
+
+        channel_layer = get_channel_layer()
+        channel_name = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)(station.group_name,
+                                               channel_name)
+
+        response = self.client.patch(f'/api/v1/stations/{station.id}/',
+                                     data={
+                                         'playbackstate': {
+                                             'raw_position_ms': 1,
+                                         },
+                                     },
+                                     format='json')
+        assert response.status_code == HTTPStatus.OK
+
+        event = async_to_sync(channel_layer.receive)(channel_name)
+        assert event['type'] == 'station.playback_state_changed'
+        frame = json.loads(event['text'])
+        assert frame['type'] == 'playback_state_changed'
+        assert without_server_times(
+            frame['playbackstate']) == without_server_times(
+                response.data['playbackstate'])
+
+    def test_stations_include_extrapolated_playback_position(self):
+        station = utils.create_station()
+        utils.create_listener(station, self.user1)
+        playback_state = create_playback_state(station)
+        playback_state.paused = False
+        playback_state.sample_time = timezone.now() - timedelta(seconds=10)
+        playback_state.save()
+
+        response = self.client.get(f'/api/v1/stations/{station.id}/')
+        assert response.status_code == HTTPStatus.OK
+
+        data = response.data['playbackstate']
+        server_time = clock_sync.to_datetime(data['server_time_us'])
+        assert data['position_ms'] == playback_state.position_ms_at(
+            server_time)
+        assert data['position_ms'] >= 10000
+
+        scheduled_seek = data['scheduled_seek']
+        assert scheduled_seek['apply_at_us'] > data['server_time_us']
+        assert (scheduled_seek['position_ms'] -
+                data['position_ms'] == (scheduled_seek['apply_at_us'] -
+                                        data['server_time_us']) // 1000)
+
+    def test_can_get_unchanged_stations_conditionally(self):
+        station = utils.create_station()
+        utils.create_listener(station, self.user1)
+        create_playback_state(station)
+
+        response = self.client.get(f'/api/v1/stations/{station.id}/')
+        assert response.status_code == HTTPStatus.OK
+        etag = response['ETag']
+
+        response = self.client.get(f'/api/v1/stations/{station.id}/',
+                                   HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == HTTPStatus.NOT_MODIFIED
+        assert response['ETag'] == etag
+
+        self.client.patch(f'/api/v1/stations/{station.id}/',
+                          data={'playbackstate': {
+                              'paused': False
+                          }},
+                          format='json')
+        response = self.client.get(f'/api/v1/stations/{station.id}/',
+                                   HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == HTTPStatus.OK
+        assert response['ETag'] != etag
+
+    def test_can_update_stations_conditionally(self):
+        station = utils.create_station()
+        utils.create_listener(station, self.user1)
+        create_playback_state(station)
+        etag = self.client.get(f'/api/v1/stations/{station.id}/')['ETag']
+
+        response = self.client.patch(f'/api/v1/stations/{station.id}/',
+                                     data={'playbackstate': {
+                                         'paused': False
+                                     }},
+                                     format='json',
+                                     HTTP_IF_MATCH=etag)
+        assert response.status_code == HTTPStatus.OK
+        assert response['ETag'] != etag
+
+        # The playback state has changed since etag was issued
+        response = self.client.patch(f'/api/v1/stations/{station.id}/',
+                                     data={'playbackstate': {
+                                         'paused': True
+                                     }},
+                                     format='json',
+                                     HTTP_IF_MATCH=etag)
+        assert response.status_code == HTTPStatus.PRECONDITION_FAILED
+        assert not PlaybackState.objects.get(station_id=station.id).paused
+
+    def test_cannot_update_stations_while_another_dj_holds_the_lease(self):
+        station = utils.create_station()
+        utils.create_listener(station, self.user1)
+        create_playback_state(station)
+        dj_lease.acquire_dj_lease(station.id, create_user2().id)
+
+        response = self.client.patch(f'/api/v1/stations/{station.id}/',
+                                     data={'playbackstate': {
+                                         'paused': False
+                                     }},
+                                     format='json')
+        assert response.status_code == HTTPStatus.CONFLICT
+        assert PlaybackState.objects.get(station_id=station.id).paused
+
+    def test_stale_dj_lease_is_released_on_conflict(self):
+        station = utils.create_station()
+        utils.create_listener(station, self.user1)
+        playback_state = create_playback_state(station)
+        lease = dj_lease.acquire_dj_lease(station.id, self.user1.id)
+        # Another DJ changed the playback state under a newer lease
+        playback_state.dj_lease_token = lease['token'] + 1
+        playback_state.save()
+
+        response = self.client.patch(f'/api/v1/stations/{station.id}/',
+                                     data={'playbackstate': {
+                                         'paused': False
+                                     }},
+                                     format='json')
+        assert response.status_code == HTTPStatus.CONFLICT
+        assert dj_lease.get_dj_lease(station.id) is None
+
+    def test_only_djs_can_update_station_playback_state(self):
+        station = utils.create_station()
+        utils.create_listener(station, self.user1, is_dj=False)
+        create_playback_state(station)
+
+        response = self.client.patch(f'/api/v1/stations/{station.id}/',
+                                     data={'playbackstate': {
+                                         'paused': False
+                                     }},
+                                     format='json')
+        assert response.status_code == HTTPStatus.FORBIDDEN
+        assert PlaybackState.objects.get(station_id=station.id).paused
+        assert dj_lease.get_dj_lease(station.id) is None
+
     def test_user_can_only_update_authorized_stations(self):
         station = utils.create_station()
         playback_state = create_playback_state(station)
@@ -142,6 +293,142 @@ class ListenerTests(APITestCase):
             f'/api/v1/stations/{self.station.id}/listeners/', data=data)
         assert response.status_code == HTTPStatus.BAD_REQUEST.value
 
+    def test_can_invite_listeners_in_bulk(self):
+        user2 = create_user2()
+        user3 = auth.get_user_model().objects.create_user(
+            username='MockUsername3')
+
+        data = {
+            'listeners': [
+                {
+                    'user': user2.username,
+                    'is_admin': True
+                },
+                {
+                    'user': user3.username,
+                    'is_dj': True
+                },
+                {
+                    'user': self.user1.username
+                },
+                {
+                    'user': 'NonexistentUsername'
+                },
+            ]
+        }
+        response = self.client.post(
+            f'/api/v1/stations/{self.station.id}/listeners/bulk/',
+            data=data,
+            format='json')
+        assert response.status_code == HTTPStatus.OK.value
+
+        results = response.data['results']
+        assert [(result['user'], result['status']) for result in results] == [
+            (user2.username, 'invited'),
+            (user3.username, 'invited'),
+            (self.user1.username, 'already_listener'),
+            ('NonexistentUsername', 'unknown_user'),
+        ]
+        assert results[0]['listener']['is_admin']
+        assert not results[0]['listener']['is_dj']
+        assert results[1]['listener']['is_dj']
+        assert results[2]['listener']['id'] == self.listener.id
+        assert results[3]['listener'] is None
+
+        listener2 = Listener.objects.get(station=self.station, user=user2)
+        assert listener2.id == results[0]['listener']['id']
+        assert Listener.objects.filter(station=self.station).count() == 3
+
+    def test_can_invite_listeners_in_bulk_in_constant_queries(self):
+        usernames = [f'BulkUsername{i}' for i in range(10)]
+        for username in usernames:
+            auth.get_user_model().objects.create_user(username=username)
+
+        data = {'listeners': [{'user': username} for username in usernames]}
+        # The session, the user, the admin check, the users, the existing
+        # listeners, the savepoint, the insert, the listeners and the release
+        with self.assertNumQueries(9):
+            response = self.client.post(
+                f'/api/v1/stations/{self.station.id}/listeners/bulk/',
+                data=data,
+                format='json')
+        assert response.status_code == HTTPStatus.OK.value
+        assert Listener.objects.filter(station=self.station).count() == 11
+
+    def test_cannot_invite_duplicate_listeners_in_bulk(self):
+        username2 = create_user2().username
+
+        data = {'listeners': [{'user': username2}, {'user': username2}]}
+        response = self.client.post(
+            f'/api/v1/stations/{self.station.id}/listeners/bulk/',
+            data=data,
+            format='json')
+        assert response.status_code == HTTPStatus.BAD_REQUEST.value
+        assert not Listener.objects.filter(user__username=username2).exists()
+
+    def test_can_only_invite_listeners_in_bulk_if_authorized(self):
+        station2 = utils.create_station()
+        username2 = create_user2().username
+        data = {'listeners': [{'user': username2}]}
+
+        # user1 is not a listener of station2
+        response = self.client.post(
+            f'/api/v1/stations/{station2.id}/listeners/bulk/',
+            data=data,
+            format='json')
+        assert response.status_code == HTTPStatus.NOT_FOUND.value
+
+        # user1 is not an admin of station2
+        utils.create_listener(station2, self.user1, is_admin=False)
+        response = self.client.post(
+            f'/api/v1/stations/{station2.id}/listeners/bulk/',
+            data=data,
+            format='json')
+        assert response.status_code == HTTPStatus.FORBIDDEN.value
+        assert not Listener.objects.filter(user__username=username2).exists()
+
+    def test_can_remove_listeners_in_bulk(self):
+        user2 = create_user2()
+        utils.create_listener(self.station, user2)
+        station2 = utils.create_station()
+        listener2_station2 = utils.create_listener(station2, user2)
+
+        data = {'users': [user2.username, 'NonexistentUsername']}
+        response = self.client.delete(
+            f'/api/v1/stations/{self.station.id}/listeners/bulk/',
+            data=data,
+            format='json')
+        assert response.status_code == HTTPStatus.OK.value
+        assert response.data['results'] == [
+            {
+                'user': user2.username,
+                'status': 'removed'
+            },
+            {
+                'user': 'NonexistentUsername',
+                'status': 'not_listener'
+            },
+        ]
+
+        assert not Listener.objects.filter(station=self.station,
+                                           user=user2).exists()
+        # Only the station's listeners are removed
+        assert Listener.objects.filter(id=listener2_station2.id).exists()
+
+    def test_can_only_remove_listeners_in_bulk_if_authorized(self):
+        station2 = utils.create_station()
+        user2 = create_user2()
+        utils.create_listener(station2, user2)
+        utils.create_listener(station2, self.user1, is_admin=False)
+
+        data = {'users': [user2.username]}
+        response = self.client.delete(
+            f'/api/v1/stations/{station2.id}/listeners/bulk/',
+            data=data,
+            format='json')
+        assert response.status_code == HTTPStatus.FORBIDDEN.value
+        assert Listener.objects.filter(station=station2, user=user2).exists()
+
     def test_can_get_listeners(self):
         user2 = create_user2()
         listener2 = utils.create_listener(self.station,
@@ -158,22 +445,100 @@ class ListenerTests(APITestCase):
                 'user': MOCK_USERNAME1,
                 'station': self.station.id,
                 'is_admin': True,
-                'is_dj': True
+                'is_dj': True,
+                'clock_sync': None,
             },
             listener2.id: {
                 'id': listener2.id,
                 'user': user2.username,
                 'station': self.station.id,
                 'is_admin': False,
-                'is_dj': True
+                'is_dj': True,
+                'clock_sync': None,
             }
         }
         actual_data = {
             listener['id']: dict(listener)
-            for listener in response.data
+            for listener in response.data['results']
         }
         assert actual_data == data
 
+    def test_can_get_listener_clock_syncs(self):
+        clock_sync.save_clock_sync(self.station.id,
+                                   self.user1.id,
+                                   rtt_us=20000,
+                                   offset_us=-1500,
+                                   sample_count=8)
+
+        response = self.client.get(
+            f'/api/v1/stations/{self.station.id}/listeners/')
+        assert response.status_code == HTTPStatus.OK.value
+
+        listener_clock_sync = response.data['results'][0]['clock_sync']
+        assert listener_clock_sync['rtt_us'] == 20000
+        assert listener_clock_sync['offset_us'] == -1500
+        assert listener_clock_sync['sample_count'] == 8
+
+    def test_can_get_listeners_in_pages(self):
+        for i in range(3):
+            user = auth.get_user_model().objects.create_user(
+                username=f'PagedUsername{i}')
+            utils.create_listener(self.station, user)
+
+        usernames = []
+        url = f'/api/v1/stations/{self.station.id}/listeners/'
+        with mock.patch.object(ListenerPagination, 'page_size', 2):
+            while url:
+                response = self.client.get(url)
+                assert response.status_code == HTTPStatus.OK.value
+                assert len(response.data['results']) <= 2
+                usernames += [
+                    listener['user'] for listener in response.data['results']
+                ]
+                url = response.data['next']
+
+        assert usernames == [
+            MOCK_USERNAME1, 'PagedUsername0', 'PagedUsername1',
+            'PagedUsername2'
+        ]
+
+    def test_can_filter_listeners(self):
+        user2 = create_user2()
+        utils.create_listener(self.station, user2, is_admin=False, is_dj=True)
+
+        def get_usernames(query):
+            response = self.client.get(
+                f'/api/v1/stations/{self.station.id}/listeners/?{query}')
+            assert response.status_code == HTTPStatus.OK.value
+            return [listener['user'] for listener in response.data['results']]
+
+        assert get_usernames('is_admin=true') == [MOCK_USERNAME1]
+        assert get_usernames('is_admin=false') == [MOCK_USERNAME2]
+        assert get_usernames('is_dj=true') == [MOCK_USERNAME1, MOCK_USERNAME2]
+        assert get_usernames('is_admin=false&is_dj=true') == [MOCK_USERNAME2]
+        assert get_usernames('username=MockUsername2') == [MOCK_USERNAME2]
+        assert get_usernames('username=MockUser') == [
+            MOCK_USERNAME1, MOCK_USERNAME2
+        ]
+        assert get_usernames('username=Username') == []
+
+    def test_cannot_filter_listeners_by_invalid_role(self):
+        response = self.client.get(
+            f'/api/v1/stations/{self.station.id}/listeners/?is_dj=maybe')
+        assert response.status_code == HTTPStatus.BAD_REQUEST.value
+
+    def test_can_get_listeners_in_constant_queries(self):
+        for i in range(5):
+            user = auth.get_user_model().objects.create_user(
+                username=f'ManyUsername{i}')
+            utils.create_listener(self.station, user)
+
+        # The session, the user, the admin check and the listeners
+        with self.assertNumQueries(4):
+            response = self.client.get(
+                f'/api/v1/stations/{self.station.id}/listeners/')
+        assert len(response.data['results']) == 6
+
     def test_can_only_get_listeners_if_authorized(self):
         station2 = utils.create_station()
 
@@ -213,6 +578,65 @@ class ListenerTests(APITestCase):
         assert response.status_code == HTTPStatus.FORBIDDEN.value
 
 
+class PresenceTests(APITestCase):
+    def setUp(self):
+        password = 'testpassword'
+        self.user1 = create_user1(password)
+        assert self.client.login(username=self.user1.username,
+                                 password=password)
+
+        self.station = utils.create_station()
+        utils.create_listener(self.station, self.user1, is_admin=True)
+
+    def tearDown(self):
+        self.client.logout()
+        auth.get_user_model().objects.all().delete()
+
+    def test_can_get_presence(self):
+        user2 = create_user2()
+        station_presence = presence.get_presence()
+        station_presence.join(self.station.id, self.user1.id)
+        station_presence.join(self.station.id, user2.id)
+        station_presence.join(self.station.id, user2.id)
+
+        response = self.client.get(
+            f'/api/v1/stations/{self.station.id}/presence/?limit=1')
+        assert response.status_code == HTTPStatus.OK.value
+        assert response.data['count'] == 2
+        assert response.data['next'] is not None
+
+        user_presence = response.data['results'][0]
+        assert user_presence['user_id'] == user2.id
+        assert user_presence['username'] == user2.username
+        assert user_presence['connections'] == 2
+
+    def test_stale_presence_is_reaped(self):
+        station_presence = presence.get_presence()
+        station_presence.join(self.station.id, self.user1.id)
+
+        with self.settings(PRESENCE_STALE_AFTER=timedelta()):
+            response = self.client.get(
+                f'/api/v1/stations/{self.station.id}/presence/')
+        assert response.status_code == HTTPStatus.OK.value
+        assert response.data['count'] == 0
+
+    def test_can_only_get_presence_if_authorized(self):
+        station2 = utils.create_station()
+
+        # user1 is not a listener of station2
+        response = self.client.get(f'/api/v1/stations/{station2.id}/presence/')
+        assert response.status_code == HTTPStatus.NOT_FOUND.value
+
+        # user1 is not an admin of station2
+        utils.create_listener(station2, self.user1, is_admin=False)
+        response = self.client.get(f'/api/v1/stations/{station2.id}/presence/')
+        assert response.status_code == HTTPStatus.FORBIDDEN.value
+
+    def test_presence_of_invalid_station_is_not_found(self):
+        response = self.client.get('/api/v1/stations/invalid/presence/')
+        assert response.status_code == HTTPStatus.NOT_FOUND.value
+
+
 class AccessTokenTests(APITestCase):
     def setUp(self):
         password = 'testpassword'
@@ -272,3 +696,11 @@ def create_playback_state(station: Station,
     station_state.sample_time = timezone.now()
     station_state.save()
     return station_state
+
+
+def without_server_times(playbackstate_data):
+    return {
+        field: value
+        for field, value in playbackstate_data.items()
+        if field not in ('server_time_us', 'position_ms', 'scheduled_seek')
+    }
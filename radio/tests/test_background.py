@@ -0,0 +1,35 @@
+import asyncio
+import logging
+
+import pytest
+
+from ..background import run_in_background
+
+
+@pytest.mark.asyncio
+async def test_background_task_failures_are_logged(caplog):
+    async def fail():
+        raise RuntimeError('MockFailure')
+
+    task = run_in_background(fail(), 'Failing')
+    await asyncio.wait([task])
+    # Done callbacks run on the next iteration of the event loop
+    await asyncio.sleep(0)
+
+    records = [
+        record for record in caplog.records if record.levelno == logging.ERROR
+    ]
+    assert [record.getMessage() for record in records] == ['Failing failed']
+    assert isinstance(records[0].exc_info[1], RuntimeError)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_background_tasks_are_not_logged(caplog):
+    task = run_in_background(asyncio.sleep(60), 'Sleeping')
+    task.cancel()
+    await asyncio.wait([task])
+    await asyncio.sleep(0)
+
+    assert not [
+        record for record in caplog.records if record.levelno == logging.ERROR
+    ]
@@ -2,7 +2,9 @@
 # fixtures.
 # pylint: disable=redefined-outer-name
 
+import asyncio
 from contextlib import asynccontextmanager
+from datetime import timedelta
 
 from channels.db import database_sync_to_async
 from channels.routing import URLRouter
@@ -14,24 +16,25 @@ from django.utils import timezone
 import pytest
 
 from accounts.models import User
-from .. import consumers
+from .. import clock_sync, consumers, presence
+from ..admission import RETRY_AFTER_CLOSE_CODE
 from ..api.serializers import PlaybackStateSerializer
 from ..consumers import StationConsumer
 from ..models import Listener, PlaybackState, Station
 
 MOCK_CONTEXT_URI1 = 'MockContextUri1'
 MOCK_CONTEXT_URI2 = 'MockContextUri2'
+MOCK_TRACK_URI1 = 'MockTrackUri1'
 NON_USER_EMAIL = 'nonuser@example.com'
 
 
-@pytest.mark.skip(
-    reason='Authentication does not work with StationCommunicator')
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio
 async def test_ping_pong(user1, station1):
     await create_listener(user1, station1)
 
-    async with disconnecting(StationCommunicator(station1.id)) as communicator:
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as communicator:
         start_time = timezone.now().isoformat()
         await communicator.ping(start_time)
 
@@ -41,19 +44,161 @@ async def test_ping_pong(user1, station1):
         assert dateutil.parser.isoparse(response['server_time'])
 
 
-@pytest.mark.skip(reason='Test bug: deserialization not working')
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio
-async def test_playback_state_changed_notifications(user1: User,
+async def test_time_sync(user1: User, station1: Station):
+    await create_listener(user1, station1)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as communicator:
+        await communicator.send_json_to({'command': 'time_sync', 'samples': 3})
+
+        # The client's clock is a minute ahead of the server's
+        client_clock_offset_us = 60 * 1000 * 1000
+        for sample_id in range(3):
+            response = await communicator.receive_json_from()
+            assert response['type'] == 'time_sync_ping'
+            assert response['sample_id'] == sample_id
+
+            client_time_us = clock_sync.now_us() + client_clock_offset_us
+            await communicator.time_sync_pong(sample_id, client_time_us,
+                                              client_time_us)
+
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'time_sync_result'
+        assert response['rtt_us'] >= 0
+        assert abs(response['offset_us'] +
+                   client_clock_offset_us) <= response['rtt_us']
+
+    saved_clock_sync = await get_clock_sync(station1, user1)
+    assert saved_clock_sync['offset_us'] == response['offset_us']
+    assert saved_clock_sync['sample_count'] == 3
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_time_sync_rejects_non_integer_fields(user1: User,
+                                                    station1: Station):
+    await create_listener(user1, station1)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as communicator:
+        await communicator.send_json_to({
+            'command': 'time_sync',
+            'samples': 'many'
+        })
+        response = await communicator.receive_json_from()
+        assert response['error'] == 'bad_request'
+
+        await communicator.send_json_to({'command': 'time_sync', 'samples': 1})
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'time_sync_ping'
+
+        await communicator.send_json_to({
+            'command': 'time_sync_pong',
+            'sample_id': response['sample_id'],
+            'client_receive_us': [1],
+            'client_transmit_us': 1,
+        })
+        response = await communicator.receive_json_from()
+        assert response['error'] == 'bad_request'
+
+        # The consumer is still serving requests
+        await communicator.ping(timezone.now().isoformat())
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'pong'
+
+
+def test_clock_sync_sample():
+    # Client clock 1000us behind, 100us each way and 50us in the client
+    rtt_us, offset_us = clock_sync.get_sample(server_transmit_us=10000,
+                                              client_receive_us=9100,
+                                              client_transmit_us=9150,
+                                              server_receive_us=10250)
+    assert rtt_us == 200
+    assert offset_us == 1000
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_join_sends_playback_state(user1: User, station1: Station):
+    await create_listener(user1, station1)
+    await create_playback_state(station1)
+
+    communicator = StationCommunicator(station1.id, user1)
+    try:
+        connected, _ = await communicator.connect()
+        assert connected
+
+        response = await communicator.receive_json_from()
+        assert response['join'] == station1.title
+        assert response['playbackstate']['context_uri'] == MOCK_CONTEXT_URI1
+        assert response['playbackstate']['etag'] == '"0"'
+    finally:
+        await communicator.disconnect()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_join_is_rejected_with_retry_after(settings, user1: User,
+                                                 station1: Station):
+    settings.STATION_JOIN_MAX_CONCURRENCY = 0
+    settings.STATION_JOIN_MAX_QUEUED = 0
+    await create_listener(user1, station1)
+
+    communicator = StationCommunicator(station1.id, user1)
+    try:
+        connected, _ = await communicator.connect()
+        assert connected
+
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'retry_after'
+        assert response['retry_after_ms'] >= 5000
+
+        output = await communicator.receive_output()
+        assert output == {
+            'type': 'websocket.close',
+            'code': RETRY_AFTER_CLOSE_CODE,
+        }
+    finally:
+        await communicator.disconnect()
+
+
+@pytest.mark.django_db
+def test_join_fetches_listener_station_and_playback_state_at_once(
+        django_assert_num_queries, user1: User, station1: Station):
+    Listener.objects.create(user=user1,
+                            station=station1,
+                            is_admin=False,
+                            is_dj=False)
+    PlaybackState.objects.create(station=station1,
+                                 context_uri=MOCK_CONTEXT_URI1,
+                                 current_track_uri=MOCK_TRACK_URI1,
+                                 paused=True,
+                                 raw_position_ms=0,
+                                 sample_time=timezone.now())
+
+    with django_assert_num_queries(1):
+        # Call the wrapped function to count queries in this thread
+        listener = consumers.get_listener_or_error.func(station1.id, user1)
+        assert listener.station.title == station1.title
+        assert listener.station.playbackstate.context_uri == MOCK_CONTEXT_URI1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_playback_state_changed_notifications(user1: User, user2: User,
                                                     station1: Station):
     await create_listener(user1, station1, is_dj=False)
-    playback_state = await create_playback_state(station1)
+    await create_listener(user2, station1, is_dj=True)
+    await create_playback_state(station1)
 
     async with disconnecting(StationCommunicator(
-            station1.id)) as listener_communicator:
+            station1.id, user1)) as listener_communicator, disconnecting(
+                StationCommunicator(station1.id, user2)) as dj_communicator:
         # The DJ changes the playback state
-        playback_state.context_uri = MOCK_CONTEXT_URI2
-        await consumers.save_station_playback_state(playback_state)
+        await dj_communicator.player_state_change(
+            1, build_state(context_uri=MOCK_CONTEXT_URI2))
 
         response = await listener_communicator.receive_json_from()
         assert response['type'] == 'playback_state_changed'
@@ -63,24 +208,319 @@ async def test_playback_state_changed_notifications(user1: User,
         assert response_playback_state.is_valid()
 
 
-@pytest.mark.skip(
-    reason='Authentication does not work with StationCommunicator')
 @pytest.mark.django_db(transaction=True)
 @pytest.mark.asyncio
-async def test_dj_leaves_station(user1: User, station1: Station):
+async def test_playback_state_changed_notifications_are_station_scoped(
+        user1: User, user2: User, station1: Station, station2: Station):
+    await create_listener(user1, station1, is_dj=False)
+    await create_listener(user2, station2, is_dj=True)
+    await create_playback_state(station2)
+
+    async with disconnecting(StationCommunicator(
+            station1.id, user1)) as listener_communicator, disconnecting(
+                StationCommunicator(station2.id, user2)) as dj_communicator:
+        # Another station's DJ changes their playback state
+        await dj_communicator.player_state_change(
+            1, build_state(context_uri=MOCK_CONTEXT_URI2))
+        response = await dj_communicator.receive_json_from()
+        assert response['state']['context_uri'] == MOCK_CONTEXT_URI2
+
+        assert await listener_communicator.receive_nothing()
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_dj_changes_playback_state(user1: User, user2: User,
+                                         station1: Station):
+    await create_listener(user1, station1, is_dj=True)
+    await create_listener(user2, station1, is_dj=False)
+    await create_playback_state(station1)
+
+    async with disconnecting(StationCommunicator(
+            station1.id, user1)) as dj_communicator, disconnecting(
+                StationCommunicator(station1.id,
+                                    user2)) as listener_communicator:
+        await dj_communicator.player_state_change(
+            1, build_state(context_uri=MOCK_CONTEXT_URI2))
+
+        response = await dj_communicator.receive_json_from()
+        assert response['type'] == 'ensure_playback_state'
+        assert response['request_id'] == 1
+        assert response['state']['context_uri'] == MOCK_CONTEXT_URI2
+        assert response['state']['etag'] == '"1"'
+
+        response = await listener_communicator.receive_json_from()
+        assert response['type'] == 'playback_state_changed'
+        assert response['playbackstate']['context_uri'] == MOCK_CONTEXT_URI2
+
+    new_playback_state = await get_playback_state(station1)
+    assert new_playback_state.context_uri == MOCK_CONTEXT_URI2
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_dj_playback_state_change_with_stale_etag(
+        user1: User, station1: Station):
+    await create_listener(user1, station1, is_dj=True)
+    await create_playback_state(station1)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as communicator:
+        await communicator.player_state_change(
+            1, build_state(context_uri=MOCK_CONTEXT_URI2), etag='"5"')
+
+        # The DJ is told the current state instead
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'ensure_playback_state'
+        assert response['request_id'] == 1
+        assert response['state']['context_uri'] == MOCK_CONTEXT_URI1
+        assert response['state']['etag'] == '"0"'
+
+    new_playback_state = await get_playback_state(station1)
+    assert new_playback_state.context_uri == MOCK_CONTEXT_URI1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_only_the_dj_lease_holder_changes_playback_state(
+        user1: User, user2: User, station1: Station):
+    await create_listener(user1, station1, is_dj=True)
+    await create_listener(user2, station1, is_dj=True)
+    await create_playback_state(station1)
+
+    async with disconnecting(StationCommunicator(
+            station1.id, user1)) as dj_communicator1, disconnecting(
+                StationCommunicator(station1.id, user2)) as dj_communicator2:
+        await dj_communicator1.player_state_change(
+            1, build_state(context_uri=MOCK_CONTEXT_URI2))
+        response = await dj_communicator1.receive_json_from()
+        assert response['state']['context_uri'] == MOCK_CONTEXT_URI2
+
+        # The other DJ follows the lease holder's changes
+        response = await dj_communicator2.receive_json_from()
+        assert response['type'] == 'playback_state_changed'
+        assert response['playbackstate']['context_uri'] == MOCK_CONTEXT_URI2
+
+        # and is told the lease holder's state instead of changing it
+        await dj_communicator2.player_state_change(
+            1, build_state(context_uri=MOCK_CONTEXT_URI1))
+        response = await dj_communicator2.receive_json_from()
+        assert response['type'] == 'ensure_playback_state'
+        assert response['state']['context_uri'] == MOCK_CONTEXT_URI2
+
+        assert await dj_communicator1.receive_nothing()
+
+    new_playback_state = await get_playback_state(station1)
+    assert new_playback_state.context_uri == MOCK_CONTEXT_URI2
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_listener_cannot_change_playback_state(user1: User,
+                                                     station1: Station):
+    await create_listener(user1, station1, is_dj=False)
+    await create_playback_state(station1)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as communicator:
+        await communicator.player_state_change(
+            1, build_state(context_uri=MOCK_CONTEXT_URI2))
+
+        response = await communicator.receive_json_from()
+        assert response['error'] == 'forbidden'
+
+    new_playback_state = await get_playback_state(station1)
+    assert new_playback_state.context_uri == MOCK_CONTEXT_URI1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_player_state_change_rejects_malformed_fields(
+        user1: User, station1: Station):
+    await create_listener(user1, station1, is_dj=True)
+    await create_playback_state(station1)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as communicator:
+        await communicator.send_json_to({
+            'command':
+            'player_state_change',
+            'state':
+            build_state(context_uri=MOCK_CONTEXT_URI2),
+        })
+        response = await communicator.receive_json_from()
+        assert response['error'] == 'bad_request'
+
+        await communicator.send_json_to({
+            'command': 'player_state_change',
+            'request_id': 1,
+        })
+        response = await communicator.receive_json_from()
+        assert response['error'] == 'bad_request'
+
+        await communicator.player_state_change(
+            1, build_state(context_uri=MOCK_CONTEXT_URI2), etag=1)
+        response = await communicator.receive_json_from()
+        assert response['error'] == 'bad_request'
+
+        # The consumer is still serving requests
+        await communicator.ping(timezone.now().isoformat())
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'pong'
+
+    new_playback_state = await get_playback_state(station1)
+    assert new_playback_state.context_uri == MOCK_CONTEXT_URI1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_admins_are_sent_listener_change_batches(settings, user1: User,
+                                                       user2: User,
+                                                       station1: Station):
+    settings.LISTENER_CHANGE_BATCH_WINDOW = timedelta(milliseconds=50)
+    await create_listener(user1, station1, is_admin=True)
+    await create_listener(user2, station1)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as admin_communicator:
+        async with disconnecting(StationCommunicator(station1.id, user2)):
+            response = await admin_communicator.receive_json_from()
+            assert response == {
+                'type': 'listener_change_batch',
+                'joined': [{
+                    'username': user2.username,
+                    'email': user2.email,
+                }],
+                'left': [],
+            }
+
+        response = await admin_communicator.receive_json_from()
+        assert response == {
+            'type': 'listener_change_batch',
+            'joined': [],
+            'left': [{
+                'username': user2.username,
+                'email': user2.email,
+            }],
+        }
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_listener_reconnects_are_not_sent_to_admins(
+        settings, user1: User, user2: User, station1: Station):
+    settings.LISTENER_CHANGE_BATCH_WINDOW = timedelta(milliseconds=200)
+    await create_listener(user1, station1, is_admin=True)
+    await create_listener(user2, station1)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as admin_communicator:
+        # Let the admin's own join be published
+        assert await admin_communicator.receive_nothing(timeout=0.3)
+
+        async with disconnecting(StationCommunicator(station1.id, user2)):
+            pass
+
+        assert await admin_communicator.receive_nothing(timeout=0.3)
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_admins_are_sent_roster_snapshots(settings, user1: User,
+                                                user2: User,
+                                                station1: Station):
+    settings.LISTENER_CHANGE_BATCH_WINDOW = timedelta(seconds=10)
+    settings.LISTENER_ROSTER_SNAPSHOT_INTERVAL = timedelta(milliseconds=50)
+    await create_listener(user1, station1, is_admin=True)
+    await create_listener(user2, station1)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as communicator:
+        response = await communicator.receive_json_from()
+        assert response['type'] == 'listener_roster'
+        assert sorted(listener['username']
+                      for listener in response['listeners']) == sorted(
+                          [user1.username, user2.username])
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_listener_presence(user1: User, station1: Station):
+    await create_listener(user1, station1)
+    station_presence = presence.get_presence()
+
+    async with disconnecting(StationCommunicator(station1.id, user1)):
+        async with disconnecting(StationCommunicator(station1.id, user1)):
+            users = station_presence.get_users(station1.id, 0, 1)
+            assert [(user['user_id'], user['connections'])
+                    for user in users] == [(user1.id, 2)]
+
+        assert station_presence.count(station1.id) == 1
+
+    assert station_presence.count(station1.id) == 0
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_dj_leaves_station(settings, user1: User, station1: Station):
+    settings.DJ_RECONNECT_GRACE_PERIOD = timedelta()
     await create_listener(user1, station1, is_dj=True)
 
     # precondition: station playback state exists and is playing
     await create_playback_state(station1, paused=False)
 
-    async with disconnecting(StationCommunicator(
-            station1.id)) as _communicator:
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user1)) as _communicator:
         pass
 
     new_playback_state = await get_playback_state(station1)
     assert new_playback_state.paused
 
 
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_station_is_paused_after_dj_grace_period(settings, user1: User,
+                                                       user2: User,
+                                                       station1: Station):
+    settings.DJ_RECONNECT_GRACE_PERIOD = timedelta(milliseconds=100)
+    await create_listener(user1, station1, is_dj=True)
+    await create_listener(user2, station1)
+    await create_playback_state(station1, paused=False)
+
+    async with disconnecting(StationCommunicator(station1.id,
+                                                 user2)) as communicator:
+        async with disconnecting(StationCommunicator(station1.id, user1)):
+            pass
+
+        assert not (await get_playback_state(station1)).paused
+
+        response = await communicator.receive_json_from(timeout=1)
+        assert response['type'] == 'playback_state_changed'
+        assert response['playbackstate']['paused']
+
+    new_playback_state = await get_playback_state(station1)
+    assert new_playback_state.paused
+    assert new_playback_state.version == 1
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_dj_reconnecting_within_grace_period_keeps_playing(
+        settings, user1: User, station1: Station):
+    settings.DJ_RECONNECT_GRACE_PERIOD = timedelta(milliseconds=100)
+    await create_listener(user1, station1, is_dj=True)
+    await create_playback_state(station1, paused=False)
+
+    async with disconnecting(StationCommunicator(station1.id, user1)):
+        pass
+
+    async with disconnecting(StationCommunicator(station1.id, user1)):
+        await asyncio.sleep(0.2)
+
+        new_playback_state = await get_playback_state(station1)
+        assert not new_playback_state.paused
+
+
 # Fixtures
 
 
@@ -101,6 +541,11 @@ def station1() -> Station:
     return Station.objects.create(title='TestStation1')
 
 
+@pytest.fixture
+def station2() -> Station:
+    return Station.objects.create(title='TestStation2')
+
+
 # Utils
 
 
@@ -119,6 +564,9 @@ def create_listener(user: User,
 @database_sync_to_async
 def create_playback_state(station: Station, **kwargs):
     station_state = PlaybackState(station=station)
+    station_state.context_uri = kwargs.get('context_uri', MOCK_CONTEXT_URI1)
+    station_state.current_track_uri = kwargs.get('current_track_uri',
+                                                 MOCK_TRACK_URI1)
     station_state.paused = kwargs.get('paused', True)
     station_state.raw_position_ms = kwargs.get('raw_position_ms', 0)
     station_state.sample_time = timezone.now()
@@ -126,11 +574,26 @@ def create_playback_state(station: Station, **kwargs):
     return station_state
 
 
+@database_sync_to_async
+def get_clock_sync(station: Station, user: User):
+    return clock_sync.get_clock_sync(station.id, user.id)
+
+
 @database_sync_to_async
 def get_playback_state(station: Station):
     return PlaybackState.objects.get(station=station)
 
 
+def build_state(**kwargs):
+    return {
+        'context_uri': kwargs.get('context_uri', MOCK_CONTEXT_URI1),
+        'current_track_uri': kwargs.get('current_track_uri', MOCK_TRACK_URI1),
+        'paused': kwargs.get('paused', True),
+        'raw_position_ms': kwargs.get('raw_position_ms', 0),
+        'sample_time': timezone.now().isoformat(),
+    }
+
+
 def assert_client_server_states_are_equal(client_state, server_state):
     assert client_state.context_uri == server_state.context_uri
     assert client_state.current_track_uri == server_state.current_track_uri
@@ -143,21 +606,43 @@ async def disconnecting(communicator: WebsocketCommunicator):
     try:
         connected, _ = await communicator.connect()
         assert connected
+        response = await communicator.receive_json_from()
+        assert 'join' in response
         yield communicator
     finally:
         await communicator.disconnect()
 
 
 class StationCommunicator(WebsocketCommunicator):
-    def __init__(self, station_id: int):
+    def __init__(self, station_id: int, user: User):
         application = URLRouter([
             path('api/stations/<int:station_id>/stream/', StationConsumer),
         ])
         url = f'/api/stations/{station_id}/stream/'
         super().__init__(application, url)
+        self.scope['user'] = user
 
     async def ping(self, start_time: str):
         await self.send_json_to({
             'command': 'ping',
             'start_time': start_time,
         })
+
+    async def time_sync_pong(self, sample_id: int, client_receive_us: int,
+                             client_transmit_us: int):
+        await self.send_json_to({
+            'command': 'time_sync_pong',
+            'sample_id': sample_id,
+            'client_receive_us': client_receive_us,
+            'client_transmit_us': client_transmit_us,
+        })
+
+    async def player_state_change(self, request_id: int, state, etag=None):
+        content = {
+            'command': 'player_state_change',
+            'request_id': request_id,
+            'state': state,
+        }
+        if etag is not None:
+            content['etag'] = etag
+        await self.send_json_to(content)
@@ -0,0 +1,91 @@
+from datetime import timedelta
+import threading
+import time
+from unittest import mock
+
+from django.core.cache import cache
+import pytest
+
+from ..dj_lease import (acquire_dj_lease, get_dj_lease, get_dj_lease_cache_key,
+                        release_dj_lease)
+from ..exceptions import DjLeaseHeld
+
+STATION_ID = 1
+USER_ID1 = 1
+USER_ID2 = 2
+
+
+def test_dj_lease_is_renewed_by_its_holder():
+    lease = acquire_dj_lease(STATION_ID, USER_ID1)
+    assert lease['holder_id'] == USER_ID1
+
+    renewed_lease = acquire_dj_lease(STATION_ID, USER_ID1)
+    assert renewed_lease['token'] == lease['token']
+    assert renewed_lease['expiration_time'] >= lease['expiration_time']
+    assert get_dj_lease(STATION_ID) == renewed_lease
+
+
+def test_dj_lease_cannot_be_acquired_while_held():
+    lease = acquire_dj_lease(STATION_ID, USER_ID1)
+
+    with pytest.raises(DjLeaseHeld) as exc_info:
+        acquire_dj_lease(STATION_ID, USER_ID2)
+    assert exc_info.value.lease == lease
+
+
+def test_expired_dj_lease_is_acquired_with_a_greater_token(settings):
+    settings.DJ_LEASE_DURATION = timedelta(milliseconds=50)
+    lease = acquire_dj_lease(STATION_ID, USER_ID1)
+
+    time.sleep(0.1)
+    new_lease = acquire_dj_lease(STATION_ID, USER_ID2)
+    assert new_lease['holder_id'] == USER_ID2
+    assert new_lease['token'] > lease['token']
+
+
+def test_dj_lease_renewal_does_not_overwrite_a_new_holder():
+    acquire_dj_lease(STATION_ID, USER_ID1)
+    new_leases = []
+    acquire_dj_lease2 = threading.Thread(
+        target=lambda: new_leases.append(try_acquire_dj_lease(USER_ID2)))
+
+    def get(key, *args, **kwargs):
+        value = cache_get(key, *args, **kwargs)
+        if key == get_dj_lease_cache_key(STATION_ID):
+            # The lease expires and another DJ acquires it while the holder
+            # renews it
+            cache.delete(key)
+            acquire_dj_lease2.start()
+            acquire_dj_lease2.join(0.1)
+        return value
+
+    cache_get = cache.get
+    with mock.patch.object(cache, 'get', get):
+        renewed_lease = try_acquire_dj_lease(USER_ID1)
+    acquire_dj_lease2.join()
+
+    leases = [lease for lease in [renewed_lease] + new_leases if lease]
+    assert leases == [get_dj_lease(STATION_ID)]
+
+
+def test_dj_lease_is_only_released_by_its_holder(settings):
+    settings.DJ_LEASE_DURATION = timedelta(milliseconds=50)
+    lease = acquire_dj_lease(STATION_ID, USER_ID1)
+
+    time.sleep(0.1)
+    new_lease = acquire_dj_lease(STATION_ID, USER_ID2)
+    release_dj_lease(STATION_ID, lease)
+    assert get_dj_lease(STATION_ID) == new_lease
+
+    release_dj_lease(STATION_ID, new_lease)
+    assert get_dj_lease(STATION_ID) is None
+
+
+# Utils
+
+
+def try_acquire_dj_lease(user_id):
+    try:
+        return acquire_dj_lease(STATION_ID, user_id)
+    except DjLeaseHeld:
+        return None
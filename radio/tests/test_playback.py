@@ -0,0 +1,314 @@
+# Disable redefinition of outer name for pytest which uses this feature for
+# fixtures.
+# pylint: disable=redefined-outer-name
+
+import copy
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import override_settings
+from django.utils import timezone
+import pytest
+
+from .. import playback
+from ..exceptions import PlaybackStateConflict, StaleDjLease
+from ..models import PlaybackState, Station
+
+MOCK_CONTEXT_URI1 = 'MockContextUri1'
+MOCK_CONTEXT_URI2 = 'MockContextUri2'
+MOCK_TRACK_URI1 = 'MockTrackUri1'
+
+
+@pytest.mark.django_db(transaction=True)
+def test_playback_state_is_read_from_cache(station1: Station,
+                                           django_assert_num_queries):
+    create_playback_state(station1)
+    playback.get_playback_state(station1.id)
+
+    with django_assert_num_queries(0):
+        playback_state = playback.get_playback_state(station1.id)
+    assert playback_state.context_uri == MOCK_CONTEXT_URI1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_missing_playback_state_is_cached(station1: Station,
+                                          django_assert_num_queries):
+    assert playback.get_playback_state(station1.id) is None
+
+    with django_assert_num_queries(0):
+        assert playback.get_playback_state(station1.id) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_save_playback_state_writes_through(station1: Station,
+                                            django_assert_num_queries):
+    playback_state = create_playback_state(station1)
+    playback.get_playback_state(station1.id)
+
+    playback_state.context_uri = MOCK_CONTEXT_URI2
+    playback.save_playback_state(playback_state)
+
+    with django_assert_num_queries(0):
+        cached_playback_state = playback.get_playback_state(station1.id)
+    assert cached_playback_state.context_uri == MOCK_CONTEXT_URI2
+    assert PlaybackState.objects.get(
+        station=station1).context_uri == MOCK_CONTEXT_URI2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_stale_cache_fill_is_not_served(station1: Station):
+    playback_state = create_playback_state(station1)
+
+    # A reader loads the playback state from the database...
+    stale_version = playback.get_cache_version(station1.id)
+    stale_entry = playback.build_cache_entry(
+        PlaybackState.objects.get(station=station1))
+
+    # ...while a writer updates it...
+    playback_state.context_uri = MOCK_CONTEXT_URI2
+    playback.save_playback_state(playback_state)
+
+    # ...and then the reader fills the cache with what it read
+    cache.add(playback.get_state_cache_key(station1.id, stale_version),
+              stale_entry)
+
+    assert playback.get_playback_state(
+        station1.id).context_uri == MOCK_CONTEXT_URI2
+
+
+@pytest.mark.django_db(transaction=True)
+def test_save_playback_state_increments_version(station1: Station):
+    playback_state = create_playback_state(station1)
+    version = playback_state.version
+
+    playback_state.context_uri = MOCK_CONTEXT_URI2
+    playback.save_playback_state(playback_state)
+    assert playback_state.version == version + 1
+    assert PlaybackState.objects.get(station=station1).version == version + 1
+
+
+@pytest.mark.django_db(transaction=True)
+def test_concurrent_playback_state_updates_conflict(station1: Station):
+    create_playback_state(station1)
+    playback_state1 = playback.get_playback_state(station1.id)
+    playback_state2 = playback.get_playback_state(station1.id)
+
+    playback_state1.context_uri = MOCK_CONTEXT_URI2
+    playback.save_playback_state(playback_state1)
+
+    playback_state2.paused = False
+    with pytest.raises(PlaybackStateConflict):
+        playback.save_playback_state(playback_state2)
+
+    playback_state = PlaybackState.objects.get(station=station1)
+    assert playback_state.context_uri == MOCK_CONTEXT_URI2
+    assert playback_state.paused
+
+
+@pytest.mark.django_db(transaction=True)
+def test_unexpected_playback_state_version_conflicts(station1: Station):
+    create_playback_state(station1)
+    playback_state = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state)
+    playback_state.paused = False
+    with pytest.raises(PlaybackStateConflict):
+        playback.save_playback_state(playback_state, previous,
+                                     {previous.version - 1})
+
+
+@pytest.mark.django_db(transaction=True)
+def test_changes_under_an_older_dj_lease_conflict(station1: Station):
+    create_playback_state(station1)
+    playback_state = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state)
+    playback_state.paused = False
+    playback.save_playback_state(playback_state, previous, lease_token=2)
+    assert PlaybackState.objects.get(station=station1).dj_lease_token == 2
+
+    playback_state = playback.get_playback_state(station1.id)
+    previous = copy.copy(playback_state)
+    playback_state.paused = True
+    with pytest.raises(StaleDjLease):
+        playback.save_playback_state(playback_state, previous, lease_token=1)
+    assert not PlaybackState.objects.get(station=station1).paused
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(PLAYBACK_STATE_BATCH_FLUSH_POSITIONS=True)
+def test_position_updates_are_batch_flushed(station1: Station):
+    create_playback_state(station1)
+    playback_state = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state)
+    playback_state.raw_position_ms = 1000
+    assert playback.save_playback_state(playback_state, previous)
+    assert playback.get_playback_state(station1.id).raw_position_ms == 1000
+    assert PlaybackState.objects.get(station=station1).raw_position_ms == 0
+
+    # Flush once the database copy is older than the flush interval
+    playback_state = playback.get_playback_state(station1.id)
+    playback_state.flushed_time -= timedelta(minutes=1)
+    previous = copy.copy(playback_state)
+    playback_state.raw_position_ms = 2000
+    assert playback.save_playback_state(playback_state, previous)
+    assert PlaybackState.objects.get(station=station1).raw_position_ms == 2000
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(PLAYBACK_STATE_BATCH_FLUSH_POSITIONS=True)
+def test_concurrent_batched_position_updates_conflict(station1: Station):
+    create_playback_state(station1)
+    playback_state1 = playback.get_playback_state(station1.id)
+    playback_state2 = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state1)
+    playback_state1.raw_position_ms = 1000
+    assert playback.save_playback_state(playback_state1, previous)
+
+    # Made to the same version as the first update
+    previous = copy.copy(playback_state2)
+    playback_state2.raw_position_ms = 2000
+    with pytest.raises(PlaybackStateConflict):
+        playback.save_playback_state(playback_state2, previous)
+    assert playback.get_playback_state(station1.id).raw_position_ms == 1000
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(PLAYBACK_STATE_BATCH_FLUSH_POSITIONS=True)
+def test_writes_do_not_overwrite_batched_position_updates(station1: Station):
+    create_playback_state(station1)
+    playback_state1 = playback.get_playback_state(station1.id)
+    playback_state2 = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state1)
+    playback_state1.raw_position_ms = 1000
+    assert playback.save_playback_state(playback_state1, previous)
+
+    # The database is still at the version the second update was made to
+    previous = copy.copy(playback_state2)
+    playback_state2.paused = False
+    with pytest.raises(PlaybackStateConflict):
+        playback.save_playback_state(playback_state2, previous)
+    assert playback.get_playback_state(station1.id).raw_position_ms == 1000
+    assert PlaybackState.objects.get(station=station1).paused
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(PLAYBACK_STATE_BATCH_FLUSH_POSITIONS=True)
+def test_non_position_updates_are_not_batched(station1: Station):
+    create_playback_state(station1)
+    playback_state = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state)
+    playback_state.paused = False
+    assert playback.save_playback_state(playback_state, previous)
+    assert not PlaybackState.objects.get(station=station1).paused
+
+
+@pytest.mark.django_db(transaction=True)
+def test_consistent_heartbeats_are_coalesced(station1: Station):
+    create_playback_state(station1, paused=False)
+    playback_state = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state)
+    playback_state.raw_position_ms += 3000
+    playback_state.sample_time += timedelta(seconds=3, milliseconds=100)
+    assert not playback.save_playback_state(playback_state, previous)
+    assert playback.get_playback_state(station1.id).raw_position_ms == 0
+    assert PlaybackState.objects.get(station=station1).raw_position_ms == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_paused_heartbeats_are_coalesced(station1: Station):
+    create_playback_state(station1, paused=True)
+    playback_state = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state)
+    playback_state.sample_time += timedelta(seconds=3)
+    assert not playback.save_playback_state(playback_state, previous)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_heartbeats_are_checkpointed(station1: Station):
+    create_playback_state(station1, paused=False)
+    playback_state = playback.get_playback_state(station1.id)
+    playback_state.flushed_time -= timedelta(minutes=1)
+
+    previous = copy.copy(playback_state)
+    playback_state.raw_position_ms += 3000
+    playback_state.sample_time += timedelta(seconds=3)
+    assert not playback.save_playback_state(playback_state, previous)
+    assert PlaybackState.objects.get(station=station1).raw_position_ms == 3000
+
+
+@pytest.mark.django_db(transaction=True)
+def test_seeks_are_not_coalesced(station1: Station):
+    create_playback_state(station1, paused=False)
+    playback_state = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state)
+    playback_state.raw_position_ms += 60000
+    playback_state.sample_time += timedelta(seconds=3)
+    assert playback.save_playback_state(playback_state, previous)
+    assert PlaybackState.objects.get(station=station1).raw_position_ms == 60000
+
+
+@pytest.mark.django_db(transaction=True)
+def test_pause_playback_state(station1: Station):
+    create_playback_state(station1, paused=False)
+    playback.get_playback_state(station1.id)
+
+    playback_state = playback.pause_playback_state(station1.id)
+    assert playback_state.paused
+    assert playback_state.version == 1
+    assert playback.get_playback_state(station1.id).paused
+    assert PlaybackState.objects.get(station=station1).paused
+
+    # Pausing a paused station changes nothing
+    assert playback.pause_playback_state(station1.id) is None
+    assert PlaybackState.objects.get(station=station1).version == 1
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(PLAYBACK_STATE_BATCH_FLUSH_POSITIONS=True)
+def test_pause_playback_state_moves_past_batched_versions(station1: Station):
+    create_playback_state(station1, paused=False)
+    playback_state = playback.get_playback_state(station1.id)
+
+    previous = copy.copy(playback_state)
+    playback_state.raw_position_ms = 1000
+    playback_state.sample_time += timedelta(minutes=1)
+    assert playback.save_playback_state(playback_state, previous)
+    assert PlaybackState.objects.get(station=station1).version == 0
+
+    paused_playback_state = playback.pause_playback_state(station1.id)
+    assert paused_playback_state.version == playback_state.version + 1
+
+
+def test_position_is_extrapolated_while_playing():
+    sample_time = timezone.now()
+    playback_state = PlaybackState(paused=False,
+                                   raw_position_ms=1000,
+                                   sample_time=sample_time)
+    assert playback_state.position_ms_at(sample_time +
+                                         timedelta(seconds=2)) == 3000
+
+    playback_state.paused = True
+    assert playback_state.position_ms_at(sample_time +
+                                         timedelta(seconds=2)) == 1000
+
+
+@pytest.fixture
+def station1() -> Station:
+    return Station.objects.create(title='TestStation1')
+
+
+def create_playback_state(station: Station, paused=True) -> PlaybackState:
+    return PlaybackState.objects.create(station=station,
+                                        context_uri=MOCK_CONTEXT_URI1,
+                                        current_track_uri=MOCK_TRACK_URI1,
+                                        paused=paused,
+                                        raw_position_ms=0,
+                                        sample_time=timezone.now())
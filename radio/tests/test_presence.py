@@ -0,0 +1,103 @@
+from datetime import timedelta
+import time
+
+from ..presence import InMemoryPresence, StationRoster
+
+STATION_ID = 1
+USER_ID1 = 1
+USER_ID2 = 2
+
+
+def test_users_are_present_until_their_last_connection_leaves():
+    presence = InMemoryPresence()
+    presence.join(STATION_ID, USER_ID1)
+    presence.join(STATION_ID, USER_ID1)
+    presence.join(STATION_ID, USER_ID2)
+    assert presence.count(STATION_ID) == 2
+
+    presence.leave(STATION_ID, USER_ID1)
+    assert presence.count(STATION_ID) == 2
+    assert [
+        user['connections'] for user in presence.get_users(STATION_ID, 0, 2)
+        if user['user_id'] == USER_ID1
+    ] == [1]
+
+    presence.leave(STATION_ID, USER_ID1)
+    presence.leave(STATION_ID, USER_ID2)
+    assert presence.count(STATION_ID) == 0
+
+
+def test_present_users_are_counted_per_station():
+    presence = InMemoryPresence()
+    presence.join(STATION_ID, USER_ID1)
+    presence.join(STATION_ID, USER_ID2)
+    presence.join(STATION_ID + 1, USER_ID1)
+
+    assert presence.get_counts([STATION_ID, STATION_ID + 1,
+                                STATION_ID + 2]) == {
+                                    STATION_ID: 2,
+                                    STATION_ID + 1: 1,
+                                    STATION_ID + 2: 0,
+                                }
+
+
+def test_stale_users_are_reaped(settings):
+    settings.PRESENCE_STALE_AFTER = timedelta(milliseconds=50)
+    presence = InMemoryPresence()
+    presence.join(STATION_ID, USER_ID1)
+    presence.join(STATION_ID, USER_ID2)
+
+    time.sleep(0.1)
+    presence.touch(STATION_ID, USER_ID2)
+
+    assert presence.reap(STATION_ID) == 1
+    assert [user['user_id']
+            for user in presence.get_users(STATION_ID, 0, 2)] == [USER_ID2]
+
+
+def test_stale_users_are_not_present_before_being_reaped(settings):
+    settings.PRESENCE_STALE_AFTER = timedelta(milliseconds=50)
+    presence = InMemoryPresence()
+    presence.join(STATION_ID, USER_ID1)
+    presence.join(STATION_ID, USER_ID2)
+
+    time.sleep(0.1)
+    presence.touch(STATION_ID, USER_ID2)
+
+    assert not presence.is_present(STATION_ID, USER_ID1)
+    assert presence.get_present_user_ids(STATION_ID,
+                                         [USER_ID1, USER_ID2]) == {USER_ID2}
+    assert presence.count(STATION_ID) == 1
+    assert presence.get_counts([STATION_ID]) == {STATION_ID: 1}
+    assert [user['user_id']
+            for user in presence.get_users(STATION_ID, 0, 2)] == [USER_ID2]
+
+
+def test_reaped_users_are_present_again_when_touched(settings):
+    settings.PRESENCE_STALE_AFTER = timedelta(milliseconds=50)
+    presence = InMemoryPresence()
+    presence.join(STATION_ID, USER_ID1)
+
+    time.sleep(0.1)
+    assert presence.reap(STATION_ID) == 1
+    presence.touch(STATION_ID, USER_ID1)
+
+    assert presence.is_present(STATION_ID, USER_ID1)
+    assert [
+        user['connections'] for user in presence.get_users(STATION_ID, 0, 1)
+    ] == [1]
+
+    presence.leave(STATION_ID, USER_ID1)
+    assert not presence.is_present(STATION_ID, USER_ID1)
+
+
+def test_station_roster_is_sliced_most_recently_seen_first():
+    presence = InMemoryPresence()
+    for user_id in range(1, 6):
+        presence.join(STATION_ID, user_id)
+        time.sleep(0.001)
+
+    roster = StationRoster(presence, STATION_ID)
+    assert len(roster) == 5
+    assert [user['user_id'] for user in roster[1:3]] == [4, 3]
+    assert roster[5:10] == []
@@ -0,0 +1,203 @@
+"""Query plans of the hot queries against seeded data.
+
+Each test asks SQLite to EXPLAIN QUERY PLAN one of the hot queries and fails
+if it scans a whole table instead of searching an index, or no longer uses
+the index meant for it.
+"""
+
+# Disable redefinition of outer name for pytest which uses this feature for
+# fixtures.
+# pylint: disable=redefined-outer-name
+
+from datetime import timedelta
+
+from django.contrib import auth
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+import pytest
+
+from ..models import Listener, PlaybackState, SpotifyCredentials, Station
+
+pytestmark = pytest.mark.skipif(connection.vendor != 'sqlite',
+                                reason='Query plans are SQLite specific')
+
+USER_COUNT = 200
+STATION_COUNT = 20
+STATIONS_PER_USER = 5
+
+
+@pytest.mark.django_db
+def test_listener_lookup_searches_index(seeded_ids):
+    user_id, station_id = seeded_ids
+    plan = get_query_plan(
+        Listener.objects.select_related(
+            'station', 'station__playbackstate').filter(user_id=user_id,
+                                                        station_id=station_id))
+    # Both indexes lead with (user_id, station_id)
+    assert_searches(plan, 'radio_listener',
+                    get_unique_index_name('radio_listener'),
+                    'radio_listener_user_roles')
+
+
+@pytest.mark.django_db
+def test_station_admin_check_searches_index(seeded_ids):
+    user_id, station_id = seeded_ids
+    plan = get_query_plan(
+        Listener.objects.filter(user_id=user_id,
+                                station_id=station_id).values_list('is_admin',
+                                                                   flat=True))
+    # Both indexes lead with (user_id, station_id)
+    assert_searches(plan, 'radio_listener',
+                    get_unique_index_name('radio_listener'),
+                    'radio_listener_user_roles')
+
+
+@pytest.mark.django_db
+def test_station_index_searches_covering_index(seeded_ids):
+    user_id, _ = seeded_ids
+    plan = get_query_plan(
+        Station.objects.filter(listener__user=user_id).annotate(
+            is_admin=F('listener__is_admin'),
+            is_dj=F('listener__is_dj'),
+            current_track_uri=F('playbackstate__current_track_uri'),
+        ).order_by('title', 'id'))
+    assert_searches(plan, 'radio_listener', 'radio_listener_user_roles')
+    assert_searches(plan, 'radio_playbackstate')
+
+
+@pytest.mark.django_db
+def test_listener_pages_search_index_in_order(seeded_ids):
+    _, station_id = seeded_ids
+    plan = get_query_plan(
+        Listener.objects.filter(
+            station_id=station_id).select_related('user').order_by('id'))
+    assert_searches(plan, 'radio_listener', 'radio_listener_station')
+    assert_not_sorted(plan)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('role, index', [
+    ('is_admin', 'radio_listener_station_admins'),
+    ('is_dj', 'radio_listener_station_djs'),
+])
+def test_listener_pages_by_role_search_partial_index(seeded_ids, role, index):
+    _, station_id = seeded_ids
+    plan = get_query_plan(
+        Listener.objects.filter(station_id=station_id, **{
+            role: True
+        }).order_by('id'))
+    assert_searches(plan, 'radio_listener', index)
+    assert_not_sorted(plan)
+
+
+@pytest.mark.django_db
+def test_playback_state_lookup_searches_index(seeded_ids):
+    _, station_id = seeded_ids
+    plan = get_query_plan(PlaybackState.objects.filter(station_id=station_id))
+    assert_searches(plan, 'radio_playbackstate')
+
+
+@pytest.mark.django_db
+def test_expiring_credentials_search_covering_index(seeded_ids):
+    now = timezone.now()
+    plan = get_query_plan(
+        SpotifyCredentials.objects.filter(
+            access_token_expiration_time__gte=now - timedelta(minutes=5),
+            access_token_expiration_time__lt=now +
+            timedelta(minutes=10)).order_by(
+                'access_token_expiration_time').values_list('user_id',
+                                                            flat=True)[:500])
+    assert_searches(plan, 'radio_spotifycredentials',
+                    'radio_spotifycreds_expiring')
+    assert_not_sorted(plan)
+
+
+@pytest.mark.django_db
+def test_connected_users_lookup_searches_index(seeded_ids):
+    user_id, _ = seeded_ids
+    plan = get_query_plan(
+        Listener.objects.filter(user_id__in=[user_id, user_id +
+                                             1]).values_list(
+                                                 'user_id', 'station_id'))
+    assert_searches(plan, 'radio_listener')
+
+
+# Fixtures
+
+
+@pytest.fixture
+def seeded_ids():
+    """Seed users listening to stations and return a user and station id."""
+    user_model = auth.get_user_model()
+    user_model.objects.bulk_create(
+        [user_model(username=f'SeededUsername{i}') for i in range(USER_COUNT)])
+    users = list(user_model.objects.order_by('id'))
+
+    Station.objects.bulk_create(
+        [Station(title=f'SeededStation{i}') for i in range(STATION_COUNT)])
+    stations = list(Station.objects.order_by('id'))
+
+    now = timezone.now()
+    PlaybackState.objects.bulk_create([
+        PlaybackState(station=station,
+                      context_uri='context_uri',
+                      current_track_uri='current_track_uri',
+                      paused=True,
+                      raw_position_ms=0,
+                      sample_time=now) for station in stations
+    ])
+
+    Listener.objects.bulk_create([
+        Listener(user=user,
+                 station=stations[(i + j) % STATION_COUNT],
+                 is_admin=i % 10 == 0,
+                 is_dj=i % 5 == 0) for i, user in enumerate(users)
+        for j in range(STATIONS_PER_USER)
+    ])
+
+    SpotifyCredentials.objects.bulk_create([
+        SpotifyCredentials(user=user,
+                           access_token_expiration_time=now +
+                           timedelta(minutes=i))
+        for i, user in enumerate(users)
+    ])
+
+    # Plan with statistics of the seeded data, like a production database
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+
+    return users[0].id, stations[0].id
+
+
+# Utils
+
+
+def get_query_plan(queryset):
+    """Return the details of the queryset's query plan, one per step."""
+    return [line.split(' ', 3)[3] for line in queryset.explain().splitlines()]
+
+
+def assert_searches(plan, table, *indexes):
+    """Assert that the plan searches the table, using one of the indexes if
+    any are given."""
+    steps = [step for step in plan if f' {table} ' in f' {step} ']
+    assert steps, plan
+    for step in steps:
+        assert not step.startswith('SCAN'), plan
+        assert step.startswith('SEARCH'), plan
+        if indexes:
+            assert any(f' INDEX {index} ' in step for index in indexes), plan
+
+
+def get_unique_index_name(table):
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+
+    return next(name for name, constraint in constraints.items()
+                if constraint['unique'] and constraint['index']
+                and not constraint['primary_key'])
+
+
+def assert_not_sorted(plan):
+    assert not any(step.startswith('USE TEMP B-TREE') for step in plan), plan
@@ -2,12 +2,18 @@
 # fixtures.
 # pylint: disable=redefined-outer-name
 
+from datetime import timedelta
+from http import HTTPStatus
+
+from channels.db import database_sync_to_async
 from django.contrib import auth
 from django.test import override_settings
 from django.utils import timezone
 import pytest
+import requests
 
 from accounts.models import User
+from .. import spotify_accounts
 from ..spotify import AccessToken
 from ..models import SpotifyCredentials
 from . import mocks
@@ -28,12 +34,180 @@ def test_refresh_access_token(user1: User):
         assert access_token.token == mocks.TEST_ACCESS_TOKEN
 
 
+@pytest.mark.django_db(transaction=True)
+def test_load_fresh_access_token_refreshes_once(user1: User):
+    create_spotify_credentials(user1)
+
+    handler = mocks.create_flaky_spotify_request_handler([])
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port, handler)
+
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token'):
+        access_token = AccessToken.load_fresh(user1.id)
+        assert access_token.token == mocks.TEST_ACCESS_TOKEN
+
+        # Later callers reuse the refreshed token
+        access_token = AccessToken.load_fresh(user1.id)
+        assert access_token.token == mocks.TEST_ACCESS_TOKEN
+        assert handler.requests == 1
+
+    assert SpotifyCredentials.objects.get(
+        user=user1).access_token == mocks.TEST_ACCESS_TOKEN
+
+
+@pytest.mark.django_db(transaction=True)
+@override_settings(
+    SPOTIFY_ACCOUNTS_RETRY_BACKOFF=timedelta(seconds=1),
+    SPOTIFY_ACCESS_TOKEN_LOCKED_REFRESH_DEADLINE=timedelta(milliseconds=1500))
+def test_load_fresh_access_token_gives_up_by_deadline(user1: User):
+    create_spotify_credentials(user1, access_token='expired_access_token')
+
+    handler = mocks.create_flaky_spotify_request_handler(
+        [(HTTPStatus.SERVICE_UNAVAILABLE, {})] * 10)
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port, handler)
+
+    start = timezone.now()
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token'):
+        with pytest.raises(requests.HTTPError):
+            AccessToken.load_fresh(user1.id)
+
+    # The second retry would have waited past the deadline
+    assert handler.requests == 2
+    assert timezone.now() - start < timedelta(seconds=3)
+    assert SpotifyCredentials.objects.get(
+        user=user1).access_token == 'expired_access_token'
+
+
+@pytest.mark.django_db
+def test_fresh_access_tokens_are_loaded_from_cache(user1: User,
+                                                   django_assert_num_queries):
+    create_spotify_credentials(user1,
+                               access_token_expiration_time=timezone.now() +
+                               timedelta(hours=1))
+    access_token = AccessToken.load_fresh(user1.id)
+
+    with django_assert_num_queries(0):
+        cached_access_token = AccessToken.load_fresh(user1.id)
+    assert cached_access_token.token == access_token.token
+    assert (cached_access_token.token_expiration_time ==
+            access_token.token_expiration_time)
+
+
+@pytest.mark.django_db
+def test_save_access_token_updates_credentials_in_one_query(
+        user1: User, django_assert_num_queries):
+    creds = create_spotify_credentials(user1)
+    access_token = AccessToken.from_db_model(creds)
+    access_token.update_token({
+        'access_token': 'new_access_token',
+        'refresh_token': 'new_refresh_token',
+        'expires_in': 3600,
+    })
+
+    with django_assert_num_queries(1):
+        access_token.save()
+
+    creds = SpotifyCredentials.objects.get(user=user1)
+    assert creds.access_token == 'new_access_token'
+    assert creds.refresh_token == 'new_refresh_token'
+    assert AccessToken.get_cached(user1.id).token == 'new_access_token'
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.asyncio
+async def test_refresh_access_token_async(user1: User):
+    await database_sync_to_async(create_spotify_credentials)(user1)
+    access_token = await database_sync_to_async(AccessToken.load)(user1.id)
+
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port)
+
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token'):
+        await access_token.refresh_async()
+        assert access_token.token == mocks.TEST_ACCESS_TOKEN
+
+
+@override_settings(SPOTIFY_ACCOUNTS_RETRY_BACKOFF=timedelta())
+def test_token_requests_are_retried():
+    handler = mocks.create_flaky_spotify_request_handler([
+        (HTTPStatus.TOO_MANY_REQUESTS, {
+            'Retry-After': '0'
+        }),
+        (HTTPStatus.SERVICE_UNAVAILABLE, {}),
+    ])
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port, handler)
+
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token'):
+        response_data = spotify_accounts.refresh_access_token('refresh_token')
+        assert response_data['access_token'] == mocks.TEST_ACCESS_TOKEN
+        assert handler.requests == 3
+
+
+@override_settings(SPOTIFY_ACCOUNTS_RETRY_BACKOFF=timedelta(),
+                   SPOTIFY_ACCOUNTS_MAX_RETRIES=1)
+def test_token_requests_give_up_after_retries():
+    handler = mocks.create_flaky_spotify_request_handler(
+        [(HTTPStatus.INTERNAL_SERVER_ERROR, {})] * 3)
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port, handler)
+
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token'):
+        with pytest.raises(requests.HTTPError):
+            spotify_accounts.refresh_access_token('refresh_token')
+        assert handler.requests == 2
+
+
+@override_settings(SPOTIFY_ACCOUNTS_MAX_RETRY_AFTER=timedelta(seconds=1))
+def test_token_requests_are_not_retried_after_long_retry_after():
+    handler = mocks.create_flaky_spotify_request_handler([
+        (HTTPStatus.TOO_MANY_REQUESTS, {
+            'Retry-After': '60'
+        }),
+    ])
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port, handler)
+
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token'):
+        with pytest.raises(requests.HTTPError):
+            spotify_accounts.refresh_access_token('refresh_token')
+        assert handler.requests == 1
+
+
+def test_token_requests_fail_on_unfollowed_redirects():
+    handler = mocks.create_flaky_spotify_request_handler([
+        (HTTPStatus.MULTIPLE_CHOICES, {}),
+    ])
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port, handler)
+
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token'):
+        with pytest.raises(requests.HTTPError):
+            spotify_accounts.refresh_access_token('refresh_token')
+        assert handler.requests == 1
+
+
+def test_parse_retry_after():
+    assert spotify_accounts.parse_retry_after('3') == timedelta(seconds=3)
+    assert spotify_accounts.parse_retry_after(
+        'Wed, 21 Oct 2015 07:28:00 GMT') == timedelta()
+    assert spotify_accounts.parse_retry_after('soon') is None
+
+
 @pytest.fixture
 def user1() -> User:
     return auth.get_user_model().objects.create(username='testuser1',
                                                 email='testuser1@example.com')
 
 
-def create_spotify_credentials(user):
-    return SpotifyCredentials.objects.create(
-        user=user, access_token_expiration_time=timezone.now())
+def create_spotify_credentials(user, **kwargs):
+    kwargs.setdefault('access_token_expiration_time', timezone.now())
+    return SpotifyCredentials.objects.create(user=user, **kwargs)
@@ -0,0 +1,132 @@
+# Disable redefinition of outer name for pytest which uses this feature for
+# fixtures.
+# pylint: disable=redefined-outer-name
+
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib import auth
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+import pytest
+
+from accounts.models import User
+from .. import presence, token_refresh
+from ..models import Listener, SpotifyCredentials, Station
+from . import mocks
+
+
+@pytest.mark.django_db(transaction=True)
+def test_expiring_access_tokens_of_connected_users_are_refreshed(
+        station1: Station):
+    expiring_user = create_user('expiring', timedelta(minutes=1))
+    disconnected_user = create_user('disconnected', timedelta(minutes=1))
+    fresh_user = create_user('fresh', timedelta(hours=1))
+    for user in (expiring_user, disconnected_user, fresh_user):
+        Listener.objects.create(user=user,
+                                station=station1,
+                                is_admin=False,
+                                is_dj=False)
+
+    station_presence = presence.get_presence()
+    station_presence.join(station1.id, expiring_user.id)
+    station_presence.join(station1.id, fresh_user.id)
+
+    handler = mocks.create_flaky_spotify_request_handler([])
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port, handler)
+
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token'):
+        refreshed = token_refresh.refresh_expiring_access_tokens(
+            token_refresh.RateLimiter(rate=100))
+
+    assert refreshed == 1
+    assert handler.requests == 1
+    assert SpotifyCredentials.objects.get(
+        user=expiring_user).access_token == mocks.TEST_ACCESS_TOKEN
+
+
+@pytest.mark.django_db(transaction=True)
+def test_long_expired_access_tokens_do_not_crowd_out_expiring_ones(
+        station1: Station):
+    for i in range(5):
+        create_user(f'inactive{i}', -timedelta(days=1))
+    expiring_user = create_user('expiring', timedelta(minutes=1))
+    Listener.objects.create(user=expiring_user,
+                            station=station1,
+                            is_admin=False,
+                            is_dj=False)
+    presence.get_presence().join(station1.id, expiring_user.id)
+
+    handler = mocks.create_flaky_spotify_request_handler([])
+    port = mocks.get_free_port()
+    mocks.start_mock_spotify_server(port, handler)
+
+    with override_settings(
+            SPOTIFY_TOKEN_API_URL=f'http://localhost:{port}/api/token',
+            SPOTIFY_PROACTIVE_REFRESH_BATCH_SIZE=3):
+        refreshed = token_refresh.refresh_expiring_access_tokens(
+            token_refresh.RateLimiter(rate=100))
+
+    assert refreshed == 1
+    assert SpotifyCredentials.objects.get(
+        user=expiring_user).access_token == mocks.TEST_ACCESS_TOKEN
+
+
+@pytest.mark.django_db
+def test_expiring_user_ids_are_ordered_by_expiration():
+    later_user = create_user('later', timedelta(minutes=5))
+    sooner_user = create_user('sooner', timedelta(minutes=1))
+    just_expired_user = create_user('just_expired', -timedelta(minutes=1))
+    create_user('long_expired', -timedelta(hours=1))
+    create_user('fresh', timedelta(hours=1))
+
+    assert token_refresh.get_expiring_user_ids(timedelta(minutes=10),
+                                               timedelta(minutes=5)) == [
+                                                   just_expired_user.id,
+                                                   sooner_user.id,
+                                                   later_user.id
+                                               ]
+
+
+def test_rate_limiter_spaces_calls():
+    rate_limiter = token_refresh.RateLimiter(rate=20)
+    start = timezone.now()
+    for _ in range(3):
+        rate_limiter.wait()
+
+    assert timezone.now() - start >= timedelta(milliseconds=100)
+
+
+@pytest.mark.django_db
+def test_refresh_worker_keeps_running_after_failures():
+    stdout = StringIO()
+    # The worker is stopped by the interrupt of its third refresh
+    with mock.patch(
+            'radio.management.commands.refresh_access_tokens.'
+            'refresh_expiring_access_tokens',
+            side_effect=[RuntimeError, 3, KeyboardInterrupt]), mock.patch(
+                'radio.management.commands.refresh_access_tokens.time.sleep'):
+        with pytest.raises(KeyboardInterrupt):
+            call_command('refresh_access_tokens', stdout=stdout)
+
+    assert stdout.getvalue() == 'Refreshed 3 access tokens\n'
+
+
+@pytest.fixture
+def station1() -> Station:
+    return Station.objects.create(title='TestStation1')
+
+
+def create_user(username: str, expires_in: timedelta) -> User:
+    user = auth.get_user_model().objects.create(
+        username=username, email=f'{username}@example.com')
+    SpotifyCredentials.objects.create(
+        user=user,
+        refresh_token=f'{username}_refresh_token',
+        access_token=f'{username}_access_token',
+        access_token_expiration_time=timezone.now() + expires_in)
+    return user
@@ -1,11 +1,14 @@
+from datetime import timedelta
 from http import HTTPStatus
 
 from django.contrib import auth
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 import pytest
 
 from accounts.models import User
-from ..models import Station
+from .. import presence
+from ..models import PlaybackState, SpotifyCredentials, Station
 from . import utils
 
 MOCK_USERNAME = 'MockUsername'
@@ -28,6 +31,58 @@ class RadioViewsTests(TestCase):
         assert station1 in response.context['stations']
         assert station2 not in response.context['stations']
 
+    def test_station_index_shows_roles_tracks_and_live_listeners(self):
+        user = create_user()
+        self.client.force_login(user)
+        station1 = utils.create_station()
+        utils.create_listener(station1, user, is_admin=True)
+        PlaybackState.objects.create(station=station1,
+                                     context_uri='context_uri',
+                                     current_track_uri='current_track_uri',
+                                     paused=False,
+                                     raw_position_ms=0,
+                                     sample_time=timezone.now())
+        station2 = utils.create_station()
+        utils.create_listener(station2, user, is_admin=False, is_dj=False)
+        presence.get_presence().join(station2.id, user.id)
+
+        response = self.client.get('/stations/')
+
+        stations = {
+            station.id: station
+            for station in response.context['stations']
+        }
+        assert stations[station1.id].is_admin
+        assert stations[station1.id].current_track_uri == 'current_track_uri'
+        assert stations[station1.id].live_listener_count == 0
+        assert not stations[station2.id].is_admin
+        assert not stations[station2.id].is_dj
+        assert stations[station2.id].current_track_uri is None
+        assert stations[station2.id].live_listener_count == 1
+
+    def test_station_index_renders_in_constant_queries(self):
+        user = create_user()
+        self.client.force_login(user)
+        for _ in range(5):
+            utils.create_listener(utils.create_station(), user)
+
+        # Session, user, and the page's count and stations
+        with self.assertNumQueries(4):
+            response = self.client.get('/stations/')
+        assert len(response.context['stations']) == 5
+
+    @override_settings(STATION_PAGE_SIZE=2)
+    def test_station_index_is_paginated(self):
+        user = create_user()
+        self.client.force_login(user)
+        for _ in range(3):
+            utils.create_listener(utils.create_station(), user)
+
+        response = self.client.get('/stations/?page=2')
+
+        assert response.context['is_paginated']
+        assert len(response.context['stations']) == 1
+
     def test_user_needs_to_be_logged_in_to_access_station_index(self):
         response = self.client.get('/stations/')
         self.assertRedirects(response, '/accounts/login/?next=/stations/')
@@ -40,6 +95,27 @@ class RadioViewsTests(TestCase):
 
         assert response.status_code == HTTPStatus.NOT_FOUND.value
 
+    def test_station_renders_in_few_queries(self):
+        user = create_user()
+        self.client.force_login(user)
+        station = utils.create_station()
+        utils.create_listener(station, user)
+        SpotifyCredentials.objects.create(
+            user=user,
+            refresh_token='refresh_token',
+            access_token='access_token',
+            access_token_expiration_time=timezone.now() + timedelta(hours=1))
+
+        # The first view saves the access token in the session
+        response = self.client.get(f'/stations/{station.id}/')
+        assert response.status_code == HTTPStatus.OK.value
+        assert response.context['access_token'] == 'access_token'
+
+        # Session, user, and the listener with its station and credentials
+        with self.assertNumQueries(3):
+            response = self.client.get(f'/stations/{station.id}/')
+        assert response.status_code == HTTPStatus.OK.value
+
     def test_user_can_delete_station(self):
         user = create_user()
         self.client.force_login(user)
@@ -0,0 +1,95 @@
+"""Proactive refresh of the access tokens of connected listeners.
+
+Refreshing access tokens when a page or the player asks for them puts a
+Spotify round trip on their critical path. Instead, a worker periodically
+refreshes the tokens which expire within SPOTIFY_PROACTIVE_REFRESH_LEAD of
+the users connected to a station, found through the station presence, so
+that requests find their token fresh. Tokens which expired more than
+SPOTIFY_PROACTIVE_REFRESH_EXPIRED_GRACE ago belong to users who have not
+used them since, and are left to be refreshed on demand, so they cannot
+crowd the tokens about to expire out of the batch. Refreshes are spaced to at most
+SPOTIFY_PROACTIVE_REFRESH_RATE per second to stay clear of the accounts
+service's rate limits.
+"""
+
+import logging
+import time
+
+from django.conf import settings
+from django.utils import timezone
+import requests
+
+from . import presence
+from .models import Listener, SpotifyCredentials
+from .spotify import AccessToken
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Space calls to wait() at least 1 / rate seconds apart."""
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = time.monotonic()
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self.next_time:
+            time.sleep(self.next_time - now)
+            now = self.next_time
+
+        self.next_time = now + self.interval
+
+
+def refresh_expiring_access_tokens(rate_limiter):
+    """Refresh the expiring access tokens of connected users.
+
+    Returns the number of access tokens refreshed.
+    """
+    lead = settings.SPOTIFY_PROACTIVE_REFRESH_LEAD
+    user_ids = get_connected_user_ids(
+        get_expiring_user_ids(
+            lead, settings.SPOTIFY_PROACTIVE_REFRESH_EXPIRED_GRACE))
+
+    refreshed = 0
+    for user_id in user_ids:
+        rate_limiter.wait()
+        try:
+            AccessToken.load_fresh(user_id, lead)
+        except (requests.RequestException, SpotifyCredentials.DoesNotExist):
+            logger.exception('Failed to refresh the access token of user %d',
+                             user_id)
+        else:
+            refreshed += 1
+
+    return refreshed
+
+
+def get_expiring_user_ids(lead, expired_grace):
+    """Return the users whose access tokens expire within lead, or expired
+    within expired_grace, soonest first."""
+    now = timezone.now()
+    expiring = SpotifyCredentials.objects.filter(
+        access_token_expiration_time__gte=now - expired_grace,
+        access_token_expiration_time__lt=now + lead)
+    return list(
+        expiring.order_by('access_token_expiration_time').values_list(
+            'user_id',
+            flat=True)[:settings.SPOTIFY_PROACTIVE_REFRESH_BATCH_SIZE])
+
+
+def get_connected_user_ids(user_ids):
+    """Return which of the users are connected to any of their stations, in
+    the order given."""
+    station_user_ids = {}
+    for user_id, station_id in Listener.objects.filter(
+            user_id__in=user_ids).values_list('user_id', 'station_id'):
+        station_user_ids.setdefault(station_id, []).append(user_id)
+
+    station_presence = presence.get_presence()
+    connected_user_ids = set()
+    for station_id, station_users in station_user_ids.items():
+        connected_user_ids |= station_presence.get_present_user_ids(
+            station_id, station_users)
+
+    return [user_id for user_id in user_ids if user_id in connected_user_ids]
@@ -2,13 +2,14 @@ import logging
 
 from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db.models import F
 from django.http import HttpRequest, HttpResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse_lazy
 from django.views import View, generic
 from django.views.generic.edit import CreateView, DeleteView
 
-from . import spotify
+from . import presence, spotify
 from .forms import StationForm
 from .models import Listener, Station
 
@@ -17,12 +18,19 @@ logger = logging.getLogger(__name__)
 
 # pylint: disable=too-few-public-methods
 class ListenerRequiredMixin:
+    """
+    Verify that the current user is a listener of the station.
+
+    The listener is stored in request.listener, fetched together with its
+    listener_related relations.
+    """
     user_check_failure_path = ''
+    listener_related = ('station', )
 
     def dispatch(self, request: HttpRequest, *args, **kwargs):
         # Django does not have a base class for mixins, so ignore some type errors
-        get_object_or_404(
-            Listener,
+        request.listener = get_object_or_404(  # type: ignore
+            Listener.objects.select_related(*self.listener_related),
             user=self.request.user,  # type: ignore
             station_id=kwargs['pk'])
         return super().dispatch(request, *args, **kwargs)  # type: ignore
@@ -39,17 +47,40 @@ class IndexView(LoginRequiredMixin, View):
 
 
 class ListStationsView(generic.ListView):
+    """
+    List the user's stations with the user's roles, the current track and
+    the number of connected listeners.
+
+    The stations, roles and current tracks are read in one query joining the
+    user's listeners, and the connected listener counts of the page in one
+    presence round trip.
+    """
     model = Station
     context_object_name = 'stations'
     template_name = 'radio/index.html'
 
+    def get_paginate_by(self, queryset):
+        return settings.STATION_PAGE_SIZE
+
     def get_queryset(self):
-        station_ids = Listener.objects.filter(
-            user=self.request.user).values_list('station_id', flat=True)
-        return Station.objects.filter(id__in=station_ids)
+        # Filter and annotate through the same join on the user's listeners
+        return Station.objects.filter(
+            listener__user=self.request.user).annotate(
+                is_admin=F('listener__is_admin'),
+                is_dj=F('listener__is_dj'),
+                current_track_uri=F('playbackstate__current_track_uri'),
+            ).order_by('title', 'id')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+
+        stations = list(context['stations'])
+        live_listener_counts = presence.get_presence().get_counts(
+            [station.id for station in stations])
+        for station in stations:
+            station.live_listener_count = live_listener_counts[station.id]
+        context['stations'] = stations
+
         context['form'] = StationForm
         return context
 
@@ -77,6 +108,11 @@ class DetailStationView(LoginRequiredMixin, ListenerRequiredMixin,
                         generic.DetailView):
     model = Station
     template_name = 'radio/detail.html'
+    # Fetch everything the page needs along with the listener
+    listener_related = ('station', 'user__spotifycredentials')
+
+    def get_object(self, queryset=None):
+        return self.request.listener.station
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -84,9 +120,7 @@ class DetailStationView(LoginRequiredMixin, ListenerRequiredMixin,
         context['user_id'] = self.request.user.id
         context['debug'] = settings.DEBUG
 
-        listener = get_object_or_404(Listener,
-                                     user=self.request.user,
-                                     station=context['object'])
+        listener = self.request.listener
         context['is_dj'] = listener.is_dj
         context['is_admin'] = listener.is_admin
 
@@ -102,9 +136,7 @@ class DeleteStationView(LoginRequiredMixin, ListenerRequiredMixin, DeleteView):
 
     def post(self, request: HttpRequest, *args, **kwargs):
         # precondition: ListenerRequiredMixin
-        listener = Listener.objects.get(user=request.user,
-                                        station_id=kwargs['pk'])
-        if listener.is_admin:
+        if request.listener.is_admin:
             return super().post(request, *args, **kwargs)
         else:
             return redirect('/stations/')